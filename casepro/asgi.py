@@ -0,0 +1,18 @@
+"""
+ASGI config for casepro project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. This should be used to serve /push/
+so that clients' open push streams don't each hold a worker thread, e.g. with gunicorn's uvicorn worker class.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/dev/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application  # noqa
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "casepro.settings")
+
+
+application = get_asgi_application()
@@ -28,6 +28,17 @@ class BaseBackend(object):
         :return: tuple of the number of contacts created, updated, deleted and ignored
         """
 
+    @abstractmethod
+    def pull_contacts_by_uuid(self, org, uuids) -> Tuple[int, int, int, int]:
+        """
+        Pulls the contacts with the given UUIDs, e.g. to fill in stub contacts without waiting for them to be pulled as
+        modified contacts. Stub contacts which the backend confirms were deleted are released.
+
+        :param org: the org
+        :param list[str] uuids: the contact UUIDs
+        :return: tuple of the number of contacts created, updated, deleted and ignored
+        """
+
     @abstractmethod
     def pull_fields(self, org) -> Tuple[int, int, int, int]:
         """
@@ -200,7 +211,7 @@ class BaseBackend(object):
         """
 
     @abstractmethod
-    def fetch_contact_messages(self, org, contact, created_after, created_before):
+    def fetch_contact_messages(self, org, contact, created_after, created_before, newer_than_id=None, limit=None):
         """
         Fetches additional messages to display on a case timeline
 
@@ -208,6 +219,8 @@ class BaseBackend(object):
         :param contact: the contact
         :param created_after: include messages created after this time
         :param created_before: include messages created before this time
+        :param newer_than_id: only include messages with backend ids greater than this
+        :param limit: stop after fetching at least this many of the newest messages
         :return: the messages as transient Message and Outgoing instances
         """
 
@@ -248,6 +261,9 @@ class NoopBackend(BaseBackend):  # pragma: no cover
     def pull_contacts(self, org, modified_after, modified_before, progress_callback=None, resume_cursor: str = None):
         return self.NO_CHANGES + (None,)
 
+    def pull_contacts_by_uuid(self, org, uuids):
+        return self.NO_CHANGES
+
     def pull_fields(self, org):
         return self.NO_CHANGES
 
@@ -262,7 +278,7 @@ class NoopBackend(BaseBackend):  # pragma: no cover
     ):
         return self.NO_CHANGES + (None,)
 
-    def fetch_contact_messages(self, org, contact, created_after, created_before):
+    def fetch_contact_messages(self, org, contact, created_after, created_before, newer_than_id=None, limit=None):
         return []
 
     def fetch_flows(self, org):
@@ -1,13 +1,21 @@
-from typing import Tuple
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 
 from dash.utils import chunks, is_dict_equal
-from dash.utils.sync import BaseSyncer, SyncOutcome, sync_local_to_changes, sync_local_to_set
+from dash.utils.sync import BaseSyncer, SyncOutcome, sync_local_to_set
+from temba_client.exceptions import TembaRateExceededError
 
+from django.db import connection
 from django.utils.timezone import now
 
 from casepro.contacts.models import Contact, Field, Group
-from casepro.msgs.models import Label, Message, Outgoing
+from casepro.msgs.models import Label, Labelling, Message, Outgoing
 from casepro.orgs_ext.models import Flow
+from casepro.statistics.models import DailyCount, datetime_to_date
 from casepro.utils.email import send_raw_email
 
 from . import BaseBackend
@@ -18,6 +26,12 @@ SYSTEM_LABEL_FLAGGED = "Flagged"
 # maximum number of days old a message can be for it to be handled
 MAXIMUM_HANDLE_MESSAGE_AGE = 30
 
+# returned in place of an object which couldn't be fetched because we exceeded the API rate limit
+RATE_EXCEEDED = object()
+
+# returned in place of an object which has been deleted in RapidPro
+DELETED = object()
+
 
 def remote_message_is_flagged(msg):
     return SYSTEM_LABEL_FLAGGED in [l.name for l in msg.labels]
@@ -27,6 +41,118 @@ def remote_message_is_archived(msg):
     return msg.visibility == "archived"
 
 
+def sync_local_to_changes_in_batches(
+    org, syncer, fetches, deleted_fetches=(), progress_callback=None, time_limit: int = None
+) -> Tuple[dict, Optional[str]]:
+    """
+    Like dash's sync_local_to_changes, but syncs each fetch of changed remote objects as a single batch using the
+    syncer's sync_batch method, rather than one object at a time. Deleted remote objects are released one at a time as
+    they are rare.
+
+    :return: tuple of a dict of counts of created, updated, deleted, ignored local instances and a possible cursor if
+             fetching didn't complete
+    """
+    num_synced = 0
+    outcome_counts = {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
+    resume_cursor = None
+
+    start = time.time()
+
+    for fetch in fetches:
+        for outcome, count in syncer.sync_batch(org, fetch).items():
+            outcome_counts[outcome] += count
+
+        num_synced += len(fetch)
+        if progress_callback:
+            progress_callback(num_synced)
+
+        if time_limit and time.time() - start > time_limit:
+            resume_cursor = fetches.get_cursor()
+            break
+
+    # any item that has been deleted remotely should also be released locally
+    for deleted_fetch in deleted_fetches:
+        for deleted_remote in deleted_fetch:
+            identity = syncer.identify_remote(deleted_remote)
+            with syncer.lock(org, identity):
+                existing = syncer.fetch_local(org, identity)
+                if existing:
+                    syncer.delete_local(existing)
+                    outcome_counts[SyncOutcome.deleted] += 1
+
+        num_synced += len(deleted_fetch)
+        if progress_callback:
+            progress_callback(num_synced)
+
+    return outcome_counts, resume_cursor
+
+
+class PrefetchingFetches:
+    """
+    Wraps an iterator of fetches from the API (e.g. from iterfetches) so that the following fetches are requested in a
+    background thread while the current one is synced locally. The cursor is that of the last fetch returned rather
+    than the last fetch requested, so that resuming doesn't skip fetches which were prefetched but never synced.
+    Should be used as a context manager so that the background thread is stopped if syncing finishes early.
+    """
+
+    END = object()
+
+    def __init__(self, fetches, size: int = 1):
+        self.fetches = fetches
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.cursor = None
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if item is self.END:
+            raise StopIteration()
+
+        fetch, cursor, error = item
+        if error:
+            raise error
+
+        self.cursor = cursor
+        return fetch
+
+    def get_cursor(self):
+        return self.cursor
+
+    def _produce(self):
+        try:
+            for fetch in self.fetches:
+                if not self._put((fetch, self.fetches.get_cursor(), None)):
+                    return
+        except Exception as e:
+            self._put((None, None, e))
+            return
+
+        self._put(self.END)
+
+    def _put(self, item) -> bool:
+        """
+        Puts an item on the queue, waiting for space unless we're stopped. Returns whether the item was put.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
 class ContactSyncer(BaseSyncer):
     """
     Syncer for contacts
@@ -35,6 +161,10 @@ class ContactSyncer(BaseSyncer):
     model = Contact
     prefetch_related = ("groups",)
 
+    def __init__(self, backend=None):
+        super().__init__(backend)
+        self.org_groups_by_uuid = None  # loaded when first needed and reused for the rest of the sync
+
     def local_kwargs(self, org, remote):
         # groups and fields are updated via a post save signal handler
         groups = [(g.uuid, g.name) for g in remote.groups]
@@ -72,6 +202,110 @@ class ContactSyncer(BaseSyncer):
     def delete_local(self, local):
         local.release()
 
+    def sync_batch(self, org, remotes):
+        """
+        Syncs a fetch of remote contacts with the same outcomes as syncing each one individually, but upserting the
+        contacts in bulk and applying their group changes as bulk inserts and deletes on the membership table
+
+        :return: dict of counts of each outcome
+        """
+        remotes = list({r.uuid: r for r in remotes}.values())  # only the latest version of each contact
+        outcomes = defaultdict(int)
+
+        existing = self.fetch_all(org).filter(uuid__in=[r.uuid for r in remotes])
+        existing = existing.select_related(*self.select_related).prefetch_related(*self.prefetch_related)
+        existing_by_uuid = {c.uuid: c for c in existing}
+
+        upserts = []  # tuples of kwargs and existing contact (if any)
+
+        for remote in remotes:
+            local = existing_by_uuid.get(remote.uuid)
+            kwargs = self.local_kwargs(org, remote)
+
+            if local:
+                if self.update_required(local, remote, kwargs) or not local.is_active:
+                    upserts.append((kwargs, local))
+                    outcomes[SyncOutcome.updated] += 1
+                else:
+                    outcomes[SyncOutcome.ignored] += 1
+            else:
+                upserts.append((kwargs, None))
+                outcomes[SyncOutcome.created] += 1
+
+        if upserts:
+            self._upsert_contacts(org, upserts)
+
+        return outcomes
+
+    def _upsert_contacts(self, org, upserts):
+        contacts = []
+        for kwargs, _ in upserts:
+            kwargs = kwargs.copy()
+            kwargs.pop(Contact.SAVE_GROUPS_ATTR)
+            contacts.append(Contact(is_active=True, **kwargs))
+
+        Contact.objects.bulk_create(
+            contacts,
+            update_conflicts=True,
+            unique_fields=("uuid",),
+            update_fields=("name", "language", "urns", "is_blocked", "is_stopped", "is_stub", "fields", "is_active"),
+        )
+
+        # upserts don't return ids, so look them up for the new contacts
+        ids_by_uuid = {local.uuid: local.pk for _, local in upserts if local}
+        new_uuids = [c.uuid for c in contacts if c.uuid not in ids_by_uuid]
+        if new_uuids:
+            ids_by_uuid.update(Contact.objects.filter(uuid__in=new_uuids).values_list("uuid", "id"))
+
+        for contact in contacts:
+            contact.pk = ids_by_uuid[contact.uuid]
+
+        self._update_groups(org, upserts, contacts)
+
+    def _get_org_groups(self, org):
+        if self.org_groups_by_uuid is None:
+            self.org_groups_by_uuid = {g.uuid: g for g in org.groups.all()}
+        return self.org_groups_by_uuid
+
+    def _update_groups(self, org, upserts, contacts):
+        """
+        Applies the group changes of upserted contacts as a single insert and a single delete of memberships
+        """
+        to_add = []  # tuples of contact id and group id
+        to_remove = []
+
+        for (kwargs, local), contact in zip(upserts, contacts):
+            new_groups_by_uuid = {g[0]: g[1] for g in kwargs[Contact.SAVE_GROUPS_ATTR]}
+            cur_groups_by_uuid = {g.uuid: g for g in local.groups.all()} if local else {}
+
+            for group in cur_groups_by_uuid.values():
+                if group.uuid not in new_groups_by_uuid:
+                    to_remove.append((contact.pk, group.pk))
+
+            for uuid in new_groups_by_uuid.keys() - cur_groups_by_uuid.keys():
+                org_groups_by_uuid = self._get_org_groups(org)
+                group = org_groups_by_uuid.get(uuid)
+                if not group:
+                    # create stub
+                    group = org.groups.create(uuid=uuid, name=new_groups_by_uuid[uuid], is_active=False)
+                    org_groups_by_uuid[uuid] = group
+
+                to_add.append((contact.pk, group.pk))
+
+        if to_remove:
+            contact_ids, group_ids = zip(*to_remove)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {Contact.groups.through._meta.db_table} WHERE ("contact_id", "group_id") IN '
+                    f"(SELECT UNNEST(%s::int[]), UNNEST(%s::int[]))",
+                    [list(contact_ids), list(group_ids)],
+                )
+
+        if to_add:
+            Contact.groups.through.objects.bulk_create(
+                [Contact.groups.through(contact_id=c, group_id=g) for c, g in to_add], ignore_conflicts=True
+            )
+
 
 class FieldSyncer(BaseSyncer):
     """
@@ -199,6 +433,144 @@ class MessageSyncer(BaseSyncer):
     def delete_local(self, local):
         local.release()
 
+    def sync_batch(self, org, remotes):
+        """
+        Syncs a fetch of remote messages with the same outcomes as syncing each one individually, but using a fixed
+        number of queries for the contacts and messages. Messages are upserted in bulk so the message save signals
+        don't fire, and the contact, label and count updates they would make are made here for the whole batch.
+
+        :return: dict of counts of each outcome
+        """
+        remotes = list({r.id: r for r in remotes}.values())  # only the latest version of each message
+        outcomes = defaultdict(int)
+
+        existing = self.fetch_all(org).filter(backend_id__in=[r.id for r in remotes])
+        existing = existing.select_related(*self.select_related).prefetch_related(*self.prefetch_related)
+        existing_by_id = {m.backend_id: m for m in existing}
+
+        upserts = []  # tuples of remote, kwargs and existing message (if any)
+        releases = []
+
+        for remote in remotes:
+            local = existing_by_id.get(remote.id)
+            kwargs = self.local_kwargs(org, remote)
+
+            if local:
+                local.org = org
+                if kwargs:
+                    if self.update_required(local, remote, kwargs) or not local.is_active:
+                        upserts.append((remote, kwargs, local))
+                        outcomes[SyncOutcome.updated] += 1
+                        continue
+                elif local.is_active:
+                    releases.append(local)
+                    outcomes[SyncOutcome.deleted] += 1
+                    continue
+            elif kwargs:
+                upserts.append((remote, kwargs, None))
+                outcomes[SyncOutcome.created] += 1
+                continue
+
+            outcomes[SyncOutcome.ignored] += 1
+
+        if releases:
+            Labelling.objects.filter(message__in=releases).delete()
+            Message.objects.filter(pk__in=[m.pk for m in releases]).update(is_active=False, modified_on=now())
+
+        if upserts:
+            self._upsert_messages(org, upserts)
+
+        return outcomes
+
+    def _upsert_messages(self, org, upserts):
+        contacts_by_uuid = Contact.get_or_create_many(
+            org,
+            {kwargs[Message.SAVE_CONTACT_ATTR][0]: kwargs[Message.SAVE_CONTACT_ATTR][1] for _, kwargs, _ in upserts},
+        )
+
+        # messages which are to be marked as handled are upserted separately so that other messages aren't unhandled
+        messages = []
+        upsert_fields = ("contact", "type", "text", "is_flagged", "is_archived", "created_on", "is_active")
+        by_update_fields = defaultdict(list)
+
+        for remote, kwargs, local in upserts:
+            kwargs = kwargs.copy()
+            contact_uuid, _ = kwargs.pop(Message.SAVE_CONTACT_ATTR)
+            kwargs.pop(Message.SAVE_LABELS_ATTR)
+
+            message = Message(contact=contacts_by_uuid[contact_uuid], is_active=True, **kwargs)
+            messages.append(message)
+
+            update_fields = upsert_fields + (("is_handled",) if "is_handled" in kwargs else ())
+            by_update_fields[update_fields].append(message)
+
+        for update_fields, batch in by_update_fields.items():
+            Message.objects.bulk_create(
+                batch, update_conflicts=True, unique_fields=("backend_id",), update_fields=update_fields
+            )
+
+        # upserts don't return ids, so look them up for the new messages
+        ids_by_backend_id = {local.backend_id: local.pk for _, _, local in upserts if local}
+        new_backend_ids = [m.backend_id for m in messages if m.backend_id not in ids_by_backend_id]
+        if new_backend_ids:
+            ids_by_backend_id.update(
+                Message.objects.filter(backend_id__in=new_backend_ids).values_list("backend_id", "id")
+            )
+
+        for message in messages:
+            message.pk = ids_by_backend_id[message.backend_id]
+
+        self._update_labels(org, upserts, messages)
+
+        # record the new messages in the daily counts of incoming messages
+        new_counts = defaultdict(int)
+        for (_, _, local), message in zip(upserts, messages):
+            if not local:
+                new_counts[(datetime_to_date(message.created_on, org), (org,))] += 1
+
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, new_counts)
+
+    def _update_labels(self, org, upserts, messages):
+        """
+        Applies the label changes of upserted messages in bulk, grouping messages by the labels to add or remove
+        """
+        org_labels_by_uuid = {l.uuid: l for l in org.labels.all()}
+        org_unsynced_names = {l.name for l in org_labels_by_uuid.values() if not l.is_synced}
+
+        add_by_labels = defaultdict(list)
+        remove_by_labels = defaultdict(list)
+
+        for (_, kwargs, local), message in zip(upserts, messages):
+            new_labels_by_uuid = {l[0]: l[1] for l in kwargs[Message.SAVE_LABELS_ATTR]}
+            cur_labels_by_uuid = {l.uuid: l for l in local.labels.all() if l.uuid} if local else {}
+
+            # remove labels not in the new set, except un-synced local labels
+            remove_from = [l for l in cur_labels_by_uuid.values() if l.uuid not in new_labels_by_uuid and l.is_synced]
+
+            add_to = []
+            for uuid, name in new_labels_by_uuid.items():
+                if uuid in cur_labels_by_uuid:
+                    continue
+
+                label = org_labels_by_uuid.get(uuid)
+                if not label and name not in org_unsynced_names:
+                    # create stub
+                    label = org.labels.create(uuid=uuid, name=name, is_active=False)
+                    org_labels_by_uuid[uuid] = label
+
+                if label and label.is_synced:
+                    add_to.append(label)
+
+            if remove_from:
+                remove_by_labels[frozenset(remove_from)].append(message)
+            if add_to:
+                add_by_labels[frozenset(add_to)].append(message)
+
+        for labels, label_messages in remove_by_labels.items():
+            Message.unlabel_messages(org, label_messages, labels)
+        for labels, label_messages in add_by_labels.items():
+            Message.label_messages(org, label_messages, labels)
+
 
 class RapidProBackend(BaseBackend):
     """
@@ -210,6 +582,10 @@ class RapidProBackend(BaseBackend):
 
     FETCH_TIME_LIMIT = 30 * 60  # 30 minutes
 
+    PREFETCH_SIZE = 1  # number of fetches to request ahead of the one being synced
+
+    FETCH_WORKERS = 4  # number of concurrent requests when fetching objects one at a time
+
     @staticmethod
     def _get_client(org):
         return org.get_temba_client(api_version=2)
@@ -229,17 +605,54 @@ class RapidProBackend(BaseBackend):
         deleted_query = client.get_contacts(deleted=True, after=modified_after, before=modified_before)
         deleted_fetches = deleted_query.iterfetches(retry_on_rate_exceed=True)
 
-        counts, resume_cursor = sync_local_to_changes(
-            org,
-            ContactSyncer(backend=self.backend),
-            fetches,
-            deleted_fetches,
-            progress_callback,
-            time_limit=self.FETCH_TIME_LIMIT,
-        )
+        with PrefetchingFetches(fetches, self.PREFETCH_SIZE) as fetches:
+            counts, resume_cursor = sync_local_to_changes_in_batches(
+                org,
+                ContactSyncer(backend=self.backend),
+                fetches,
+                deleted_fetches,
+                progress_callback,
+                time_limit=self.FETCH_TIME_LIMIT,
+            )
 
         return self._counts(counts) + (resume_cursor,)
 
+    def pull_contacts_by_uuid(self, org, uuids):
+        client = self._get_client(org)
+        syncer = ContactSyncer(backend=self.backend)
+        counts = {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
+
+        def fetch(uuid):
+            try:
+                remote = client.get_contacts(uuid=uuid).first(retry_on_rate_exceed=False)
+                if not remote and client.get_contacts(uuid=uuid, deleted=True).first(retry_on_rate_exceed=False):
+                    return DELETED
+                return remote
+            except TembaRateExceededError:
+                return RATE_EXCEEDED
+
+        # the API only filters contacts by a single UUID so each batch is fetched by concurrent requests. We don't wait
+        # out rate limits as that would stall the caller, so if we hit one we stop and leave the rest for the next call.
+        with ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+            for batch in chunks(uuids, self.BATCH_SIZE):
+                results = dict(zip(batch, executor.map(fetch, batch)))
+                remotes = [r for r in results.values() if r and r is not RATE_EXCEEDED and r is not DELETED]
+
+                for outcome, count in syncer.sync_batch(org, remotes).items():
+                    counts[outcome] += count
+
+                # stubs which RapidPro confirms were deleted are released, but any which it can't find at all are left
+                # for pull_contacts as releasing a contact also hides its unhandled messages
+                deleted = [uuid for uuid, r in results.items() if r is DELETED]
+                for contact in Contact.objects.filter(org=org, uuid__in=deleted, is_stub=True, is_active=True):
+                    contact.release()
+                    counts[SyncOutcome.deleted] += 1
+
+                if any(r is RATE_EXCEEDED for r in results.values()):
+                    break
+
+        return self._counts(counts)
+
     def pull_fields(self, org):
         client = self._get_client(org)
         incoming_objects = client.get_fields().all(retry_on_rate_exceed=True)
@@ -267,14 +680,14 @@ class RapidProBackend(BaseBackend):
         query = client.get_messages(folder="incoming", after=modified_after, before=modified_before)
         fetches = query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor)
 
-        counts, resume_cursor = sync_local_to_changes(
-            org,
-            MessageSyncer(backend=self.backend, as_handled=as_handled),
-            fetches,
-            [],
-            progress_callback,
-            time_limit=self.FETCH_TIME_LIMIT,
-        )
+        with PrefetchingFetches(fetches, self.PREFETCH_SIZE) as fetches:
+            counts, resume_cursor = sync_local_to_changes_in_batches(
+                org,
+                MessageSyncer(backend=self.backend, as_handled=as_handled),
+                fetches,
+                progress_callback=progress_callback,
+                time_limit=self.FETCH_TIME_LIMIT,
+            )
 
         return self._counts(counts) + (resume_cursor,)
 
@@ -385,13 +798,13 @@ class RapidProBackend(BaseBackend):
         for batch in chunks(messages, self.BATCH_SIZE):
             client.bulk_unlabel_messages(messages=[m.backend_id for m in batch], label_name=SYSTEM_LABEL_FLAGGED)
 
-    def fetch_contact_messages(self, org, contact, created_after, created_before):
+    def fetch_contact_messages(self, org, contact, created_after, created_before, newer_than_id=None, limit=None):
         """
         Used to grab messages sent to the contact from RapidPro that we won't have in CasePro
         """
         # fetch remote messages for contact
         client = self._get_client(org)
-        remote_messages = client.get_messages(contact=contact.uuid, after=created_after, before=created_before).all()
+        query = client.get_messages(contact=contact.uuid, after=created_after, before=created_before)
 
         def remote_as_outgoing(msg):
             return Outgoing(
@@ -402,7 +815,20 @@ class RapidProBackend(BaseBackend):
                 created_on=msg.created_on,
             )
 
-        return [remote_as_outgoing(m) for m in remote_messages if m.direction == "out"]
+        # messages are returned newest first, so we can stop at the first page which reaches messages we already have
+        # or once we have enough
+        messages = []
+        for fetch in query.iterfetches(retry_on_rate_exceed=True):
+            for msg in fetch:
+                if msg.direction == "out" and (newer_than_id is None or msg.id > newer_than_id):
+                    messages.append(remote_as_outgoing(msg))
+
+            if newer_than_id is not None and any(msg.id <= newer_than_id for msg in fetch):
+                break
+            if limit and len(messages) >= limit:
+                break
+
+        return messages
 
     def fetch_flows(self, org):
         """
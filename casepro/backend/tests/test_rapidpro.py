@@ -1,3 +1,4 @@
+import threading
 import time
 from datetime import datetime, timedelta
 from unittest import skip
@@ -5,6 +6,8 @@ from unittest.mock import call, patch
 
 from dash.orgs.models import Org
 from dash.test import MockClientQuery
+from dash.utils.sync import SyncOutcome, sync_local_to_changes
+from temba_client.exceptions import TembaRateExceededError
 from temba_client.v2.types import (
     Broadcast as TembaBroadcast,
     Contact as TembaContact,
@@ -22,9 +25,16 @@ from django.utils.timezone import now
 from casepro.contacts.models import Contact, Field, Group
 from casepro.msgs.models import Label, Message, Outgoing
 from casepro.orgs_ext.models import Flow
+from casepro.statistics.models import DailyCount
 from casepro.test import BaseCasesTest
 
-from ..rapidpro import ContactSyncer, MessageSyncer, RapidProBackend
+from ..rapidpro import (
+    ContactSyncer,
+    MessageSyncer,
+    PrefetchingFetches,
+    RapidProBackend,
+    sync_local_to_changes_in_batches,
+)
 
 
 class ContactSyncerTest(BaseCasesTest):
@@ -201,6 +211,69 @@ class ContactSyncerTest(BaseCasesTest):
             )
         )
 
+    def test_sync_batch(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", [self.males, self.reporters], fields={"age": "34"})
+        bob = self.create_contact(self.unicef, "C-002", "Bob", [self.females])
+        cat = self.create_contact(self.unicef, "C-003", "Cat", [self.males])
+
+        def remote(uuid, name, groups=(), fields=None, status="active"):
+            return TembaContact.create(
+                uuid=uuid,
+                name=name,
+                language="eng",
+                urns=[],
+                groups=[ObjectRef.create(uuid=g[0], name=g[1]) for g in groups],
+                fields=fields or {},
+                status=status,
+            )
+
+        with self.assertNumQueries(8):
+            outcomes = self.syncer.sync_batch(
+                self.unicef,
+                [
+                    # groups changed to include a group we don't have yet
+                    remote("C-001", "Ann", [("G-002", "Females"), ("G-009", "Volunteers")], {"age": "35"}),
+                    remote("C-002", "Bob", [("G-002", "Females")]),  # unchanged
+                    remote("C-004", "Dan", [("G-001", "Males")]),  # first version of new contact
+                    remote("C-004", "Dan", [("G-003", "Reporters")], status="blocked"),  # latest version
+                ],
+            )
+
+        self.assertEqual(outcomes, {SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.ignored: 1})
+
+        volunteers = Group.objects.get(org=self.unicef, uuid="G-009", name="Volunteers", is_active=False)
+
+        ann.refresh_from_db()
+        self.assertEqual(set(ann.groups.all()), {self.females, volunteers})
+        self.assertEqual(ann.get_fields(), {"age": "35"})
+
+        # other contacts' memberships of the groups Ann left and joined are untouched
+        self.assertEqual(set(bob.groups.all()), {self.females})
+        self.assertEqual(set(cat.groups.all()), {self.males})
+
+        dan = Contact.objects.get(uuid="C-004")
+        self.assertEqual(dan.name, "Dan")
+        self.assertTrue(dan.is_blocked)
+        self.assertFalse(dan.is_stub)
+        self.assertEqual(set(dan.groups.all()), {self.reporters})
+
+        # stub and inactive contacts are updated
+        eve = self.create_contact(self.unicef, "C-005", "Eve", is_stub=True)
+        Contact.objects.filter(pk=bob.pk).update(is_active=False)
+
+        outcomes = self.syncer.sync_batch(
+            self.unicef, [remote("C-002", "Bob", [("G-002", "Females")]), remote("C-005", "Eve", [("G-009", "Vols")])]
+        )
+
+        self.assertEqual(outcomes, {SyncOutcome.updated: 2})
+
+        bob.refresh_from_db()
+        self.assertTrue(bob.is_active)
+
+        eve.refresh_from_db()
+        self.assertFalse(eve.is_stub)
+        self.assertEqual(set(eve.groups.all()), {volunteers})  # org groups are only loaded once per syncer
+
 
 class MessageSyncerTest(BaseCasesTest):
     def setUp(self):
@@ -362,6 +435,185 @@ class MessageSyncerTest(BaseCasesTest):
         self.assertEqual(local.is_active, False)
         self.assertEqual(set(local.labels.all()), set())
 
+    def test_sync_batch(self):
+        d1 = now() - timedelta(hours=1)
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hello", [self.pregnancy], created_on=d1)
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Bye", created_on=d1)
+        msg3 = self.create_message(self.unicef, 103, self.ann, "Spam", [self.aids], created_on=d1)
+
+        def remote(id, contact, text, visibility="visible", labels=()):
+            return TembaMessage.create(
+                id=id,
+                contact=contact,
+                type="text",
+                text=text,
+                visibility=visibility,
+                labels=[ObjectRef.create(uuid=l.uuid, name=l.name) for l in labels],
+                flow=None,
+                created_on=d1,
+            )
+
+        ann = ObjectRef.create(uuid="C-001", name="Ann")
+        zed = ObjectRef.create(uuid="C-009", name="Zed")
+        incoming_before = DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total()
+
+        outcomes = self.syncer.sync_batch(
+            self.unicef,
+            [
+                remote(101, ann, "Hello", visibility="archived", labels=[self.aids]),  # archived and relabelled
+                remote(102, ann, "Bye"),  # unchanged
+                remote(103, ann, "Spam", visibility="deleted"),  # deleted
+                remote(104, zed, "Hi", labels=[self.pregnancy]),  # first version of new message
+                remote(104, zed, "Hi", labels=[self.aids]),  # latest version of new message
+            ],
+        )
+
+        self.assertEqual(
+            outcomes,
+            {SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1},
+        )
+
+        msg1.refresh_from_db()
+        self.assertTrue(msg1.is_archived)
+        self.assertEqual(set(msg1.labels.all()), {self.aids})
+
+        msg2.refresh_from_db()
+        self.assertFalse(msg2.is_archived)
+
+        msg3.refresh_from_db()
+        self.assertFalse(msg3.is_active)
+        self.assertEqual(set(msg3.labels.all()), set())
+
+        msg4 = Message.objects.get(backend_id=104)
+        self.assertEqual(msg4.text, "Hi")
+        self.assertFalse(msg4.is_handled)
+        self.assertEqual(set(msg4.labels.all()), {self.aids})
+        self.assertEqual(msg4.contact.uuid, "C-009")
+        self.assertEqual(msg4.contact.name, "Zed")
+        self.assertTrue(msg4.contact.is_stub)
+
+        # only the new message is counted as incoming
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), incoming_before + 1)
+
+        # syncing the same messages again changes nothing
+        outcomes = self.syncer.sync_batch(
+            self.unicef,
+            [
+                remote(101, ann, "Hello", visibility="archived", labels=[self.aids]),
+                remote(103, ann, "Spam", visibility="deleted"),
+                remote(104, zed, "Hi", labels=[self.aids]),
+            ],
+        )
+
+        self.assertEqual(
+            outcomes, {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 3}
+        )
+
+        # messages can be synced as handled
+        syncer = MessageSyncer(backend=self.unicef.backends.get(), as_handled=True)
+        syncer.sync_batch(self.unicef, [remote(105, ann, "Handled")])
+
+        self.assertTrue(Message.objects.get(backend_id=105).is_handled)
+        self.assertFalse(Message.objects.get(backend_id=104).is_handled)
+
+
+class FakeFetches:
+    """
+    Fake of the cursor iterator returned by the temba client's iterfetches which takes time to make each request
+    """
+
+    def __init__(self, num_fetches, request_time, fail_on=None):
+        self.num_fetches = num_fetches
+        self.request_time = request_time
+        self.fail_on = fail_on
+        self.num_requested = 0
+        self.requested = [threading.Event() for f in range(num_fetches + 1)]  # set as each fetch is requested
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_requested == self.num_fetches:
+            raise StopIteration()
+        if self.num_requested == self.fail_on:
+            raise ValueError("API error")
+
+        time.sleep(self.request_time)
+        self.num_requested += 1
+        self.requested[self.num_requested].set()
+        return ["item-%d" % self.num_requested]
+
+    def get_cursor(self):
+        return "cursor-%d" % self.num_requested if self.num_requested < self.num_fetches else None
+
+
+class PrefetchingFetchesTest(BaseCasesTest):
+    def test_overlap(self):
+        remote = FakeFetches(5, request_time=0)
+        synced = []
+
+        with PrefetchingFetches(remote) as fetches:
+            for fetch in fetches:
+                fetch_num = len(synced) + 1
+
+                # the next fetch is requested while we're still syncing this one, which would never happen without
+                # prefetching, so this would time out
+                if fetch_num < 5:
+                    self.assertTrue(remote.requested[fetch_num + 1].wait(timeout=5))
+
+                synced.extend(fetch)
+
+        self.assertEqual(synced, ["item-1", "item-2", "item-3", "item-4", "item-5"])
+
+    def test_cursor(self):
+        remote = FakeFetches(5, request_time=0)
+
+        with PrefetchingFetches(remote, size=2) as fetches:
+            self.assertEqual(next(fetches), ["item-1"])
+
+            time.sleep(0.1)
+
+            # later fetches have been requested but the cursor is still where we'd resume after the synced fetch
+            self.assertEqual(remote.num_requested, 4)
+            self.assertEqual(fetches.get_cursor(), "cursor-1")
+
+            self.assertEqual(next(fetches), ["item-2"])
+            self.assertEqual(fetches.get_cursor(), "cursor-2")
+
+        # exiting stops the background thread even though it's waiting to queue another fetch
+        fetches.thread.join(timeout=1)
+        self.assertFalse(fetches.thread.is_alive())
+
+        with PrefetchingFetches(FakeFetches(2, request_time=0)) as fetches:
+            self.assertEqual(list(fetches), [["item-1"], ["item-2"]])
+            self.assertIsNone(fetches.get_cursor())
+
+    def test_error(self):
+        with PrefetchingFetches(FakeFetches(5, request_time=0, fail_on=2)) as fetches:
+            self.assertEqual(next(fetches), ["item-1"])
+            self.assertEqual(next(fetches), ["item-2"])
+
+            with self.assertRaises(ValueError):
+                next(fetches)
+
+    @patch("dash.orgs.models.TembaClient.get_messages")
+    def test_time_limit(self, mock_get_messages):
+        fetches = FakeFetches(5, request_time=0)
+        mock_get_messages.return_value.iterfetches.return_value = fetches
+
+        def sync_batch(org, fetch):
+            time.sleep(0.1)
+            return {}
+
+        with patch.object(MessageSyncer, "sync_batch", side_effect=sync_batch):
+            with patch.object(RapidProBackend, "FETCH_TIME_LIMIT", 0.05):
+                backend = RapidProBackend(backend=self.unicef.backends.get())
+                result = backend.pull_messages(self.unicef, None, None)
+
+        # resuming starts after the synced fetch even though the next one has been prefetched
+        self.assertEqual(fetches.num_requested, 3)
+        self.assertEqual(result, (0, 0, 0, 0, "cursor-1"))
+
 
 class RapidProBackendTest(BaseCasesTest):
     def setUp(self):
@@ -423,7 +675,7 @@ class RapidProBackendTest(BaseCasesTest):
             ),
         ]
 
-        with self.assertNumQueries(14):
+        with self.assertNumQueries(12):
             num_created, num_updated, num_deleted, num_ignored, _ = self.backend.pull_contacts(self.unicef, None, None)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (3, 0, 0, 0))
@@ -504,9 +756,96 @@ class RapidProBackendTest(BaseCasesTest):
         with self.assertNumQueries(4):
             self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (0, 1, 0, 0, None))
 
+        bob.refresh_from_db()
+        self.assertEqual(bob.urns, ["twitter:bobflow22"])
+        self.assertEqual(set(bob.groups.all()), {spammers})
+
         self.assertEqual(set(Contact.objects.filter(is_active=True)), {bob, ann})
         self.assertEqual(set(Contact.objects.filter(is_active=False)), {jim})
 
+    @patch("dash.orgs.models.TembaClient.get_contacts")
+    def test_pull_contacts_by_uuid(self, mock_get_contacts):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", is_stub=True)
+        bob = self.create_contact(self.unicef, "C-002", "Bob", is_stub=True)
+        cat = self.create_contact(self.unicef, "C-003", "Cat", is_stub=True)
+        cat_msg = self.create_message(self.unicef, 101, cat, "Hello")
+
+        remotes = {
+            "C-001": TembaContact.create(
+                uuid="C-001",
+                name="Ann McPoll",
+                language="eng",
+                urns=["tel:+250783835664"],
+                groups=[ObjectRef.create(uuid="G-001", name="Males")],
+                fields={"age": "35"},
+                status="active",
+            ),
+            "C-002": None,  # deleted in RapidPro
+            "C-003": None,  # not found in RapidPro at all
+        }
+        deleted_remotes = {
+            "C-002": TembaContact.create(uuid="C-002", name=None, language=None, urns=[], groups=[], fields={})
+        }
+
+        def get_contacts(uuid, deleted=False):
+            remote = deleted_remotes.get(uuid) if deleted else remotes[uuid]
+            return MockClientQuery([remote] if remote else [])
+
+        mock_get_contacts.side_effect = get_contacts
+
+        self.assertEqual(self.backend.pull_contacts_by_uuid(self.unicef, ["C-001", "C-002", "C-003"]), (0, 1, 1, 0))
+
+        mock_get_contacts.assert_has_calls(
+            [
+                call(uuid="C-001"),
+                call(uuid="C-002"),
+                call(uuid="C-002", deleted=True),
+                call(uuid="C-003"),
+                call(uuid="C-003", deleted=True),
+            ],
+            any_order=True,
+        )
+
+        ann.refresh_from_db()
+        self.assertFalse(ann.is_stub)
+        self.assertEqual(ann.name, "Ann McPoll")
+        self.assertEqual(set(ann.groups.all()), {self.males})
+
+        # stubs which RapidPro confirms were deleted are released
+        bob.refresh_from_db()
+        self.assertTrue(bob.is_stub)
+        self.assertFalse(bob.is_active)
+
+        # but stubs which it can't find are left for the next contact pull, along with their unhandled messages
+        cat.refresh_from_db()
+        cat_msg.refresh_from_db()
+        self.assertTrue(cat.is_stub)
+        self.assertTrue(cat.is_active)
+        self.assertFalse(cat_msg.is_handled)
+        self.assertTrue(cat_msg.is_active)
+
+        # if we hit the rate limit, we stop without waiting and leave the remaining stubs for the next pull
+        dan = self.create_contact(self.unicef, "C-004", "Dan", is_stub=True)
+        eve = self.create_contact(self.unicef, "C-005", "Eve", is_stub=True)
+        self.backend.BATCH_SIZE = 1
+
+        def get_contacts(uuid, deleted=False):
+            if uuid == "C-004":
+                raise TembaRateExceededError(retry_after=60)
+            return MockClientQuery([TembaContact.create(uuid=uuid)] if deleted else [])
+
+        mock_get_contacts.reset_mock()
+        mock_get_contacts.side_effect = get_contacts
+
+        self.assertEqual(self.backend.pull_contacts_by_uuid(self.unicef, ["C-004", "C-005"]), (0, 0, 0, 0))
+
+        mock_get_contacts.assert_called_once_with(uuid="C-004")
+
+        dan.refresh_from_db()
+        eve.refresh_from_db()
+        self.assertTrue(dan.is_active)
+        self.assertTrue(eve.is_active)
+
     @patch("dash.orgs.models.TembaClient.get_fields")
     def test_pull_fields(self, mock_get_fields):
         # start with no fields
@@ -626,7 +965,7 @@ class RapidProBackendTest(BaseCasesTest):
             ]
         )
 
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(8):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_labels(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (1, 1, 1, 0))
@@ -1059,6 +1398,39 @@ class RapidProBackendTest(BaseCasesTest):
         self.assertEqual(messages[0].text, "Welcome")
         self.assertEqual(messages[0].created_on, d3)
 
+        def outgoing(msg_id):
+            return TembaMessage.create(
+                id=msg_id,
+                broadcast=None,
+                contact=ObjectRef.create(uuid="C-001", name="Ann"),
+                text="Msg %d" % msg_id,
+                type="text",
+                direction="out",
+                visibility="visible",
+                labels=[],
+                created_on=d2,
+            )
+
+        # can stop at the first page which reaches messages we've already fetched
+        mock_get_messages.reset_mock()
+        mock_get_messages.return_value = MockClientQuery(
+            [outgoing(106), outgoing(105)], [outgoing(104), outgoing(103)], [outgoing(102), outgoing(101)]
+        )
+
+        messages = self.backend.fetch_contact_messages(self.unicef, self.ann, d1, d3, newer_than_id=103)
+
+        self.assertEqual([m.backend_id for m in messages], [106, 105, 104])
+        mock_get_messages.assert_called_once_with(contact="C-001", after=d1, before=d3)
+
+        # or once we have enough of the newest messages
+        mock_get_messages.return_value = MockClientQuery(
+            [outgoing(106), outgoing(105)], [outgoing(104), outgoing(103)], [outgoing(102), outgoing(101)]
+        )
+
+        messages = self.backend.fetch_contact_messages(self.unicef, self.ann, d1, d3, limit=3)
+
+        self.assertEqual([m.backend_id for m in messages], [106, 105, 104, 103])
+
     @patch("dash.orgs.models.TembaClient.get_flows")
     def test_fetch_flows(self, mock_get_flows):
         mock_get_flows.return_value = MockClientQuery(
@@ -1221,3 +1593,53 @@ class PerfTest(BaseCasesTest):
         self.assertEqual((num_created, num_updated, num_deleted), (0, num_fetches * fetch_size, 0))
 
         print("Contact sync with 10 field value changes: %f secs" % (time.time() - start))
+
+    def test_message_sync(self):
+        fetch_size = 100
+        num_fetches = 5
+        labels = [self.aids, self.pregnancy]
+        syncer = MessageSyncer(backend=self.rapidpro_backend)
+
+        def create_fetches(first_id, visibility):
+            fetches = []
+            for b in range(0, num_fetches):
+                batch = []
+                for m in range(0, fetch_size):
+                    num = first_id + b * fetch_size + m
+                    label = labels[num % len(labels)]
+                    batch.append(
+                        TembaMessage.create(
+                            id=num,
+                            contact=ObjectRef.create(
+                                uuid="C0000000-0000-0000-0000-00000000%04d" % (num % 250), name="Ann"
+                            ),
+                            type="text",
+                            text="Message #%d" % num,
+                            visibility=visibility,
+                            labels=[ObjectRef.create(uuid=label.uuid, name=label.name)],
+                            flow=None,
+                            created_on=now(),
+                        )
+                    )
+                fetches.append(batch)
+            return fetches
+
+        def one_at_a_time(fetches):
+            return sync_local_to_changes(self.unicef, syncer, MockClientQuery(*fetches), [])[0]
+
+        def in_batches(fetches):
+            return sync_local_to_changes_in_batches(self.unicef, syncer, MockClientQuery(*fetches))[0]
+
+        # compare the current path and the batch path on different messages so that both create and then update
+        for sync, first_id in ((one_at_a_time, 10000), (in_batches, 20000)):
+            start = time.time()
+            counts = sync(create_fetches(first_id, "visible"))
+            self.assertEqual(counts[SyncOutcome.created], num_fetches * fetch_size)
+
+            print("New message sync %s: %f secs per fetch" % (sync.__name__, (time.time() - start) / num_fetches))
+
+            start = time.time()
+            counts = sync(create_fetches(first_id, "archived"))
+            self.assertEqual(counts[SyncOutcome.updated], num_fetches * fetch_size)
+
+            print("Message update sync %s: %f secs per fetch" % (sync.__name__, (time.time() - start) / num_fetches))
@@ -7,12 +7,14 @@ from dash.orgs.models import Org
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.management.base import BaseCommand
-from django.db import connection, reset_queries
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
 from django.http import HttpRequest
 from django.test.client import Client
 from django.urls import reverse
 
+from casepro.msgs.models import Message, MessageFolder, Outgoing, OutgoingFolder
+
 Problem = namedtuple("Problem", ["test", "org", "partner", "user", "time"])
 
 REQUEST_TIME_LIMITS = (0.5, 1)  # limit for warning, limit for problem
@@ -32,15 +34,28 @@ VIEW_TESTS = (
 )
 
 
+TEXT_SEARCHES = ("hello", "hiv", "pregnan")  # text searches to benchmark with and without the trigram indexes
+
+
 class Command(BaseCommand):
     help = "Checks performance of inbox view for all partners"
     verbose = False
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--text-search",
+            action="store_true",
+            help="Also compares message text searches using the trigram indexes to using sequential scans",
+        )
+
     def handle(self, *args, **options):
         self.verbose = options["verbosity"] >= 2
 
         colorama_init()
 
+        if options["text_search"]:
+            self.compare_text_searches()
+
         settings.COMPRESS_ENABLED = True
 
         problems = []
@@ -80,6 +95,51 @@ class Command(BaseCommand):
                 )
             )
 
+    def compare_text_searches(self):
+        self.stdout.write("Comparing text search performance (indexed vs sequential scan)...")
+
+        for org in Org.objects.filter(is_active=True).order_by("name"):
+            admin = org.administrators.first()
+            if not admin:
+                raise CommandError("Org '%s' has no administrator to search as" % org.name)
+
+            searches = (
+                (Message, {"folder": MessageFolder.inbox}),
+                (Message, {"folder": MessageFolder.archived}),
+                (Outgoing, {"folder": OutgoingFolder.sent}),
+            )
+
+            for model, search in searches:
+                for text in TEXT_SEARCHES:
+                    text_search = {**search, "text": text}
+                    indexed_time = self.time_text_search(org, admin, model, text_search, use_indexes=True)
+                    scan_time = self.time_text_search(org, admin, model, text_search, use_indexes=False)
+
+                    self.stdout.write(
+                        " > %s %s '%s' indexed=%s secs, scan=%s secs (org='%s')"
+                        % (
+                            model.__name__,
+                            search["folder"].name,
+                            text,
+                            colorcoded(indexed_time, DB_TIME_LIMITS),
+                            colorcoded(scan_time, DB_TIME_LIMITS),
+                            org.name,
+                        )
+                    )
+
+    def time_text_search(self, org, user, model, search, use_indexes):
+        """
+        Times fetching the first page of a text search, optionally stopping Postgres from using the trigram indexes
+        """
+        with transaction.atomic():
+            if not use_indexes:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_bitmapscan = off")
+
+            start_time = time.time()
+            list(model.search(org, user, search)[:50])
+            return time.time() - start_time
+
     def test_as_user(self, org, partner, user):
         problems = []
         for test in VIEW_TESTS:
@@ -0,0 +1,129 @@
+from django.db import migrations
+
+SQL = """
+----------------------------------------------------------------------
+-- Utility function to get the partners which can see a case, i.e. its assignee and partners with any of its labels
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_partner_ids(_case_id INT, _assignee_id INT, _exclude_label_id INT) RETURNS SETOF INT AS $$
+BEGIN
+  RETURN QUERY
+    SELECT _assignee_id
+    UNION
+    SELECT pl.partner_id FROM cases_case_labels cl
+    INNER JOIN msgs_label l ON l.id = cl.label_id AND l.is_active = TRUE
+    INNER JOIN cases_partner_labels pl ON pl.label_id = cl.label_id
+    WHERE cl.case_id = _case_id AND cl.label_id IS DISTINCT FROM _exclude_label_id;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Utility function to add or remove a case from the open/closed case counts of its org, labels and partners
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_record_case_counts(_case cases_case, _delta INT) RETURNS VOID AS $$
+DECLARE
+  _item_type CHAR(1) := CASE WHEN _case.closed_on IS NULL THEN 'O' ELSE 'X' END;
+BEGIN
+  INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+  SELECT _item_type, 'org:' || _case.org_id, _delta, FALSE
+  UNION ALL
+  SELECT _item_type, 'label:' || label_id, _delta, FALSE FROM cases_case_labels WHERE case_id = _case.id
+  UNION ALL
+  SELECT _item_type, 'partner:' || partner_id, _delta, FALSE
+  FROM cases_case_partner_ids(_case.id, _case.assignee_id, NULL) AS partner_id;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain open/closed case counts when cases are opened, closed, reopened or reassigned
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_on_change() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' AND (OLD.closed_on IS NULL) = (NEW.closed_on IS NULL) AND OLD.assignee_id = NEW.assignee_id THEN
+    RETURN NULL;
+  END IF;
+
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM cases_record_case_counts(OLD, -1);
+  END IF;
+
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM cases_record_case_counts(NEW, 1);
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain open/closed case counts when cases are labelled or unlabelled
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_labels_on_change() RETURNS TRIGGER AS $$
+DECLARE
+  _row cases_case_labels;
+  _case cases_case;
+  _delta INT;
+  _item_type CHAR(1);
+BEGIN
+  IF TG_OP = 'INSERT' THEN _row := NEW; _delta := 1; ELSE _row := OLD; _delta := -1; END IF;
+
+  SELECT * INTO _case FROM cases_case WHERE id = _row.case_id;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  _item_type := CASE WHEN _case.closed_on IS NULL THEN 'O' ELSE 'X' END;
+
+  INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+  VALUES(_item_type, 'label:' || _row.label_id, _delta, FALSE);
+
+  -- partners with access to this label gain or lose the case, unless they can see it anyway
+  INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+  SELECT _item_type, 'partner:' || pl.partner_id, _delta, FALSE FROM cases_partner_labels pl
+  INNER JOIN msgs_label l ON l.id = pl.label_id AND l.is_active = TRUE
+  WHERE pl.label_id = _row.label_id
+  AND pl.partner_id NOT IN (SELECT cases_case_partner_ids(_case.id, _case.assignee_id, _row.label_id));
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cases_case_on_change_trg
+   AFTER INSERT OR UPDATE OR DELETE ON cases_case
+   FOR EACH ROW EXECUTE PROCEDURE cases_case_on_change();
+
+CREATE TRIGGER cases_case_labels_on_change_trg
+   AFTER INSERT OR DELETE ON cases_case_labels
+   FOR EACH ROW EXECUTE PROCEDURE cases_case_labels_on_change();
+
+-- populate counts for existing cases
+INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+SELECT CASE WHEN c.closed_on IS NULL THEN 'O' ELSE 'X' END AS item_type, 'org:' || c.org_id AS scope, COUNT(*), TRUE
+FROM cases_case c GROUP BY item_type, scope
+UNION ALL
+SELECT CASE WHEN c.closed_on IS NULL THEN 'O' ELSE 'X' END AS item_type, 'label:' || cl.label_id AS scope, COUNT(*), TRUE
+FROM cases_case c INNER JOIN cases_case_labels cl ON cl.case_id = c.id GROUP BY item_type, scope
+UNION ALL
+SELECT CASE WHEN c.closed_on IS NULL THEN 'O' ELSE 'X' END AS item_type, 'partner:' || p.partner_id AS scope, COUNT(*), TRUE
+FROM cases_case c, LATERAL cases_case_partner_ids(c.id, c.assignee_id, NULL) AS p(partner_id) GROUP BY item_type, scope;
+"""
+
+REVERSE_SQL = """
+DROP TRIGGER IF EXISTS cases_case_on_change_trg ON cases_case;
+DROP TRIGGER IF EXISTS cases_case_labels_on_change_trg ON cases_case_labels;
+DROP FUNCTION IF EXISTS cases_case_on_change();
+DROP FUNCTION IF EXISTS cases_case_labels_on_change();
+DROP FUNCTION IF EXISTS cases_record_case_counts(cases_case, INT);
+DROP FUNCTION IF EXISTS cases_case_partner_ids(INT, INT, INT);
+DELETE FROM statistics_totalcount WHERE item_type IN ('O', 'X');
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cases", "0052_alter_caseexport_created_by_alter_caseexport_org_and_more"),
+        ("msgs", "0072_message_changes"),
+        ("statistics", "0019_alter_dailycountexport_created_by_and_more"),
+    ]
+
+    operations = [migrations.RunSQL(SQL, REVERSE_SQL)]
@@ -1,22 +1,27 @@
+import heapq
+from collections import defaultdict
 from enum import Enum, IntEnum
-from itertools import chain
 
 from dash.orgs.models import Org
-from dash.utils import intersection
 from django_redis import get_redis_connection
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.db import models
-from django.db.models import Count, Prefetch, Q
+from django.db.models import Count, Exists, OuterRef, Prefetch, Q
 from django.utils.translation import gettext_lazy as _
 
 from casepro.contacts.models import Contact
 from casepro.msgs.models import Label, Message, Outgoing
-from casepro.utils import TimelineItem
+from casepro.utils import TimelineItem, datetime_to_microseconds
 from casepro.utils.export import BaseSearchExport
+from casepro.utils.push import case_scope, publish
 
 CASE_LOCK_KEY = "org:%d:case_lock:%s"
+CASE_BACKEND_MESSAGES_KEY = "case-backend-messages:%d:%d"
+CASE_BACKEND_MESSAGES_TTL = 60 * 60 * 24  # 1 day
+CASE_BACKEND_MESSAGES_FETCH_LIMIT = 250  # max number of backend messages to fetch when first opening a timeline
 
 
 class CaseFolder(Enum):
@@ -188,12 +193,23 @@ class Case(models.Model):
             # if user is not an org admin, we should only return cases with partner labels or assignment
             user_partner = user.get_partner(org)
             if user_partner and user_partner.is_restricted:
-                queryset = queryset.filter(Q(labels__in=list(user_partner.get_labels())) | Q(assignee=user_partner))
+                queryset = queryset.filter(cls.partner_filter(user_partner))
 
         if label:
             queryset = queryset.filter(labels=label)
 
-        return queryset.distinct()
+        return queryset
+
+    @classmethod
+    def partner_filter(cls, partner):
+        """
+        Gets a filter for the cases a restricted partner can see, i.e. those assigned to it or with one of its labels.
+        Label access is checked with EXISTS rather than a join so that cases don't need de-duplicating with DISTINCT.
+        """
+        partner_labelled = cls.labels.through.objects.filter(
+            case_id=OuterRef("pk"), label__is_active=True, label__partners=partner
+        )
+        return Q(assignee=partner) | Exists(partner_labelled)
 
     @classmethod
     def get_open(cls, org, user=None, label=None):
@@ -203,6 +219,23 @@ class Case(models.Model):
     def get_closed(cls, org, user=None, label=None):
         return cls.get_all(org, user, label).exclude(closed_on=None)
 
+    @classmethod
+    def get_folder_counts(cls, org, user):
+        """
+        Gets the numbers of open and closed cases the given user can see, from the case counts maintained by triggers
+        """
+        from casepro.statistics.models import TotalCount
+
+        user_partner = user.get_partner(org)
+        if user_partner and user_partner.is_restricted:
+            open_counts = TotalCount.get_by_partner([user_partner], TotalCount.TYPE_OPEN_CASES)
+            closed_counts = TotalCount.get_by_partner([user_partner], TotalCount.TYPE_CLOSED_CASES)
+        else:
+            open_counts = TotalCount.get_by_org([org], TotalCount.TYPE_OPEN_CASES)
+            closed_counts = TotalCount.get_by_org([org], TotalCount.TYPE_CLOSED_CASES)
+
+        return open_counts.total(), closed_counts.total()
+
     @classmethod
     def get_for_contact(cls, org, contact):
         return cls.get_all(org).filter(contact=contact)
@@ -212,6 +245,38 @@ class Case(models.Model):
         qs = cls.get_for_contact(org, contact)
         return qs.filter(opened_on__lt=dt).filter(Q(closed_on=None) | Q(closed_on__gt=dt)).first()
 
+    @classmethod
+    def get_open_for_messages(cls, org, messages):
+        """
+        Gets the cases which were open for the contacts of the given messages at the times they were received, using
+        a single query for the whole batch
+
+        :param messages: the messages
+        :return: dict of message ids to open cases
+        """
+        if not messages:
+            return {}
+
+        contact_ids = {m.contact_id for m in messages}
+        earliest = min(m.created_on for m in messages)
+        latest = max(m.created_on for m in messages)
+
+        cases = cls.objects.filter(org=org, contact_id__in=contact_ids, opened_on__lt=latest)
+        cases = cases.filter(Q(closed_on=None) | Q(closed_on__gt=earliest)).order_by("pk")
+
+        cases_by_contact = defaultdict(list)
+        for case in cases:
+            cases_by_contact[case.contact_id].append(case)
+
+        open_cases = {}
+        for msg in messages:
+            for case in cases_by_contact[msg.contact_id]:
+                if case.opened_on < msg.created_on and (case.closed_on is None or case.closed_on > msg.created_on):
+                    open_cases[msg.id] = case
+                    break
+
+        return open_cases
+
     @classmethod
     def search(cls, org, user, search):
         """
@@ -306,36 +371,91 @@ class Case(models.Model):
 
     def get_timeline(self, after, before, merge_from_backend):
         local_outgoing = self.outgoing_messages.filter(created_on__gte=after, created_on__lte=before)
-        local_outgoing = local_outgoing.select_related("case", "contact", "created_by").order_by("-created_on")
+        local_outgoing = list(local_outgoing.select_related("case", "contact", "created_by").order_by("created_on"))
 
         local_incoming = self.incoming_messages.filter(created_on__gte=after, created_on__lte=before)
         local_incoming = local_incoming.select_related("case", "contact").prefetch_related("labels")
-        local_incoming = local_incoming.order_by("-created_on")
-
-        # merge local incoming and outgoing
-        timeline = [TimelineItem(msg) for msg in chain(local_outgoing, local_incoming)]
+        local_incoming = local_incoming.order_by("created_on")
 
+        backend_messages = []
         if merge_from_backend:
-            # if this is the initial request, fetch additional messages from the backend
-            backend = self.org.get_backend()
-            backend_messages = backend.fetch_contact_messages(self.org, self.contact, after, before)
+            # if this is the initial request, include additional messages from the backend that don't exist locally
+            local_backend_ids = {o.backend_id for o in local_outgoing if o.backend_id}
+            local_broadcast_ids = {o.backend_broadcast_id for o in local_outgoing if o.backend_broadcast_id}
+
+            backend_messages = [
+                msg
+                for msg in self.get_backend_messages(after, before)
+                if msg.backend_id not in local_backend_ids and msg.backend_broadcast_id not in local_broadcast_ids
+            ]
+
+        actions = self.actions.filter(created_on__gte=after, created_on__lte=before)
+        actions = actions.select_related("assignee", "user_assignee", "created_by").order_by("created_on")
 
-            # add any backend messages that don't exist locally
-            if backend_messages:
-                local_backend_ids = {o.backend_id for o in local_outgoing if o.backend_id}
-                local_broadcast_ids = {o.backend_broadcast_id for o in local_outgoing if o.backend_broadcast_id}
+        # each source is already in chronological order so they can be merged in a single pass without re-sorting
+        items = heapq.merge(local_outgoing, local_incoming, backend_messages, actions, key=lambda i: i.created_on)
+        return [TimelineItem(item) for item in items]
 
-                for msg in backend_messages:
-                    if msg.backend_id not in local_backend_ids and msg.backend_broadcast_id not in local_broadcast_ids:
-                        timeline.append(TimelineItem(msg))
+    def get_backend_messages(self, after, before):
+        """
+        Gets the outgoing messages sent to this case's contact in the backend, in chronological order. These are cached
+        with the highest backend id fetched, so that later requests only fetch messages newer than that. The first
+        request only fetches the newest messages, and leaves the rest of a long case's history to a background task.
+        """
+        cached = cache.get(CASE_BACKEND_MESSAGES_KEY % (self.contact_id, datetime_to_microseconds(after)))
 
-        # fetch and append actions
-        actions = self.actions.filter(created_on__gte=after, created_on__lte=before)
-        actions = actions.select_related("assignee", "user_assignee", "created_by")
-        timeline += [TimelineItem(a) for a in actions]
+        if not cached:
+            messages, complete = self.fetch_backend_messages(after, before, limit=CASE_BACKEND_MESSAGES_FETCH_LIMIT)
+
+            if not complete:
+                from .tasks import fetch_case_backend_messages
 
-        # sort timeline by reverse chronological order
-        return sorted(timeline, key=lambda item: item.get_time())
+                fetch_case_backend_messages.delay(
+                    self.pk, datetime_to_microseconds(after), datetime_to_microseconds(before)
+                )
+
+        elif cached["until"] >= before:
+            messages = cached["messages"]
+        elif cached["max_id"]:
+            messages, _ = self.fetch_backend_messages(after, before, newer_than_id=cached["max_id"])
+        else:
+            # no messages have been found yet so we can only fetch from where the last fetch ended
+            messages, _ = self.fetch_backend_messages(after, before, fetch_after=cached["until"])
+
+        return [Outgoing(contact=self.contact, **m) for m in messages if after <= m["created_on"] <= before]
+
+    def fetch_backend_messages(self, after, before, fetch_after=None, newer_than_id=None, limit=None):
+        """
+        Fetches outgoing messages sent to this case's contact from the backend and merges them into the cached messages
+        for the window starting at the given time
+
+        :return: tuple of the merged messages, and whether all messages in the window were fetched
+        """
+        backend = self.org.get_backend()
+        fetched = backend.fetch_contact_messages(
+            self.org, self.contact, fetch_after or after, before, newer_than_id=newer_than_id, limit=limit
+        )
+
+        # read the cache after fetching in case a background fetch has updated it in the meantime
+        key = CASE_BACKEND_MESSAGES_KEY % (self.contact_id, datetime_to_microseconds(after))
+        cached = cache.get(key)
+        messages = {(m["backend_id"], m["backend_broadcast_id"]): m for m in cached["messages"]} if cached else {}
+
+        for msg in fetched:
+            messages[(msg.backend_id, msg.backend_broadcast_id)] = {
+                "backend_id": msg.backend_id,
+                "backend_broadcast_id": msg.backend_broadcast_id,
+                "text": msg.text,
+                "created_on": msg.created_on,
+            }
+
+        messages = sorted(messages.values(), key=lambda m: m["created_on"])
+        max_id = max((m["backend_id"] for m in messages if m["backend_id"]), default=None)
+        until = max(before, cached["until"]) if cached else before
+
+        cache.set(key, {"max_id": max_id, "until": until, "messages": messages}, CASE_BACKEND_MESSAGES_TTL)
+
+        return messages, not (limit and len(fetched) >= limit)
 
     def add_reply(self, message):
         message.case = self
@@ -344,6 +464,41 @@ class Case(models.Model):
 
         self.notify_watchers(reply=message)
 
+        publish(case_scope(self))
+
+    @classmethod
+    def add_replies(cls, org, replies):
+        """
+        Adds replies to multiple cases at once, archiving the messages and notifying the watchers of each case
+
+        :param replies: list of (case, message) tuples
+        """
+        from casepro.profiles.models import Notification
+
+        if not replies:
+            return
+
+        case_ids = models.Case(
+            *[models.When(pk=msg.pk, then=models.Value(case.pk)) for case, msg in replies],
+            output_field=models.IntegerField(),
+        )
+        Message.objects.filter(pk__in=[msg.pk for case, msg in replies]).update(case=case_ids, is_archived=True)
+
+        for case, msg in replies:
+            msg.case = case
+            msg.is_archived = True
+
+        watchers = cls.watchers.through.objects.filter(case__in={case for case, msg in replies})
+        watcher_ids_by_case = defaultdict(list)
+        for case_id, user_id in watchers.values_list("case_id", "user_id"):
+            watcher_ids_by_case[case_id].append(user_id)
+
+        Notification.bulk_new_case_reply(
+            org, {msg: watcher_ids_by_case[case.pk] for case, msg in replies if watcher_ids_by_case[case.pk]}
+        )
+
+        publish(*{case_scope(case) for case, msg in replies})
+
     @case_action()
     def update_summary(self, user, summary):
         self.summary = summary
@@ -476,25 +631,48 @@ class Case(models.Model):
             5) they are specifically assigned to the case
             6) their partner org can view a label assigned to the case
 
-        They can additionally update the case if one of 1-4 is true
+        They can additionally update the case if one of 1-5 is true
         """
-        if not user.is_superuser and not self.org.get_user_org_group(user):
-            return AccessLevel.none
-
-        user_partner = user.get_partner(self.org)
-
-        if (
-            user.is_superuser
-            or not user_partner
-            or not user_partner.is_restricted
-            or user_partner == self.assignee
-            or user == self.user_assignee
-        ):
-            return AccessLevel.update
-        elif user_partner and intersection(self.labels.filter(is_active=True), user_partner.get_labels()):
-            return AccessLevel.read
-        else:
-            return AccessLevel.none
+        return self.access_levels([self], user)[self.pk]
+
+    @classmethod
+    def access_levels(cls, cases, user):
+        """
+        Gets the access levels of a user for the given cases (which must belong to the same org) as a dict of case ids
+        to access levels. Beyond the user's role and partner, this needs at most one query for the whole list.
+        """
+        cases = list(cases)
+        if not cases:
+            return {}
+
+        org = cases[0].org
+        if any(c.org_id != org.pk for c in cases):
+            raise ValueError("Can only get access levels for cases in the same org")
+
+        if not user.is_superuser and not user.get_role(org):
+            return {c.pk: AccessLevel.none for c in cases}
+
+        user_partner = user.get_partner(org)
+
+        if user.is_superuser or not user_partner or not user_partner.is_restricted:
+            return {c.pk: AccessLevel.update for c in cases}
+
+        levels = {}
+        for case in cases:
+            if case.assignee_id == user_partner.pk or case.user_assignee_id == user.pk:
+                levels[case.pk] = AccessLevel.update
+
+        unassigned_ids = [c.pk for c in cases if c.pk not in levels]
+        if unassigned_ids:
+            labelled_ids = set(
+                cls.labels.through.objects.filter(
+                    case_id__in=unassigned_ids, label__is_active=True, label__partners=user_partner
+                ).values_list("case_id", flat=True)
+            )
+            for case_id in unassigned_ids:
+                levels[case_id] = AccessLevel.read if case_id in labelled_ids else AccessLevel.none
+
+        return levels
 
     @property
     def is_closed(self):
@@ -578,7 +756,7 @@ class CaseAction(models.Model):
 
     @classmethod
     def create(cls, case, user, action, assignee=None, label=None, note=None, user_assignee=None):
-        return CaseAction.objects.create(
+        action = CaseAction.objects.create(
             org=case.org,
             case=case,
             action=action,
@@ -589,6 +767,10 @@ class CaseAction(models.Model):
             user_assignee=user_assignee,
         )
 
+        publish(case_scope(case))
+
+        return action
+
     def as_json(self):
         return {
             "id": self.pk,
@@ -618,7 +800,7 @@ class CaseExport(BaseSearchExport):
         search["folder"] = CaseFolder[search["folder"]]
         return search
 
-    def render_search(self, book, search):
+    def get_headers(self):
         from casepro.contacts.models import Field
 
         base_fields = [
@@ -632,10 +814,17 @@ class CaseExport(BaseSearchExport):
             "Messages Received",
             "Contact",
         ]
+        return base_fields + [f.label for f in Field.get_all(self.org, visible=True)]
+
+    def get_sheet_name(self, num):
+        return str(_("Cases %d" % num))
+
+    def get_rows(self, search):
+        from casepro.contacts.models import Field
+
         contact_fields = Field.get_all(self.org, visible=True)
-        all_fields = base_fields + [f.label for f in contact_fields]
 
-        # load all messages to be exported
+        # iterate over cases to be exported in chunks
         items = Case.search(self.org, self.created_by, search)
 
         items = items.select_related("initial_message")  # need for "Message On"
@@ -645,20 +834,7 @@ class CaseExport(BaseSearchExport):
             outgoing_count=Count("outgoing_messages", distinct=True),
         )
 
-        def add_sheet(num):
-            sheet = book.add_sheet(str(_("Cases %d" % num)))
-            self.write_row(sheet, 0, all_fields)
-            return sheet
-
-        sheet = None
-        sheet_number = 0
-        row = 1
-        for item in items:
-            if not sheet or row > self.MAX_SHEET_ROWS:
-                sheet_number += 1
-                sheet = add_sheet(sheet_number)
-                row = 1
-
+        for item in items.iterator(chunk_size=self.CHUNK_SIZE):
             values = [
                 item.initial_message.created_on if item.initial_message else "",
                 item.opened_on,
@@ -676,5 +852,4 @@ class CaseExport(BaseSearchExport):
             for field in contact_fields:
                 values.append(fields.get(field.key, ""))
 
-            self.write_row(sheet, row, values)
-            row += 1
+            yield values
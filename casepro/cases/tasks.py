@@ -1,6 +1,8 @@
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
+from casepro.utils import microseconds_to_datetime
+
 logger = get_task_logger(__name__)
 
 
@@ -10,4 +12,18 @@ def case_export(export_id):
 
     logger.info("Starting case export #%d..." % export_id)
 
-    CaseExport.objects.get(pk=export_id).do_export()
+    def progress(num, rate):  # pragma: no cover
+        logger.debug(f" > Exported {num} rows for case export #{export_id} ({rate:.0f} rows/sec)")
+
+    CaseExport.objects.get(pk=export_id).do_export(progress_callback=progress)
+
+
+@shared_task
+def fetch_case_backend_messages(case_id, after, before):
+    """
+    Fetches all of the backend messages in a case timeline window when there were too many to fetch during a request
+    """
+    from .models import Case
+
+    case = Case.objects.select_related("org", "contact").get(pk=case_id)
+    case.fetch_backend_messages(microseconds_to_datetime(after), microseconds_to_datetime(before))
@@ -1,6 +1,8 @@
+import json
 from datetime import datetime, timedelta
 from unittest.mock import patch
 
+from asgiref.sync import async_to_sync
 from temba_client.utils import format_iso8601
 
 from django.contrib.auth.models import User
@@ -13,12 +15,14 @@ from casepro.contacts.models import Contact
 from casepro.msgs.models import Label, Message, Outgoing
 from casepro.msgs.tasks import handle_messages
 from casepro.orgs_ext.models import Flow
-from casepro.profiles.models import ROLE_ANALYST, ROLE_MANAGER, Notification
+from casepro.profiles.models import ROLE_ANALYST, ROLE_MANAGER, Notification, UserOrgCache
+from casepro.statistics.models import TotalCount, update_partner_case_counts
 from casepro.test import BaseCasesTest
 from casepro.utils import datetime_to_microseconds, microseconds_to_datetime
 
 from .context_processors import sentry_dsn
-from .models import AccessLevel, Case, CaseAction, CaseExport, CaseFolder, Partner
+from .models import CASE_BACKEND_MESSAGES_FETCH_LIMIT, AccessLevel, Case, CaseAction, CaseExport, CaseFolder, Partner
+from .tasks import fetch_case_backend_messages
 
 
 class CaseTest(BaseCasesTest):
@@ -327,6 +331,11 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(set(Case.get_all(self.unicef, user=self.user1, label=self.pregnancy)), {case2, case3})
         self.assertEqual(set(Case.get_all(self.unicef, user=self.user3, label=self.pregnancy)), {case2, case3})
 
+        # case2 matches both of MOH's labels but is still only returned once, without needing DISTINCT
+        cases = Case.get_all(self.unicef, user=self.user1).order_by("id")
+        self.assertEqual(list(cases), [case1, case2, case3])
+        self.assertNotIn("DISTINCT", str(cases.query))
+
         case2.closed_on = timezone.now()
         case2.save()
 
@@ -336,6 +345,78 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(set(Case.get_closed(self.unicef)), {case2})
         self.assertEqual(set(Case.get_closed(self.unicef, user=self.user1, label=self.pregnancy)), {case2})
 
+    def test_get_folder_counts(self):
+        def assert_counts(user, open_count, closed_count):
+            self.assertEqual(Case.get_folder_counts(self.unicef, user), (open_count, closed_count))
+
+            # counts should always agree with counting the cases the user can see
+            self.assertEqual(Case.get_open(self.unicef, user).count(), open_count)
+            self.assertEqual(Case.get_closed(self.unicef, user).count(), closed_count)
+
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        cat = self.create_contact(self.unicef, "C-003", "Cat")
+
+        case1 = self.create_case(self.unicef, self.ann, self.moh, None, [self.aids])
+        case2 = self.create_case(self.unicef, bob, self.who, None, [self.pregnancy])
+        case3 = self.create_case(self.unicef, cat, self.who, None, [])
+
+        assert_counts(self.admin, 3, 0)
+        assert_counts(self.user1, 2, 0)  # case1 by assignment, case2 by label
+        assert_counts(self.user3, 3, 0)  # case1 by label, case2 and case3 by assignment
+
+        case2.closed_on = timezone.now()
+        case2.save(update_fields=("closed_on",))
+
+        assert_counts(self.admin, 2, 1)
+        assert_counts(self.user1, 1, 1)
+        assert_counts(self.user3, 2, 1)
+
+        case1.labels.remove(self.aids)
+        case3.labels.add(self.pregnancy)
+
+        assert_counts(self.user1, 2, 1)
+        assert_counts(self.user3, 1, 1)
+
+        case3.assignee = self.moh
+        case3.save(update_fields=("assignee",))
+
+        assert_counts(self.user1, 2, 1)
+        assert_counts(self.user3, 0, 1)
+
+        # changing which labels a partner can access changes which cases it can see
+        self.who.labels.add(self.pregnancy)
+
+        assert_counts(self.user3, 1, 1)
+
+        self.pregnancy.is_active = False
+        self.pregnancy.save(update_fields=("is_active",))
+
+        assert_counts(self.admin, 2, 1)
+        assert_counts(self.user1, 2, 0)
+        assert_counts(self.user3, 0, 1)
+
+        # counts survive squashing
+        TotalCount.squash()
+
+        assert_counts(self.admin, 2, 1)
+        assert_counts(self.user1, 2, 0)
+        assert_counts(self.user3, 0, 1)
+
+        # saving a label without activating or deactivating it doesn't recalculate partner counts
+        with patch("casepro.statistics.signals.update_partner_case_counts") as mock_update_counts:
+            self.aids.description = "Messages about HIV/AIDS"
+            self.aids.save()
+
+            self.assertNotCalled(mock_update_counts)
+
+        # recalculating corrects counts by adding to them rather than replacing counts the triggers may be writing
+        who_scope = TotalCount.encode_scope(self.who)
+        TotalCount.objects.create(item_type=TotalCount.TYPE_OPEN_CASES, scope=who_scope, count=3, is_squashed=True)
+        update_partner_case_counts([self.who])
+
+        assert_counts(self.user3, 0, 1)
+        self.assertEqual(TotalCount.objects.filter(scope=who_scope, is_squashed=False).count(), 1)
+
     def test_get_open_for_contact_on(self):
         d0 = datetime(2014, 1, 5, 0, 0, tzinfo=timezone.utc)
         d1 = datetime(2014, 1, 10, 0, 0, tzinfo=timezone.utc)
@@ -373,6 +454,68 @@ class CaseTest(BaseCasesTest):
         )
         self.assertEqual(open_case, case2)
 
+    def test_get_open_for_messages(self):
+        d0 = datetime(2014, 1, 5, 0, 0, tzinfo=timezone.utc)
+        d1 = datetime(2014, 1, 10, 0, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 15, 0, 0, tzinfo=timezone.utc)
+
+        # case Jan 5th -> Jan 10th and case Jan 15th -> now for Ann
+        msg1 = self.create_message(self.unicef, 123, self.ann, "Hello", created_on=d0)
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, opened_on=d0, closed_on=d1)
+        msg2 = self.create_message(self.unicef, 234, self.ann, "Hello again", created_on=d2)
+        case2 = self.create_case(self.unicef, self.ann, self.moh, msg2, opened_on=d2)
+
+        msg3 = self.create_message(
+            self.unicef, 345, self.ann, "Jan 4", created_on=datetime(2014, 1, 4, tzinfo=timezone.utc)
+        )
+        msg4 = self.create_message(
+            self.unicef, 456, self.ann, "Jan 7", created_on=datetime(2014, 1, 7, tzinfo=timezone.utc)
+        )
+        msg5 = self.create_message(
+            self.unicef, 567, self.ann, "Jan 13", created_on=datetime(2014, 1, 13, tzinfo=timezone.utc)
+        )
+        msg6 = self.create_message(
+            self.unicef, 678, self.ann, "Jan 16", created_on=datetime(2014, 1, 16, tzinfo=timezone.utc)
+        )
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg7 = self.create_message(
+            self.unicef, 789, bob, "Jan 16", created_on=datetime(2014, 1, 16, tzinfo=timezone.utc)
+        )
+
+        with self.assertNumQueries(1):
+            open_cases = Case.get_open_for_messages(self.unicef, [msg3, msg4, msg5, msg6, msg7])
+
+        self.assertEqual(open_cases, {msg4.id: case1, msg6.id: case2})
+
+        self.assertEqual(Case.get_open_for_messages(self.unicef, []), {})
+
+    def test_add_replies(self):
+        d1 = datetime(2014, 1, 5, 0, 0, tzinfo=timezone.utc)
+        msg1 = self.create_message(self.unicef, 123, self.ann, "Hello", created_on=d1)
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, opened_on=d1)
+        case1.watchers.add(self.user1, self.user2)
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg2 = self.create_message(self.unicef, 234, bob, "Hello", created_on=d1)
+        case2 = self.create_case(self.unicef, bob, self.moh, msg2, opened_on=d1)
+
+        msg3 = self.create_message(self.unicef, 345, self.ann, "Reply 1")
+        msg4 = self.create_message(self.unicef, 456, self.ann, "Reply 2")
+        msg5 = self.create_message(self.unicef, 567, bob, "Reply 3")
+
+        # user #1 already has a notification for one of the replies
+        Notification.new_case_reply(self.unicef, self.user1, msg3)
+
+        with self.assertNumQueries(4):
+            Case.add_replies(self.unicef, [(case1, msg3), (case1, msg4), (case2, msg5)])
+
+        self.assertEqual(set(case1.incoming_messages.all()), {msg1, msg3, msg4})
+        self.assertEqual(set(case2.incoming_messages.all()), {msg2, msg5})
+        self.assertEqual(set(Message.objects.filter(is_archived=True)), {msg3, msg4, msg5})
+        self.assertEqual(
+            set(Notification.objects.filter(type=Notification.TYPE_CASE_REPLY).values_list("user", "message")),
+            {(self.user1.id, msg3.id), (self.user1.id, msg4.id), (self.user2.id, msg3.id), (self.user2.id, msg4.id)},
+        )
+
     def test_get_or_open_with_user_assignee(self):
         """
         If a case is opened with the user_assignee field set, the created case should have the assigned user, and
@@ -515,6 +658,52 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(case.access_level(self.user3), AccessLevel.read)  # user from other partner can read bc labels
         self.assertEqual(case.access_level(self.user4), AccessLevel.none)  # user from different org
 
+    def test_access_levels(self):
+        msg1 = self.create_message(self.unicef, 234, self.ann, "Hello")
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, [self.aids])
+        msg2 = self.create_message(self.unicef, 235, self.ann, "Hi")
+        case2 = self.create_case(self.unicef, self.ann, self.moh, msg2, [self.pregnancy])
+        msg3 = self.create_message(self.unicef, 236, self.ann, "Yo")
+        case3 = self.create_case(self.unicef, self.ann, self.moh, msg3, [self.pregnancy], user_assignee=self.user3)
+        ned = self.create_contact(self.nyaruka, "C-002", "Ned")
+        msg4 = self.create_message(self.nyaruka, 237, ned, "Hey")
+        case4 = self.create_case(self.nyaruka, ned, self.klab, msg4, [])
+
+        cases = [case1, case2, case3]
+
+        self.assertEqual(
+            Case.access_levels(cases, self.admin),
+            {case1.pk: AccessLevel.update, case2.pk: AccessLevel.update, case3.pk: AccessLevel.update},
+        )
+        self.assertEqual(
+            Case.access_levels(cases, self.user1),
+            {case1.pk: AccessLevel.update, case2.pk: AccessLevel.update, case3.pk: AccessLevel.update},
+        )
+        self.assertEqual(
+            Case.access_levels(cases, self.user4),
+            {case1.pk: AccessLevel.none, case2.pk: AccessLevel.none, case3.pk: AccessLevel.none},
+        )
+
+        # user from other partner can read via labels or update via assignment, and once their role and partner are
+        # cached for the request, the whole list only needs one query
+        user3 = User.objects.get(pk=self.user3.pk)
+        UserOrgCache.attach(user3)
+        user3.get_role(self.unicef)
+        user3.get_partner(self.unicef)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Case.access_levels(cases, user3),
+                {case1.pk: AccessLevel.read, case2.pk: AccessLevel.none, case3.pk: AccessLevel.update},
+            )
+
+        # should match checking each case individually
+        for case in cases:
+            self.assertEqual(case.access_level(self.user3), Case.access_levels(cases, self.user3)[case.pk])
+
+        self.assertEqual(Case.access_levels([], self.user3), {})
+        self.assertRaises(ValueError, Case.access_levels, [case1, case4], self.admin)
+
 
 class CaseCRUDLTest(BaseCasesTest):
     def setUp(self):
@@ -907,7 +1096,7 @@ class CaseCRUDLTest(BaseCasesTest):
 
         # backend has a message in the case time window that we don't have locally
         remote_message1 = Outgoing(
-            backend_broadcast_id=102, contact=self.ann, text="Non casepro message...", created_on=d2
+            backend_id=1001, backend_broadcast_id=102, contact=self.ann, text="Non casepro message...", created_on=d2
         )
         mock_fetch_contact_messages.return_value = [remote_message1]
 
@@ -934,7 +1123,9 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json["results"][2]["item"]["action"], "O")
 
         # as this was the initial request, messages will have been fetched from the backend
-        mock_fetch_contact_messages.assert_called_once_with(self.unicef, self.ann, d1, t0)
+        mock_fetch_contact_messages.assert_called_once_with(
+            self.unicef, self.ann, d1, t0, newer_than_id=None, limit=CASE_BACKEND_MESSAGES_FETCH_LIMIT
+        )
         mock_fetch_contact_messages.reset_mock()
         mock_fetch_contact_messages.return_value = []
 
@@ -1018,8 +1209,7 @@ class CaseCRUDLTest(BaseCasesTest):
 
         # backend has the message sent during the case as well as the unrelated message
         mock_fetch_contact_messages.return_value = [
-            Outgoing(backend_broadcast_id=202, contact=self.ann, text="It's bad", created_on=d3),
-            remote_message1,
+            Outgoing(backend_id=1002, backend_broadcast_id=202, contact=self.ann, text="It's bad", created_on=d3),
         ]
 
         # which requests all of the timeline up to now
@@ -1045,9 +1235,73 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(items[6]["type"], "A")
         self.assertEqual(items[6]["item"]["action"], "C")
 
-        # as this was the initial request, messages will have been fetched from the backend
-        mock_fetch_contact_messages.assert_called_once_with(self.unicef, self.ann, d1, case.closed_on)
+        # as this was an initial request, messages will have been fetched from the backend, but only those newer than
+        # the ones fetched by the previous initial request
+        mock_fetch_contact_messages.assert_called_once_with(
+            self.unicef, self.ann, d1, case.closed_on, newer_than_id=1001, limit=None
+        )
+        mock_fetch_contact_messages.reset_mock()
+
+        # user refreshes page again and gets the same timeline without fetching from the backend, as it's all cached
+        response = self.url_get("unicef", "%s?after=" % timeline_url)
+        self.assertEqual(response.json["results"], items)
+
+        self.assertNotCalled(mock_fetch_contact_messages)
+
+    @patch("casepro.cases.models.CASE_BACKEND_MESSAGES_FETCH_LIMIT", 2)
+    @patch("casepro.cases.tasks.fetch_case_backend_messages.delay")
+    @patch("casepro.test.TestBackend.fetch_contact_messages")
+    def test_get_backend_messages(self, mock_fetch_contact_messages, mock_fetch_delay):
+        d1 = datetime(2014, 1, 2, 13, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 2, 14, 0, tzinfo=timezone.utc)
+        d3 = datetime(2014, 1, 2, 15, 0, tzinfo=timezone.utc)
+        d4 = datetime(2014, 1, 2, 16, 0, tzinfo=timezone.utc)
+        d5 = datetime(2014, 1, 2, 17, 0, tzinfo=timezone.utc)
+
+        case = self.create_case(self.unicef, self.ann, self.moh, message=None)
+
+        def remote(backend_id, created_on):
+            return Outgoing(backend_id=backend_id, contact=self.ann, text="Msg %d" % backend_id, created_on=created_on)
+
+        # first request only gets the newest messages, and leaves the rest for a background fetch
+        mock_fetch_contact_messages.return_value = [remote(1003, d3), remote(1002, d2)]
+
+        messages = case.get_backend_messages(d1, d4)
+
+        self.assertEqual([m.backend_id for m in messages], [1002, 1003])
+        mock_fetch_contact_messages.assert_called_once_with(self.unicef, self.ann, d1, d4, newer_than_id=None, limit=2)
+        mock_fetch_delay.assert_called_once_with(case.pk, datetime_to_microseconds(d1), datetime_to_microseconds(d4))
+
+        # which fetches the whole window
         mock_fetch_contact_messages.reset_mock()
+        mock_fetch_contact_messages.return_value = [remote(1003, d3), remote(1002, d2), remote(1001, d1)]
+
+        fetch_case_backend_messages(case.pk, datetime_to_microseconds(d1), datetime_to_microseconds(d4))
+
+        mock_fetch_contact_messages.assert_called_once_with(
+            self.unicef, self.ann, d1, d4, newer_than_id=None, limit=None
+        )
+
+        # later requests only fetch messages newer than those we have, including any which were created before the
+        # last fetch but only arrived in the backend since
+        mock_fetch_contact_messages.reset_mock()
+        mock_fetch_contact_messages.return_value = [remote(1005, d5), remote(1004, d2)]
+
+        messages = case.get_backend_messages(d1, d5)
+
+        self.assertEqual([m.backend_id for m in messages], [1001, 1002, 1004, 1003, 1005])
+        mock_fetch_contact_messages.assert_called_once_with(
+            self.unicef, self.ann, d1, d5, newer_than_id=1003, limit=None
+        )
+
+        # and requests for a window we've already fetched don't fetch at all
+        mock_fetch_contact_messages.reset_mock()
+
+        messages = case.get_backend_messages(d1, d3)
+
+        self.assertEqual([m.backend_id for m in messages], [1001, 1002, 1004, 1003])
+        self.assertNotCalled(mock_fetch_contact_messages)
+        mock_fetch_delay.assert_called_once()
 
     def test_timeline_no_initial_message(self):
         """
@@ -1153,7 +1407,7 @@ class CaseCRUDLTest(BaseCasesTest):
 
 
 class CaseExportCRUDLTest(BaseCasesTest):
-    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, SITE_EXPORT_FORMAT="xls")
     def test_create_and_read(self):
         ann = self.create_contact(
             self.unicef, "C-001", "Ann", fields={"nickname": "Annie", "age": "28", "state": "WA"}
@@ -1235,7 +1489,7 @@ class CaseExportCRUDLTest(BaseCasesTest):
         response = self.url_get("unicef", read_url)
         self.assertEqual(response.status_code, 302)
 
-    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, SITE_EXPORT_FORMAT="xls")
     def test_create_with_no_initial_message(self):
         """When a case is exported with initial_message=None, the field should be a blank string."""
         ann = self.create_contact(self.unicef, "C-001", "Ann")
@@ -1299,6 +1553,103 @@ class InboxViewsTest(BaseCasesTest):
         self.assertContains(response, "/messageboard/")
 
 
+@override_settings(PUSH_STREAM_SECONDS=0)
+class PushViewTest(BaseCasesTest):
+    def test_push(self):
+        url = reverse("cases.push")
+
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        msg = self.create_message(self.unicef, 123, ann, "Hello")
+        case = self.create_case(self.unicef, ann, self.moh, msg)
+        tea_msg = self.create_message(self.unicef, 124, ann, "Tea?", [self.tea], is_handled=True)
+        aids_msg = self.create_message(self.unicef, 125, ann, "AIDS?", [self.aids], is_handled=True)
+
+        response = self.url_get("unicef", url)
+        self.assertLoginRedirect(response, url)
+
+        self.login(self.user1)
+
+        # must specify something to check for changes to
+        response = self.url_get("unicef", url)
+        self.assertEqual(response.status_code, 400)
+
+        # first connection just gets the current versions
+        response = self.url_get("unicef", url, {"inbox": "", "case": case.pk})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        event_id, data = self.read_events(response)[0]
+        self.assertFalse(data["changed"])
+        self.assertEqual(set(data["versions"].keys()), {"inbox", "case_version"})
+
+        versions = data["versions"]
+
+        # nothing has changed so reconnecting with the last event id gets no events
+        response = self.url_get("unicef", url, {"inbox": "", "case": case.pk}, HTTP_LAST_EVENT_ID=event_id)
+        self.assertEqual(self.read_events(response), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            case.add_note(self.user1, "Interesting")
+
+        response = self.url_get("unicef", url, {"inbox": "", "case": case.pk}, HTTP_LAST_EVENT_ID=event_id)
+        event_id, data = self.read_events(response)[0]
+        self.assertTrue(data["changed"])
+        self.assertEqual(data["versions"], {"inbox": versions["inbox"], "case_version": versions["case_version"] + 1})
+
+        # versions can also be passed as params
+        response = self.url_get("unicef", url, {"case": case.pk, "case_version": versions["case_version"] + 1})
+        self.assertEqual(self.read_events(response), [])
+
+        # an invalid version is a bad request
+        response = self.url_get("unicef", url, {"case": case.pk, "case_version": "x"})
+        self.assertEqual(response.status_code, 400)
+
+        admin_versions = self.get_inbox_versions(self.admin)
+        user_versions = self.get_inbox_versions(self.user1)
+
+        # a change to a message with a label this user can't see doesn't change their inbox
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.bulk_flag(self.unicef, self.admin, [tea_msg])
+
+        self.assertTrue(self.get_inbox_versions(self.admin, admin_versions)["changed"])
+        self.assertIsNone(self.get_inbox_versions(self.user1, user_versions))
+
+        # but a change to a message with a label they can see does
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.bulk_flag(self.unicef, self.admin, [aids_msg])
+
+        self.assertTrue(self.get_inbox_versions(self.user1, user_versions)["changed"])
+
+        # user from other partner can't see this case
+        self.login(self.user3)
+
+        response = self.url_get("unicef", url, {"case": case.pk})
+        self.assertEqual(response.status_code, 403)
+
+    def get_inbox_versions(self, user, versions=None):
+        self.login(user)
+
+        response = self.url_get("unicef", reverse("cases.push"), {"inbox": "", **(versions or {})})
+        events = self.read_events(response)
+        if versions:
+            return events[0][1] if events else None
+        return events[0][1]["versions"]
+
+    def read_events(self, response):
+        """
+        Reads the (id, data) of each event from a push stream
+        """
+
+        async def read():
+            return b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        events = []
+        for block in async_to_sync(read)().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+            if "data" in fields:
+                events.append((fields["id"], json.loads(fields["data"])))
+        return events
+
+
 class PartnerTest(BaseCasesTest):
     def test_create(self):
         wfp = Partner.create(self.unicef, "WFP", "World Food Program", None, True, [self.aids, self.pregnancy])
@@ -10,6 +10,7 @@ from .views import (
     OpenCasesView,
     PartnerCRUDL,
     PingView,
+    PushView,
     SentView,
     StatusView,
     UnlabelledView,
@@ -27,6 +28,7 @@ urlpatterns += [
     re_path(r"^sent/$", SentView.as_view(), name="cases.sent"),
     re_path(r"^open/$", OpenCasesView.as_view(), name="cases.open"),
     re_path(r"^closed/$", ClosedCasesView.as_view(), name="cases.closed"),
+    re_path(r"^push/$", PushView.as_view(), name="cases.push"),
     re_path(r"^status$", StatusView.as_view(), name="internal.status"),
     re_path(r"^ping$", PingView.as_view(), name="internal.ping"),
 ]
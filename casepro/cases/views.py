@@ -17,7 +17,8 @@ from temba_client.utils import parse_iso8601
 
 from django.conf import settings
 from django.core.cache import cache
-from django.http import HttpResponse, JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, QueryDict, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.utils.timezone import now
@@ -33,9 +34,11 @@ from casepro.utils import (
     humanize_seconds,
     microseconds_to_datetime,
     month_range,
+    paginate_by_cursor,
     str_to_bool,
 )
 from casepro.utils.export import BaseDownloadView
+from casepro.utils.push import case_scope, inbox_scope, label_scope, stream_changes
 
 from .forms import PartnerCreateForm, PartnerUpdateForm
 from .models import AccessLevel, Case, CaseExport, CaseFolder, Partner
@@ -283,20 +286,27 @@ class CaseCRUDL(SmartCRUDL):
             org = self.request.org
             user = self.request.user
             page = int(self.request.GET.get("page", 1))
+            cursor = self.request.GET.get("cursor")
 
             search = self.derive_search()
             cases = Case.search(org, user, search)
-            paginator = LazyPaginator(cases, 50)
 
-            context["object_list"] = paginator.page(page)
-            context["has_more"] = paginator.num_pages > page
+            if cursor is not None:
+                context["object_list"], context["next_cursor"] = paginate_by_cursor(cases, "opened_on", cursor, 50)
+                context["has_more"] = bool(context["next_cursor"])
+            else:
+                paginator = LazyPaginator(cases, 50)
+
+                context["object_list"] = paginator.page(page)
+                context["has_more"] = paginator.num_pages > page
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            return JsonResponse(
-                {"results": [c.as_json() for c in context["object_list"]], "has_more": context["has_more"]},
-                encoder=JSONEncoder,
-            )
+            response = {"results": [c.as_json() for c in context["object_list"]], "has_more": context["has_more"]}
+            if "next_cursor" in context:
+                response["next_cursor"] = context["next_cursor"]
+
+            return JsonResponse(response, encoder=JSONEncoder)
 
     class Timeline(OrgObjPermsMixin, SmartReadView):
         """
@@ -551,12 +561,11 @@ class BaseInboxView(OrgPermsMixin, SmartTemplateView):
         context["banner_text"] = org.get_banner_text()
         context["folder"] = self.folder.name
         context["folder_icon"] = self.folder_icon
-        context["open_case_count"] = Case.get_open(org, user).count()
-        context["closed_case_count"] = Case.get_closed(org, user).count()
+        context["open_case_count"], context["closed_case_count"] = Case.get_folder_counts(org, user)
         context["allow_case_without_message"] = getattr(settings, "SITE_ALLOW_CASE_WITHOUT_MESSAGE", False)
         context["user_must_reply_with_faq"] = org and not user.is_anonymous and user.must_use_faq()
         context["site_contact_display"] = getattr(settings, "SITE_CONTACT_DISPLAY", "name")
-        context["search_text_days"] = Message.SEARCH_BY_TEXT_DAYS
+        context["search_text_days"] = settings.SITE_SEARCH_BY_TEXT_DAYS
         return context
 
 
@@ -637,6 +646,59 @@ class ClosedCasesView(BaseInboxView):
     template_name = "cases/inbox_cases.haml"
 
 
+class PushView(OrgPermsMixin, SmartTemplateView):
+    """
+    Server-sent events stream which tells clients when anything has changed in the inbox or the case they are
+    displaying. Permissions are checked up front and the stream itself is an async iterator woken by Redis pub/sub, so
+    when served by an ASGI worker (see casepro.asgi) an open stream doesn't hold a thread. Clients reconnect when the
+    stream ends, passing back the versions they last saw as the Last-Event-ID header.
+    """
+
+    permission = "orgs.org_inbox"
+
+    def get(self, request, *args, **kwargs):
+        org = request.org
+        user = request.user
+        scopes_by_param = {}
+
+        if "inbox" in request.GET:
+            partner = user.get_partner(org)
+
+            # users who can only see some labels are only told about changes to messages with those labels
+            if user.can_administer(org) or (partner and not partner.is_restricted):
+                scopes_by_param["inbox"] = [inbox_scope(org)]
+            else:
+                scopes_by_param["inbox"] = [label_scope(label.id) for label in Label.get_all(org, user)]
+
+        case_id = request.GET.get("case")
+        if case_id:
+            case = get_object_or_404(Case, org=org, pk=case_id)
+            if case.access_level(user) == AccessLevel.none:
+                raise PermissionDenied()
+
+            scopes_by_param["case_version"] = [case_scope(case)]
+
+        if not scopes_by_param:
+            return HttpResponseBadRequest("No inbox or case to check for changes to")
+
+        last_seen = QueryDict(request.headers.get("Last-Event-ID", ""))
+        known = {}
+        for param in scopes_by_param.keys():
+            version = last_seen.get(param, request.GET.get(param))
+            try:
+                if version:
+                    known[param] = int(version)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid version: %s" % version)
+
+        response = StreamingHttpResponse(
+            stream_changes(scopes_by_param, known, settings.PUSH_STREAM_SECONDS), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
 class StatusView(View):
     """
     Status endpoint for keyword-based up-time monitoring checks
@@ -313,6 +313,39 @@ class Contact(models.Model):
 
             return contact
 
+    @classmethod
+    def get_stubs_with_unhandled(cls, org):
+        """
+        Gets the stub contacts of the given org which have unhandled messages, newest first
+        """
+        from casepro.msgs.models import Message
+
+        unhandled = Message.get_unhandled(org).filter(contact=models.OuterRef("pk"))
+
+        stubs = cls.objects.filter(org=org, is_stub=True, is_active=True, uuid__isnull=False)
+        return stubs.filter(models.Exists(unhandled)).order_by("-created_on")
+
+    @classmethod
+    def get_or_create_many(cls, org, names_by_uuid):
+        """
+        Gets existing contacts or creates stub contacts for many UUIDs at once, e.g. for a batch of received messages
+
+        :param names_by_uuid: dict of contact UUIDs to the names to give any new stub contacts
+        :return: dict of UUIDs to contacts
+        """
+        contacts = {c.uuid: c for c in cls.objects.filter(org=org, uuid__in=names_by_uuid.keys())}
+
+        missing = [uuid for uuid in names_by_uuid.keys() if uuid not in contacts]
+        if missing:
+            # contacts created concurrently are ignored here and then fetched along with the ones we created
+            cls.objects.bulk_create(
+                [cls(org=org, uuid=uuid, name=names_by_uuid[uuid], is_stub=True) for uuid in missing],
+                ignore_conflicts=True,
+            )
+            contacts.update({c.uuid: c for c in cls.objects.filter(org=org, uuid__in=missing)})
+
+        return contacts
+
     @classmethod
     def get_or_create_from_urn(cls, org, urn, name=None):
         """
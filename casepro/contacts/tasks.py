@@ -2,10 +2,12 @@ import iso8601
 from celery.utils.log import get_task_logger
 from dash.orgs.tasks import org_task
 
+from django.conf import settings
+
 logger = get_task_logger(__name__)
 
 
-@org_task("contact-pull", lock_timeout=2 * 60 * 60)
+@org_task("contact-pull", lock_timeout=settings.ORG_TASK_LOCK_TIMEOUTS["contact-pull"])
 def pull_contacts(org, since, until, prev_results):
     """
     Fetches updated contacts from RapidPro and updates local contacts accordingly
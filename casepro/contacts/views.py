@@ -6,7 +6,7 @@ from django.conf import settings
 from django.http import HttpResponseRedirect, JsonResponse
 from django.utils.translation import gettext_lazy as _
 
-from casepro.cases.models import Case
+from casepro.cases.models import AccessLevel, Case
 from casepro.utils import JSONEncoder
 
 from .models import Contact, Field, Group
@@ -60,12 +60,11 @@ class ContactCRUDL(SmartCRUDL):
         def get_context_data(self, **kwargs):
             context = super(ContactCRUDL.Cases, self).get_context_data(**kwargs)
 
-            cases = (
-                Case.get_all(self.request.org, self.request.user).filter(contact=self.object).order_by("-opened_on")
-            )
-            cases = cases.prefetch_related("labels").select_related("contact", "assignee")
+            cases = Case.get_all(self.request.org).filter(contact=self.object).order_by("-opened_on")
+            cases = list(cases.prefetch_related("labels").select_related("org", "contact", "assignee"))
+            access = Case.access_levels(cases, self.request.user)
 
-            context["object_list"] = cases
+            context["object_list"] = [c for c in cases if access[c.pk] >= AccessLevel.read]
             return context
 
         def render_to_response(self, context, **response_kwargs):
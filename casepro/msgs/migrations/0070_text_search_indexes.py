@@ -0,0 +1,30 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# indexes are built concurrently so that writes to these tables aren't blocked while they're built, which means each
+# statement has to be run on its own outside of a transaction
+INDEX_SQL = [
+    """
+    CREATE INDEX CONCURRENTLY msgs_message_text_trgm
+    ON msgs_message USING GIN (text gin_trgm_ops)
+    WHERE is_active = TRUE AND is_handled = TRUE;
+    """,
+    """
+    CREATE INDEX CONCURRENTLY msgs_outgoing_text_trgm
+    ON msgs_outgoing USING GIN (text gin_trgm_ops);
+    """,
+]
+
+DROP_SQL = [
+    "DROP INDEX CONCURRENTLY msgs_message_text_trgm;",
+    "DROP INDEX CONCURRENTLY msgs_outgoing_text_trgm;",
+]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [("msgs", "0069_alter_outgoing_backend_id")]
+
+    operations = [TrigramExtension(), migrations.RunSQL(INDEX_SQL, DROP_SQL)]
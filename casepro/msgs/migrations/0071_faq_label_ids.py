@@ -0,0 +1,39 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+INDEX_SQL = """
+CREATE INDEX msgs_faq_label_ids ON msgs_faq USING GIN (label_ids);
+
+CREATE INDEX msgs_faq_question_trgm ON msgs_faq USING GIN (question gin_trgm_ops);
+
+CREATE INDEX msgs_faq_answer_trgm ON msgs_faq USING GIN (answer gin_trgm_ops);
+"""
+
+DROP_SQL = """
+DROP INDEX msgs_faq_label_ids;
+DROP INDEX msgs_faq_question_trgm;
+DROP INDEX msgs_faq_answer_trgm;
+"""
+
+
+def populate_label_ids(apps, schema_editor):
+    FAQ = apps.get_model("msgs", "FAQ")
+
+    for faq in FAQ.objects.filter(parent=None).prefetch_related("labels"):
+        label_ids = sorted(l.pk for l in faq.labels.all())
+        FAQ.objects.filter(models.Q(pk=faq.pk) | models.Q(parent=faq)).update(label_ids=label_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("msgs", "0070_text_search_indexes")]
+
+    operations = [
+        migrations.AddField(
+            model_name="faq",
+            name="label_ids",
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+        migrations.RunPython(populate_label_ids, migrations.RunPython.noop),
+        migrations.RunSQL(INDEX_SQL, DROP_SQL),
+    ]
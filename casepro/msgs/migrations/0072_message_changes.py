@@ -0,0 +1,162 @@
+# Generated by Django 4.2.30 on 2026-10-17 05:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+SQL = """
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts and record changes for inbox refreshes
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_on_change() RETURNS TRIGGER AS $$
+DECLARE
+  _inbox_delta INT;
+  _archived_delta INT;
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+
+    IF NOT msgs_is_inbox(OLD) AND msgs_is_inbox(NEW) THEN
+      _inbox_delta := 1;
+    ELSIF msgs_is_inbox(OLD) AND NOT msgs_is_inbox(NEW) THEN
+      _inbox_delta := -1;
+    ELSE
+      _inbox_delta := 0;
+    END IF;
+
+    IF NOT msgs_is_archived(OLD) AND msgs_is_archived(NEW) THEN
+      _archived_delta := 1;
+    ELSIF msgs_is_archived(OLD) AND NOT msgs_is_archived(NEW) THEN
+      _archived_delta := -1;
+    ELSE
+      _archived_delta := 0;
+    END IF;
+
+    IF _inbox_delta != 0 THEN
+      INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+      SELECT 'N', 'label:' || label_id, _inbox_delta, FALSE FROM msgs_message_labels WHERE message_id = NEW.id;
+    END IF;
+
+    IF _archived_delta != 0 THEN
+      INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+      SELECT 'A', 'label:' || label_id, _archived_delta, FALSE FROM msgs_message_labels WHERE message_id = NEW.id;
+    END IF;
+
+    -- ensure message fields on label m2m are in sync
+    UPDATE msgs_message_labels SET message_is_archived = NEW.is_archived, message_is_flagged = NEW.is_flagged WHERE message_id = NEW.id;
+
+    -- record changes to handled messages so that clients can refresh without scanning by modified_on
+    IF NEW.is_handled AND NEW.modified_on IS DISTINCT FROM OLD.modified_on THEN
+      INSERT INTO msgs_messagechange("org_id", "message_id", "kind", "created_on")
+      VALUES(NEW.org_id, NEW.id, CASE WHEN NOT OLD.is_handled THEN 'H' WHEN NOT NEW.is_active THEN 'D' ELSE 'U' END, NOW());
+    END IF;
+
+  ELSIF TG_OP = 'INSERT' AND NEW.is_handled THEN
+
+    -- messages can also be created as already handled
+    INSERT INTO msgs_messagechange("org_id", "message_id", "kind", "created_on") VALUES(NEW.org_id, NEW.id, 'H', NOW());
+
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS msgs_message_on_change_trg ON msgs_message;
+CREATE TRIGGER msgs_message_on_change_trg
+   AFTER INSERT OR UPDATE ON msgs_message
+   FOR EACH ROW EXECUTE PROCEDURE msgs_message_on_change();
+"""
+
+
+# restores the previous version of the trigger, which only maintained label counts
+REVERSE_SQL = """
+DROP TRIGGER IF EXISTS msgs_message_on_change_trg ON msgs_message;
+DROP FUNCTION IF EXISTS msgs_message_on_change();
+
+CREATE OR REPLACE FUNCTION msgs_message_on_change() RETURNS TRIGGER AS $$
+DECLARE
+  _inbox_delta INT;
+  _archived_delta INT;
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+
+    IF NOT msgs_is_inbox(OLD) AND msgs_is_inbox(NEW) THEN
+      _inbox_delta := 1;
+    ELSIF msgs_is_inbox(OLD) AND NOT msgs_is_inbox(NEW) THEN
+      _inbox_delta := -1;
+    ELSE
+      _inbox_delta := 0;
+    END IF;
+
+    IF NOT msgs_is_archived(OLD) AND msgs_is_archived(NEW) THEN
+      _archived_delta := 1;
+    ELSIF msgs_is_archived(OLD) AND NOT msgs_is_archived(NEW) THEN
+      _archived_delta := -1;
+    ELSE
+      _archived_delta := 0;
+    END IF;
+
+    IF _inbox_delta != 0 THEN
+      INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+      SELECT 'N', 'label:' || label_id, _inbox_delta, FALSE FROM msgs_message_labels WHERE message_id = NEW.id;
+    END IF;
+
+    IF _archived_delta != 0 THEN
+      INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+      SELECT 'A', 'label:' || label_id, _archived_delta, FALSE FROM msgs_message_labels WHERE message_id = NEW.id;
+    END IF;
+
+    -- ensure message fields on label m2m are in sync
+    UPDATE msgs_message_labels SET message_is_archived = NEW.is_archived, message_is_flagged = NEW.is_flagged WHERE message_id = NEW.id;
+
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER msgs_message_on_change_trg
+   AFTER UPDATE ON msgs_message
+   FOR EACH ROW EXECUTE PROCEDURE msgs_message_on_change();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orgs", "0032_rename_orgbackend_org_is_active_slug_orgs_orgbac_org_id_607508_idx"),
+        ("msgs", "0071_faq_label_ids"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageChange",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "kind",
+                    models.CharField(choices=[("H", "Handled"), ("U", "Updated"), ("D", "Deleted")], max_length=1),
+                ),
+                ("created_on", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="changes", to="msgs.message"
+                    ),
+                ),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, related_name="message_changes", to="orgs.org"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["org", "id"], name="msgs_messagechange_org_id"),
+                    models.Index(fields=["org", "created_on"], name="msgs_messagechange_org_created"),
+                ],
+            },
+        ),
+        migrations.RunSQL(SQL, REVERSE_SQL),
+    ]
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from datetime import timedelta
 from enum import Enum
 
@@ -5,19 +6,27 @@ from dash.orgs.models import Org
 from dash.utils import get_obj_cacheable
 from django_redis import get_redis_connection
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.expressions import ArraySubquery
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import TrigramWordSimilarity
 from django.core.exceptions import PermissionDenied
-from django.db import models
-from django.db.models import Index, Prefetch, Q
+from django.db import connection, models, transaction
+from django.db.models import Index, OuterRef, Prefetch, Q
+from django.db.models.expressions import RawSQL
 from django.utils.timesince import timesince
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 from casepro.contacts.models import Contact, Field
-from casepro.utils import get_language_name, json_encode
+from casepro.utils import decode_cursor, get_language_name, json_decode, json_encode
 from casepro.utils.export import BaseSearchExport
+from casepro.utils.push import case_scope, inbox_scope, label_scope, publish
 
 LABEL_LOCK_KEY = "lock:label:%d:%s"
+LABEL_ACCESS_KEY = "label-access:%d"  # hash of user ids to the ids of the labels they can access in an org
+LABEL_ACCESS_TTL = 60 * 60  # 1 hour
 MESSAGE_LOCK_KEY = "lock:message:%d:%d"
 MESSAGE_LOCK_SECONDS = 300
 
@@ -71,11 +80,56 @@ class Label(models.Model):
     @classmethod
     def get_all(cls, org, user=None):
         if user:
+            return org.labels.filter(is_active=True, pk__in=cls.get_accessible_ids(org, user))
+
+        return org.labels.filter(is_active=True)
+
+    @classmethod
+    def get_accessible_ids(cls, org, user):
+        """
+        Gets the ids of the active labels which the given user can access. These are memoized on the user object for the
+        rest of the request, and cached in Redis across requests until the org's labels or partners change.
+        """
+
+        def calculate():
+            r = get_redis_connection()
+            key = LABEL_ACCESS_KEY % org.pk
+
+            cached = r.hget(key, user.pk)
+            if cached is not None:
+                return set(json_decode(cached))
+
             user_partner = user.get_partner(org)
             if user_partner and user_partner.is_restricted:
-                return user_partner.get_labels()
+                labels = user_partner.labels.filter(is_active=True)
+            else:
+                labels = org.labels.filter(is_active=True)
 
-        return org.labels.filter(is_active=True)
+            label_ids = set(labels.values_list("pk", flat=True))
+
+            with r.pipeline() as pipe:
+                pipe.hset(key, user.pk, json_encode(sorted(label_ids)))
+                pipe.expire(key, LABEL_ACCESS_TTL)
+                pipe.execute()
+
+            return label_ids
+
+        return get_obj_cacheable(user, "_accessible_label_ids_%d" % org.pk, calculate)
+
+    @classmethod
+    def clear_accessible_ids(cls, *org_ids):
+        """
+        Clears the cached accessible label ids of all users in the given orgs. This is done again once the current
+        transaction commits, in case another request cached the old ids in the meantime.
+        """
+        if not org_ids:
+            return
+
+        def clear():
+            get_redis_connection().delete(*[LABEL_ACCESS_KEY % org_id for org_id in org_ids])
+
+        clear()
+        transaction.on_commit(clear)
 
     def update_tests(self, tests):
         from casepro.rules.models import LabelAction, Rule
@@ -193,6 +247,11 @@ class FAQ(models.Model):
 
     labels = models.ManyToManyField(Label, help_text=_("Labels assigned to this FAQ"), related_name="faqs")
 
+    # denormalized ids of this FAQ's labels, or of its parent's labels if it's a translation
+    label_ids = ArrayField(models.IntegerField(), default=list)
+
+    SEARCH_LIMIT = 100
+
     @classmethod
     def create(cls, org, question, answer, language, parent, labels=(), **kwargs):
         """
@@ -206,9 +265,9 @@ class FAQ(models.Model):
         return faq
 
     @classmethod
-    def search(cls, org, user, search):
+    def search(cls, org, user, search, limit=None):
         """
-        Search for FAQs
+        Search for FAQs, ordered by how well the question matches the search text
         """
         language = search.get("language")
         label_id = search.get("label")
@@ -221,25 +280,34 @@ class FAQ(models.Model):
             queryset = queryset.filter(language=language)
 
         # Label filtering
-        labels = Label.get_all(org, user)
+        label_ids = Label.get_accessible_ids(org, user)
 
         if label_id:
-            labels = labels.filter(pk=label_id)
-        else:
-            # if not filtering by a single label, need distinct to avoid duplicates
-            queryset = queryset.distinct()
+            label_ids = label_ids & {int(label_id)}
 
-        queryset = queryset.filter(Q(labels__in=list(labels)) | Q(parent__labels__in=list(labels)))
+        queryset = queryset.filter(label_ids__overlap=list(label_ids))
 
         # Text filtering
         if text:
             queryset = queryset.filter(Q(question__icontains=text) | Q(answer__icontains=text))
+            queryset = queryset.annotate(rank=TrigramWordSimilarity(text, "question")).order_by("-rank", "question")
+        else:
+            queryset = queryset.order_by("question")
 
         queryset = queryset.prefetch_related(
             Prefetch("labels", Label.objects.filter(is_active=True).order_by("id")), "parent__labels"
         )
 
-        return queryset.order_by("question")
+        return queryset[:limit] if limit else queryset
+
+    @classmethod
+    def update_label_ids(cls, faq_ids):
+        """
+        Updates the denormalized label ids of the given FAQs and of their translations
+        """
+        for faq in cls.objects.filter(pk__in=faq_ids, parent=None).prefetch_related("labels"):
+            faq.label_ids = sorted(l.pk for l in faq.labels.all())
+            cls.objects.filter(Q(pk=faq.pk) | Q(parent=faq)).update(label_ids=faq.label_ids)
 
     @classmethod
     def get_all(cls, org, label=None):
@@ -315,6 +383,53 @@ class Labelling(models.Model):
             message_is_archived=message.is_archived,
         )
 
+    @classmethod
+    def get_latest_message_ids(cls, labels, filters, limit, before=None):
+        """
+        Gets a subquery for the ids of the latest handled messages with any of the given labels. This does a merge of
+        the most recent labellings of each label, which can be fetched from the partial indexes below, rather than
+        sorting every labelling of those labels. Messages are checked inside each label's subquery so that unhandled
+        or deleted messages don't take up any of its limit.
+
+        :param labels: the labels
+        :param filters: dict of is_archived, is_flagged, created_on__gt or created_on__lt values
+        :param limit: the maximum number of message ids
+        :param before: the (created_on, id) of the last message of the previous page, if any
+        """
+        conditions = {
+            "is_archived": 'ml."message_is_archived" = %s',
+            "is_flagged": 'ml."message_is_flagged" = %s',
+            "created_on__gt": 'ml."message_created_on" > %s',
+            "created_on__lt": 'ml."message_created_on" < %s',
+        }
+
+        # boolean conditions are written as literals so that they always match the conditions of the partial indexes
+        where, where_params = "", []
+        for key, value in filters.items():
+            if isinstance(value, bool):
+                where += " AND " + conditions[key] % ("TRUE" if value else "FALSE")
+            else:
+                where += " AND " + conditions[key]
+                where_params.append(value)
+
+        # seek past the previous page, with the non-strict inequality on the time alone letting this use the indexes
+        if before:
+            where += ' AND ml."message_created_on" <= %s AND (ml."message_created_on", ml."message_id") < (%s, %s)'
+            where_params += [before[0], *before]
+
+        sql = f"""
+        SELECT l."message_id" FROM unnest(%s::int[]) AS lbl("id")
+        CROSS JOIN LATERAL (
+            SELECT ml."message_id", ml."message_created_on" FROM "msgs_message_labels" ml
+            INNER JOIN "msgs_message" m ON m."id" = ml."message_id"
+            WHERE ml."label_id" = lbl."id" AND m."is_handled" = TRUE AND m."is_active" = TRUE{where}
+            ORDER BY ml."message_created_on" DESC, ml."message_id" DESC LIMIT %s
+        ) l
+        GROUP BY l."message_id" ORDER BY MAX(l."message_created_on") DESC, l."message_id" DESC LIMIT %s"""
+
+        params = [[label.id for label in labels], *where_params, limit, limit]
+        return RawSQL(sql, params)
+
     class Meta:
         db_table = "msgs_message_labels"
         unique_together = ("message", "label")
@@ -355,7 +470,7 @@ class Message(models.Model):
 
     TIMELINE_TYPE = "I"
 
-    SEARCH_BY_TEXT_DAYS = 90
+    SEARCH_BY_LABEL_LIMIT = 1000
 
     org = models.ForeignKey(Org, related_name="incoming_messages", on_delete=models.PROTECT)
 
@@ -409,9 +524,14 @@ class Message(models.Model):
         return get_redis_connection().lock(MESSAGE_LOCK_KEY % (org.pk, backend_id), timeout=60)
 
     @classmethod
-    def search(cls, org, user, search, modified_after=None, all=False):
+    def search(cls, org, user, search, modified_after=None, changed_since=None, all=False, limit=None, cursor=None):
         """
         Search for messages
+
+        :param modified_after: only include messages modified after this time
+        :param changed_since: only include messages changed since this change sequence number
+        :param limit: the number of messages the caller actually needs, if known, e.g. the end of the requested page
+        :param cursor: the cursor of the previous page, which callers must still paginate by, if known
         """
         folder = search.get("folder")
         label_id = search.get("label")
@@ -431,9 +551,14 @@ class Message(models.Model):
         lbl_filtering = {}
         ordering = ("-created_on",)
 
+        is_refresh = modified_after or changed_since is not None
+
         # if this is a refresh we want everything with new actions and locks
-        if modified_after:
-            msg_filtering["modified_on__gt"] = modified_after
+        if is_refresh:
+            if changed_since is not None:
+                msg_filtering["id__in"] = MessageChange.get_message_ids(org, changed_since)
+            else:
+                msg_filtering["modified_on__gt"] = modified_after
 
             # these are sorted by the UI again so we use the optimal ordering for the index here
             ordering = ("-modified_on", "-created_on")
@@ -450,10 +575,11 @@ class Message(models.Model):
 
         if text:
             msg_filtering["text__icontains"] = text
-            msg_filtering["created_on__gt"] = now() - timedelta(days=cls.SEARCH_BY_TEXT_DAYS)
+            if settings.SITE_SEARCH_BY_TEXT_DAYS:
+                msg_filtering["created_on__gt"] = now() - timedelta(days=settings.SITE_SEARCH_BY_TEXT_DAYS)
         if contact_id:
             msg_filtering["contact__id"] = contact_id
-        if after and not modified_after:
+        if after and not is_refresh:
             lbl_filtering["created_on__gt"] = after
         if before:
             lbl_filtering["created_on__lt"] = before
@@ -479,15 +605,10 @@ class Message(models.Model):
 
         # if we're only filtering on things on the labelling table..
         if not msg_filtering and not all:
-            lbl_filtering = {f"message_{k}": v for k, v in lbl_filtering.items()}
-            message_ids = set()
-
-            for label in labels:
-                message_ids.update(
-                    Labelling.objects.filter(label=label, **lbl_filtering)
-                    .order_by("-message_created_on")
-                    .values_list("message_id", flat=True)[:1000]
-                )
+            before = decode_cursor(cursor) if cursor else None
+            message_ids = Labelling.get_latest_message_ids(
+                labels, lbl_filtering, limit or cls.SEARCH_BY_LABEL_LIMIT, before=before
+            )
 
             return Message.objects.filter(id__in=message_ids, is_handled=True).order_by("-created_on")
 
@@ -525,47 +646,86 @@ class Message(models.Model):
         """
         Adds the given labels to this message
         """
+        Message.label_messages(self.org, [self], labels)
+
+    @classmethod
+    def label_messages(cls, org, messages, labels):
+        """
+        Adds the given labels to the given messages locally (i.e. without syncing with the backend or recording an
+        action), using a fixed number of queries regardless of the number of messages
+        """
         from casepro.profiles.models import Notification
         from casepro.statistics.models import DailyCount, datetime_to_date
 
-        existing_label_ids = Labelling.objects.filter(message=self, label__in=labels).values_list("label", flat=True)
-        add_labels = [l for l in labels if l.id not in existing_label_ids]
-        new_labellings = [Labelling.create(l, self) for l in add_labels]
-        Labelling.objects.bulk_create(new_labellings)
+        messages = list({m.id: m for m in messages}.values())
+        labels = list({l.id: l for l in labels}.values())
+        if not messages or not labels:
+            return
+
+        existing = set(
+            Labelling.objects.filter(message__in=messages, label__in=labels).values_list("message_id", "label_id")
+        )
+
+        new_labellings = []
+        new_counts = defaultdict(int)
+        for msg in messages:
+            day = datetime_to_date(msg.created_on, org)
+            for label in labels:
+                if (msg.id, label.id) not in existing:
+                    new_labellings.append(Labelling.create(label, msg))
+                    new_counts[(day, (label,))] += 1
+
+        Labelling.objects.bulk_create(new_labellings, ignore_conflicts=True)
 
-        day = datetime_to_date(self.created_on, self.org)
-        for label in add_labels:
-            DailyCount.record_item(day, DailyCount.TYPE_INCOMING, label)
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, new_counts)
 
         # notify all users who watch these labels
-        for watcher in set(User.objects.filter(watched_labels__in=labels)):
-            Notification.new_message_labelling(self.org, watcher, self)
+        watchers = set(User.objects.filter(watched_labels__in=labels))
+        if watchers:
+            Notification.bulk_new_message_labelling(org, watchers, messages)
 
     def unlabel(self, *labels):
         """
         Removes the given labels from this message
         """
-        from casepro.statistics.models import DailyCount, datetime_to_date
-
-        existing_labellings = Labelling.objects.filter(message=self, label__in=labels).select_related("label")
-
-        day = datetime_to_date(self.created_on, self.org)
-        for labelling in existing_labellings:
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, labelling.label)
-
-        Labelling.objects.filter(id__in=[l.id for l in existing_labellings]).delete()
+        Message.unlabel_messages(self.org, [self], labels)
 
     def clear_labels(self):
         """
         Removes all labels from this message
         """
+        Message.unlabel_messages(self.org, [self])
+
+    @classmethod
+    def unlabel_messages(cls, org, messages, labels=None):
+        """
+        Removes the given labels (or all labels if none are specified) from the given messages locally (i.e. without
+        syncing with the backend or recording an action), using a fixed number of queries regardless of the number of
+        messages
+        """
         from casepro.statistics.models import DailyCount, datetime_to_date
 
-        day = datetime_to_date(self.created_on, self.org)
-        for label in self.labels.all():
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, label)
+        message_ids = list({m.id for m in messages})
+        if not message_ids or (labels is not None and not labels):
+            return
+
+        sql = f'DELETE FROM {Labelling._meta.db_table} WHERE "message_id" = ANY(%s)'
+        params = [message_ids]
+        if labels is not None:
+            sql += ' AND "label_id" = ANY(%s)'
+            params.append(list({l.id for l in labels}))
+        sql += ' RETURNING "label_id", "message_created_on"'
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            removed = cursor.fetchall()
+
+        # record removals as a single negative count per day and label
+        removed_counts = defaultdict(int)
+        for label_id, message_created_on in removed:
+            removed_counts[(datetime_to_date(message_created_on, org), (Label(pk=label_id),))] -= 1
 
-        Labelling.objects.filter(message=self).delete()
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, removed_counts)
 
     def update_labels(self, user, labels):
         """
@@ -612,6 +772,8 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.FLAG)
 
+            Message.publish_changes(org, messages)
+
     @staticmethod
     def bulk_unflag(org, user, messages):
         messages = list(messages)
@@ -624,12 +786,13 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.UNFLAG)
 
+            Message.publish_changes(org, messages)
+
     @staticmethod
     def bulk_label(org, user, messages, label):
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.label(label)
+            Message.label_messages(org, messages, [label])
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
@@ -638,12 +801,13 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.LABEL, label)
 
+            Message.publish_changes(org, messages, labels=[label])
+
     @staticmethod
     def bulk_unlabel(org, user, messages, label):
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.unlabel(label)
+            Message.unlabel_messages(org, messages, [label])
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
@@ -652,6 +816,8 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.UNLABEL, label)
 
+            Message.publish_changes(org, messages, labels=[label])
+
     @staticmethod
     def bulk_archive(org, user, messages):
         messages = list(messages)
@@ -664,6 +830,8 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.ARCHIVE)
 
+            Message.publish_changes(org, messages)
+
     @staticmethod
     def bulk_restore(org, user, messages):
         messages = list(messages)
@@ -676,6 +844,19 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.RESTORE)
 
+            Message.publish_changes(org, messages)
+
+    @staticmethod
+    def publish_changes(org, messages, labels=()):
+        """
+        Publishes changes to the given messages to the org's inbox and to the inboxes of their labels, so that users who
+        can only see some labels aren't woken by changes to messages they can't see
+        """
+        label_ids = set(Labelling.objects.filter(message__in=messages).values_list("label_id", flat=True))
+        label_ids.update(label.id for label in labels)
+
+        publish(inbox_scope(org), *[label_scope(label_id) for label_id in sorted(label_ids)])
+
     def as_json(self):
         """
         Prepares this message for JSON serialization
@@ -696,6 +877,65 @@ class Message(models.Model):
         return self.text if self.text else self.pk
 
 
+class MessageChange(models.Model):
+    """
+    A change to a handled message which clients refreshing their inbox need to know about. These are written by the
+    msgs_message_on_change trigger whenever a message's modified_on changes, and their ids serve as a sequence which
+    clients can request changes since.
+    """
+
+    KIND_HANDLED = "H"  # message was handled and so can now appear in the inbox
+    KIND_UPDATED = "U"  # message was labelled, flagged, archived, locked etc
+    KIND_DELETED = "D"  # message was deleted
+
+    KIND_CHOICES = ((KIND_HANDLED, _("Handled")), (KIND_UPDATED, _("Updated")), (KIND_DELETED, _("Deleted")))
+
+    # change ids are taken when rows are written but transactions may commit out of that order, so refreshes also
+    # re-read recent changes below the client's sequence number which may not have been committed when it last read
+    REFRESH_OVERLAP = timedelta(minutes=5)
+
+    TRIM_AFTER = timedelta(days=1)
+
+    id = models.BigAutoField(primary_key=True)
+
+    org = models.ForeignKey(Org, related_name="message_changes", on_delete=models.PROTECT)
+
+    message = models.ForeignKey(Message, related_name="changes", on_delete=models.CASCADE)
+
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+
+    created_on = models.DateTimeField(default=now)
+
+    @classmethod
+    def get_last_seq(cls, org):
+        """
+        Gets the sequence number of the latest change in the given org, which clients can use for their next refresh
+        """
+        last = cls.objects.filter(org=org).order_by("-id").values_list("id", flat=True).first()
+        return last or 0
+
+    @classmethod
+    def get_message_ids(cls, org, since_seq):
+        """
+        Gets the ids of messages changed since the given sequence number, as a queryset to be used as a subquery
+        """
+        recent = Q(id__gt=since_seq) | Q(created_on__gte=now() - cls.REFRESH_OVERLAP)
+        return cls.objects.filter(recent, org=org).values("message_id")
+
+    @classmethod
+    def trim(cls):
+        """
+        Deletes changes too old to be of use to refreshing clients
+        """
+        return cls.objects.filter(created_on__lt=now() - cls.TRIM_AFTER).delete()[0]
+
+    class Meta:
+        indexes = (
+            Index(name="msgs_messagechange_org_id", fields=("org", "id")),
+            Index(name="msgs_messagechange_org_created", fields=("org", "created_on")),
+        )
+
+
 class MessageAction(models.Model):
     """
     An action performed on a set of messages
@@ -761,8 +1001,6 @@ class Outgoing(models.Model):
 
     TIMELINE_TYPE = "O"
 
-    SEARCH_BY_TEXT_DAYS = 90
-
     org = models.ForeignKey(Org, related_name="outgoing_messages", on_delete=models.PROTECT)
 
     partner = models.ForeignKey("cases.Partner", null=True, related_name="outgoing_messages", on_delete=models.PROTECT)
@@ -842,6 +1080,9 @@ class Outgoing(models.Model):
         if push:
             org.get_backend().push_outgoing(org, [msg])
 
+        if case:
+            publish(case_scope(case))
+
         return msg
 
     @classmethod
@@ -860,9 +1101,9 @@ class Outgoing(models.Model):
             queryset = queryset.filter(partner=partner)
 
         if text:
-            queryset = queryset.filter(
-                text__icontains=text, created_on__gt=now() - timedelta(days=cls.SEARCH_BY_TEXT_DAYS)
-            )
+            queryset = queryset.filter(text__icontains=text)
+            if settings.SITE_SEARCH_BY_TEXT_DAYS:
+                queryset = queryset.filter(created_on__gt=now() - timedelta(days=settings.SITE_SEARCH_BY_TEXT_DAYS))
 
         if contact_id:
             queryset = queryset.filter(contact__pk=contact_id)
@@ -940,47 +1181,45 @@ class MessageExport(BaseSearchExport):
         search["folder"] = MessageFolder[search["folder"]]
         return search
 
-    def render_search(self, book, search):
+    def get_headers(self):
         from casepro.contacts.models import Field
 
         base_fields = ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact"]
-        contact_fields = Field.get_all(self.org, visible=True)
-        all_fields = base_fields + [f.label for f in contact_fields]
+        return base_fields + [f.label for f in Field.get_all(self.org, visible=True)]
 
-        # load all messages to be exported
-        items = Message.search(self.org, self.created_by, search, all=True).prefetch_related(
-            "contact", "labels", "case__assignee", "case__user_assignee"
-        )
+    def get_sheet_name(self, num):
+        return str(_("Messages %d" % num))
 
-        def add_sheet(num):
-            sheet = book.add_sheet(str(_("Messages %d" % num)))
-            self.write_row(sheet, 0, all_fields)
-            return sheet
+    def get_rows(self, search):
+        contact_fields = Field.get_all(self.org, visible=True)
+        field_columns = self.get_contact_field_columns(contact_fields)
 
-        sheet = None
-        sheet_number = 0
-        row = 1
-        for item in items:
-            if not sheet or row > self.MAX_SHEET_ROWS:
-                sheet_number += 1
-                sheet = add_sheet(sheet_number)
-                row = 1
+        # iterate over tuples of values for the messages to be exported, in chunks
+        items = Message.search(self.org, self.created_by, search, all=True)
+        items = items.annotate(
+            label_names=ArraySubquery(
+                Labelling.objects.filter(message=OuterRef("pk")).order_by("label_id").values("label__name")
+            ),
+            **field_columns,
+        )
+        items = items.values_list(
+            "created_on", "backend_id", "is_flagged", "label_names", "text", "contact__uuid", *field_columns.keys()
+        )
 
+        for created_on, backend_id, is_flagged, label_names, text, contact_uuid, *fields in items.iterator(
+            chunk_size=self.CHUNK_SIZE
+        ):
             values = [
-                item.created_on,
-                item.backend_id,
-                item.is_flagged,
-                ", ".join([l.name for l in item.labels.all()]),
-                item.text[:32767],  # can't save cell content longer than this limit
-                item.contact.uuid,
+                created_on,
+                backend_id,
+                is_flagged,
+                ", ".join(label_names),
+                text[:32767],  # can't save cell content longer than this limit
+                contact_uuid,
             ]
+            values += [v if v is not None else "" for v in fields]
 
-            fields = item.contact.get_fields()
-            for field in contact_fields:
-                values.append(fields.get(field.key, ""))
-
-            self.write_row(sheet, row, values)
-            row += 1
+            yield values
 
 
 class ReplyExport(BaseSearchExport):
@@ -991,7 +1230,7 @@ class ReplyExport(BaseSearchExport):
     directory = "reply_exports"
     download_view = "msgs.replyexport_read"
 
-    def render_search(self, book, search):
+    def get_headers(self):
         base_fields = [
             "Sent On",
             "User",
@@ -1003,41 +1242,59 @@ class ReplyExport(BaseSearchExport):
             "Labels",
             "Contact",
         ]
-        contact_fields = Field.get_all(self.org, visible=True)
-        all_fields = base_fields + [f.label for f in contact_fields]
+        return base_fields + [f.label for f in Field.get_all(self.org, visible=True)]
 
-        # load all messages to be exported
-        items = Outgoing.search_replies(self.org, self.created_by, search)
+    def get_sheet_name(self, num):
+        return str(_("Replies %d" % num))
 
-        def add_sheet(num):
-            sheet = book.add_sheet(str(_("Replies %d" % num)))
-            self.write_row(sheet, 0, all_fields)
-            return sheet
+    def get_rows(self, search):
+        contact_fields = Field.get_all(self.org, visible=True)
+        field_columns = self.get_contact_field_columns(contact_fields)
 
-        sheet = None
-        sheet_number = 0
-        row = 1
-        for item in items:
-            if not sheet or row > self.MAX_SHEET_ROWS:
-                sheet_number += 1
-                sheet = add_sheet(sheet_number)
-                row = 1
+        # iterate over tuples of values for the replies to be exported, in chunks
+        items = Outgoing.search_replies(self.org, self.created_by, search).prefetch_related(None)
+        items = items.annotate(
+            label_names=ArraySubquery(
+                Labelling.objects.filter(message=OuterRef("reply_to")).order_by("label_id").values("label__name")
+            ),
+            **field_columns,
+        )
+        items = items.values_list(
+            "created_on",
+            "created_by__email",
+            "text",
+            "reply_to__created_on",
+            "reply_to__text",
+            "reply_to__is_flagged",
+            "case__assignee__name",
+            "label_names",
+            "contact__uuid",
+            *field_columns.keys(),
+        )
 
+        for (
+            created_on,
+            created_by_email,
+            text,
+            reply_to_created_on,
+            reply_to_text,
+            reply_to_is_flagged,
+            case_assignee_name,
+            label_names,
+            contact_uuid,
+            *fields,
+        ) in items.iterator(chunk_size=self.CHUNK_SIZE):
             values = [
-                item.created_on,
-                item.created_by.email,
-                item.text,
-                timesince(item.reply_to.created_on, now=item.created_on),
-                item.reply_to.text,
-                item.reply_to.is_flagged,
-                item.case.assignee.name if item.case else "",
-                ", ".join([l.name for l in item.reply_to.labels.all()]),
-                item.contact.uuid,
+                created_on,
+                created_by_email,
+                text,
+                timesince(reply_to_created_on, now=created_on),
+                reply_to_text,
+                reply_to_is_flagged,
+                case_assignee_name or "",
+                ", ".join(label_names),
+                contact_uuid,
             ]
+            values += [v if v is not None else "" for v in fields]
 
-            fields = item.contact.get_fields()
-            for field in contact_fields:
-                values.append(fields.get(field.key, ""))
-
-            self.write_row(sheet, row, values)
-            row += 1
+            yield values
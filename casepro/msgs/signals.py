@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save, pre_save
+from dash.orgs.models import Org
+
+from django.db.models.signals import m2m_changed, post_save, pre_save
 from django.dispatch import receiver
 
-from .models import Label, Message
+from casepro.cases.models import Partner
+
+from .models import FAQ, Label, Message
 
 
 @receiver(post_save, sender=Label)
@@ -10,6 +14,82 @@ def update_label_uuid(sender, instance, **kwargs):
         instance.org.get_backend().push_label(instance.org, instance)
 
 
+@receiver(post_save, sender=Label)
+@receiver(post_save, sender=Partner)
+def clear_label_access_on_save(sender, instance, **kwargs):
+    """
+    Save signal handler to clear cached label access when a label or partner is created, activated or deactivated etc
+    """
+    Label.clear_accessible_ids(instance.org_id)
+
+
+@receiver(m2m_changed, sender=Partner.labels.through)
+def clear_label_access_on_partner_labels(sender, instance, action, **kwargs):
+    """
+    Signal handler to clear cached label access when the labels of a partner change (instance is a partner or a label)
+    """
+    if action in ("post_add", "post_remove", "post_clear"):
+        Label.clear_accessible_ids(instance.org_id)
+
+
+@receiver(m2m_changed, sender=Partner.users.through)
+def clear_label_access_on_partner_users(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal handler to clear cached label access when users are added to or removed from partners
+    """
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            Label.clear_accessible_ids(instance.org_id)
+    elif action in ("post_add", "post_remove"):
+        Label.clear_accessible_ids(*set(Partner.objects.filter(pk__in=pk_set).values_list("org_id", flat=True)))
+    elif action == "pre_clear":
+        Label.clear_accessible_ids(*set(instance.partners.values_list("org_id", flat=True)))
+
+
+@receiver(m2m_changed, sender=Org.administrators.through)
+@receiver(m2m_changed, sender=Org.editors.through)
+@receiver(m2m_changed, sender=Org.viewers.through)
+def clear_label_access_on_org_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal handler to clear cached label access when users' roles in orgs change
+    """
+    if action in ("post_add", "post_remove"):
+        Label.clear_accessible_ids(*(pk_set if reverse else {instance.pk}))
+    elif action == "post_clear" and not reverse:
+        Label.clear_accessible_ids(instance.pk)
+    elif action == "pre_clear" and reverse:
+        # instance is a user whose roles are being cleared, so we need their orgs before they're gone
+        Label.clear_accessible_ids(*set(sender.objects.filter(user=instance).values_list("org_id", flat=True)))
+
+
+@receiver(pre_save, sender=FAQ)
+def update_faq_label_ids(sender, instance, **kwargs):
+    """
+    Save signal handler to keep the denormalized label ids of a FAQ in sync with its parent
+    """
+    if instance.parent_id:
+        instance.label_ids = FAQ.objects.get(pk=instance.parent_id).label_ids
+    elif instance.pk:
+        instance.label_ids = sorted(instance.labels.values_list("pk", flat=True))
+
+
+@receiver(m2m_changed, sender=FAQ.labels.through)
+def update_faq_labels(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal handler to update the denormalized label ids of FAQs when their labels are changed
+    """
+    if reverse:
+        # labels can also be changed from the label side, in which case pk_set contains the FAQ ids
+        if action == "pre_clear":
+            instance._cleared_faq_ids = list(instance.faqs.values_list("pk", flat=True))
+        elif action == "post_clear":
+            FAQ.update_label_ids(instance.__dict__.pop("_cleared_faq_ids", []))
+        elif action in ("post_add", "post_remove"):
+            FAQ.update_label_ids(pk_set)
+    elif action in ("post_add", "post_remove", "post_clear"):
+        FAQ.update_label_ids([instance.pk])
+
+
 @receiver(pre_save, sender=Message)
 def update_message_contact(sender, instance, **kwargs):
     from casepro.contacts.models import Contact
@@ -1,5 +1,8 @@
 import csv
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import iso8601
@@ -10,22 +13,24 @@ from dash.orgs.tasks import org_task
 from smartmin.csv_imports.models import ImportTask
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils import timezone
 
 from casepro.cases.models import Case
+from casepro.contacts.models import Contact
 from casepro.profiles.models import Notification
-from casepro.rules.models import Rule
+from casepro.rules.models import Rule, RuleSet
 from casepro.utils import parse_csv
 
-from .models import FAQ, Label, Message, MessageAction, MessageExport, Outgoing, ReplyExport
+from .models import FAQ, Label, Message, MessageAction, MessageChange, MessageExport, Outgoing, ReplyExport
 
 logger = get_task_logger(__name__)
 
 TRIM_TASK_MAX_SECONDS = 8 * 60 * 60  # 8 hours
+STUB_CONTACTS_PULL_LIMIT = 100  # max number of stub contacts to pull after each message pull
 
 
-@org_task("message-pull", lock_timeout=2 * 60 * 60)
+@org_task("message-pull", lock_timeout=settings.ORG_TASK_LOCK_TIMEOUTS["message-pull"])
 def pull_messages(org, since, until, prev_results):
     """
     Pulls new unsolicited messages for an org
@@ -67,72 +72,184 @@ def pull_messages(org, since, until, prev_results):
     else:
         msgs_results["until"] = until.isoformat()
 
+    # messages from stub contacts can't be handled, so pull those contacts now rather than waiting for a contact pull
+    stubs = Contact.get_stubs_with_unhandled(org).values_list("uuid", flat=True)
+    stub_uuids = list(stubs[:STUB_CONTACTS_PULL_LIMIT])
+    stubs_pulled, stubs_released = 0, 0
+    if stub_uuids:
+        try:
+            _, stubs_pulled, stubs_released, _ = backend.pull_contacts_by_uuid(org, stub_uuids)
+        except Exception:
+            logger.error(f"Unable to pull stub contacts for org #{org.id}", exc_info=True)
+
     return {
         "labels": {"created": labels_created, "updated": labels_updated, "deleted": labels_deleted},
         "messages": msgs_results,
+        "stubs": {"pulled": stubs_pulled, "released": stubs_released},
     }
 
 
-@org_task("message-handle", lock_timeout=12 * 60 * 60)
+@org_task("message-handle", lock_timeout=settings.ORG_TASK_LOCK_TIMEOUTS["message-handle"])
 def handle_messages(org):
-    backend = org.get_backend()
+    start = time.perf_counter()
 
-    case_replies = []
-    num_rules_matched = 0
-    ignored_with_ticket = 0
-
-    # fetch all unhandled messages who now have full contacts
+    # fetch ids of all unhandled messages who now have full contacts, and split them into batches
     unhandled = Message.get_unhandled(org).filter(contact__is_stub=False)
-    unhandled = list(unhandled.select_related("contact").prefetch_related("contact__groups"))
+    unhandled = unhandled.order_by("contact_id", "created_on", "pk").values_list("contact_id", "pk")
+    batches = batch_by_contact(unhandled, settings.HANDLE_MESSAGES_BATCH_SIZE)
+
+    results = {"handled": 0, "rules_matched": 0, "case_replies": 0, "ignored_with_ticket": 0}
+    timings = {"fetch": round(time.perf_counter() - start, 3)}
+
+    def merge(batch_results):
+        batch_timings = batch_results.pop("timings")
+        for key, value in batch_results.items():
+            results[key] += value
+        for phase, duration in batch_timings.items():
+            timings[phase] = round(timings.get(phase, 0) + duration, 3)
+
+    if settings.HANDLE_MESSAGES_WORKERS > 1 and len(batches) > 1:
+        thread_local = threading.local()
+
+        def handle_in_thread(batch):
+            # each worker thread loads its own org and rules as model instances aren't safe to share between threads
+            if not hasattr(thread_local, "org"):
+                thread_local.org = Org.objects.get(pk=org.pk)
+                thread_local.rule_set = RuleSet(Rule.get_all(thread_local.org))
+
+            return handle_message_batch(thread_local.org, batch, rule_set=thread_local.rule_set, close_db=True)
+
+        with ThreadPoolExecutor(max_workers=settings.HANDLE_MESSAGES_WORKERS) as executor:
+            futures = [executor.submit(handle_in_thread, b) for b in batches]
+
+        # let every batch finish before re-raising the first failure, so one bad batch doesn't stop the others
+        errors = []
+        for future in futures:
+            try:
+                merge(future.result())
+            except Exception as e:
+                logger.error(f"Failed to handle message batch for org #{org.id}", exc_info=True)
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+    else:
+        for batch in batches:
+            merge(handle_message_batch(org, batch))
+
+    return {**results, "timings": timings}
+
+
+def batch_by_contact(rows, batch_size):
+    """
+    Splits (contact_id, message_id) rows, ordered by contact, into batches of message ids of roughly the given size,
+    without splitting any contact's messages across batches so that they are always handled together and in order
+    """
+    batches = []
+    batch = []
+    last_contact_id = None
+
+    for contact_id, message_id in rows:
+        if len(batch) >= batch_size and contact_id != last_contact_id:
+            batches.append(batch)
+            batch = []
+
+        batch.append(message_id)
+        last_contact_id = contact_id
+
+    if batch:
+        batches.append(batch)
+
+    return batches
 
-    if unhandled:
-        rules = Rule.get_all(org)
-        rule_processor = Rule.BatchProcessor(org, rules)
 
-        for msg in unhandled:
-            open_case = Case.get_open_for_contact_on(org, msg.contact, msg.created_on)
-            has_ticket = msg.contact.has_rapidpro_ticket()
+def handle_message_batch(org, message_ids, rule_set=None, close_db=False):
+    """
+    Handles a batch of unhandled messages, i.e. adds them to open cases as replies or applies rules to them
+    """
+    try:
+        backend = org.get_backend()
+
+        case_replies = []
+        num_rules_matched = 0
+        ignored_with_ticket = 0
+        timings = {}
+        phase_start = time.perf_counter()
+
+        def end_phase(name):
+            nonlocal phase_start
+            now = time.perf_counter()
+            timings[name] = now - phase_start
+            phase_start = now
+
+        messages = Message.objects.filter(pk__in=message_ids).order_by("contact_id", "created_on", "pk")
+        messages = list(messages.select_related("contact").prefetch_related("contact__groups"))
+        end_phase("fetch")
+
+        rule_processor = Rule.BatchProcessor(org, rule_set or RuleSet.get_for_org(org))
+        open_cases = Case.get_open_for_messages(org, messages)
+        end_phase("load")
+
+        for msg in messages:
+            open_case = open_cases.get(msg.id)
 
             # only apply rules if there isn't a currently open case for this contact or open ticket in RapidPro
             if open_case:
-                open_case.add_reply(msg)
-
-                case_replies.append(msg)
-            elif has_ticket:
+                case_replies.append((open_case, msg))
+            elif msg.contact.has_rapidpro_ticket():
                 ignored_with_ticket += 1
             else:
                 rules_matched, actions_deferred = rule_processor.include_messages(msg)
                 num_rules_matched += rules_matched
+        end_phase("match")
 
-        # archive messages which are case replies on the backend
         if case_replies:
-            backend.archive_messages(org, case_replies)
+            Case.add_replies(org, case_replies)
+
+            # archive messages which are case replies on the backend
+            backend.archive_messages(org, [msg for case, msg in case_replies])
+        end_phase("replies")
 
         rule_processor.apply_actions()
+        end_phase("actions")
 
         # mark all of these messages as handled
-        Message.objects.filter(pk__in=[m.pk for m in unhandled]).update(is_handled=True, modified_on=timezone.now())
+        Message.objects.filter(pk__in=message_ids).update(is_handled=True, modified_on=timezone.now())
+        end_phase("mark")
 
-    return {
-        "handled": len(unhandled),
-        "rules_matched": num_rules_matched,
-        "case_replies": len(case_replies),
-        "ignored_with_ticket": ignored_with_ticket,
-    }
+        Message.publish_changes(org, messages)
+
+        return {
+            "handled": len(messages),
+            "rules_matched": num_rules_matched,
+            "case_replies": len(case_replies),
+            "ignored_with_ticket": ignored_with_ticket,
+            "timings": timings,
+        }
+    finally:
+        # batches handled in worker threads each get their own database connection which needs closed
+        if close_db:
+            connection.close()
 
 
 @shared_task
 def message_export(export_id):
     logger.info("Starting message export #%d..." % export_id)
 
-    MessageExport.objects.get(pk=export_id).do_export()
+    def progress(num, rate):  # pragma: no cover
+        logger.debug(f" > Exported {num} rows for message export #{export_id} ({rate:.0f} rows/sec)")
+
+    MessageExport.objects.get(pk=export_id).do_export(progress_callback=progress)
 
 
 @shared_task
 def reply_export(export_id):
     logger.info("Starting replies export #%d..." % export_id)
 
-    ReplyExport.objects.get(pk=export_id).do_export()
+    def progress(num, rate):  # pragma: no cover
+        logger.debug(f" > Exported {num} rows for replies export #{export_id} ({rate:.0f} rows/sec)")
+
+    ReplyExport.objects.get(pk=export_id).do_export(progress_callback=progress)
 
 
 def get_labels(task, org, labelstring):
@@ -263,3 +380,13 @@ def trim_old_messages():
             break
 
     logger.info(f"Trimmed {num_deleted} messages older than {trim_older.isoformat()}")
+
+
+@shared_task
+def trim_message_changes():
+    """
+    Task to delete message changes which are too old to be needed by clients refreshing their inboxes
+    """
+    num_deleted = MessageChange.trim()
+
+    logger.info(f"Trimmed {num_deleted} message changes")
@@ -1,11 +1,17 @@
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import partial
 from unittest.mock import ANY, call, patch
 
 from dash.orgs.models import TaskState
 from dateutil.relativedelta import relativedelta
+from django_redis import get_redis_connection
 from temba_client.utils import format_iso8601
 
+from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections
 from django.test.utils import override_settings
 from django.urls import reverse
 from django.utils import timezone
@@ -13,24 +19,36 @@ from django.utils.timezone import now
 
 from casepro.contacts.models import Contact, Group
 from casepro.msgs.views import ImportTask
-from casepro.profiles.models import Notification
+from casepro.profiles.models import ROLE_ADMIN, ROLE_ANALYST, Notification
 from casepro.rules.models import ContainsTest, FieldTest, GroupsTest, Quantifier, WordCountTest
+from casepro.statistics.models import DailyCount
 from casepro.statistics.tasks import squash_counts
 from casepro.test import BaseCasesTest
+from casepro.utils import encode_cursor
 
 from .models import (
     FAQ,
+    LABEL_ACCESS_KEY,
     Label,
     Labelling,
     Message,
     MessageAction,
+    MessageChange,
     MessageExport,
     MessageFolder,
     Outgoing,
     OutgoingFolder,
     ReplyExport,
 )
-from .tasks import faq_csv_import, handle_messages, pull_messages, trim_old_messages
+from .tasks import (
+    batch_by_contact,
+    faq_csv_import,
+    handle_message_batch,
+    handle_messages,
+    pull_messages,
+    trim_message_changes,
+    trim_old_messages,
+)
 
 faq_good_import = b"""Parent ID,Parent Language,Parent Question,Parent Answer,Labels,afr ID,afr Question,afr Answer,bla ID,bla Question,bla Answer
 ,eng,Can I drink tea while pregnant?,"Yes, but avoid too much caffeine","Tea, Pregnancy",,Kan ek tee drink tydens swangerskap?,"Ja, maar beperk jou kaffein inname",,Xtea Xpregnant?,Xyes
@@ -67,6 +85,61 @@ class LabelTest(BaseCasesTest):
         self.assertEqual(set(Label.get_all(self.unicef, self.user1)), {self.aids, self.pregnancy})  # MOH user
         self.assertEqual(set(Label.get_all(self.unicef, self.user3)), {self.aids})  # WHO user
 
+    def test_get_accessible_ids(self):
+        def get_accessible_ids(user):
+            # load a fresh user as ids are memoized on the user object for the rest of a request
+            return Label.get_accessible_ids(self.unicef, User.objects.get(pk=user.pk))
+
+        self.assertEqual(get_accessible_ids(self.admin), {self.aids.pk, self.pregnancy.pk, self.tea.pk})
+        self.assertEqual(get_accessible_ids(self.user1), {self.aids.pk, self.pregnancy.pk})
+        self.assertEqual(get_accessible_ids(self.user3), {self.aids.pk})
+
+        # memoized on the user object...
+        user1 = User.objects.get(pk=self.user1.pk)
+        Label.get_accessible_ids(self.unicef, user1)
+        with self.assertNumQueries(0):
+            Label.get_accessible_ids(self.unicef, user1)
+
+        # and cached across requests
+        with self.assertNumQueries(1):  # to load user
+            get_accessible_ids(self.user1)
+
+        # cache is cleared when partner labels change
+        self.moh.labels.remove(self.aids)
+        self.assertEqual(get_accessible_ids(self.user1), {self.pregnancy.pk})
+
+        self.aids.partners.add(self.moh)
+        self.assertEqual(get_accessible_ids(self.user1), {self.aids.pk, self.pregnancy.pk})
+
+        # or labels are added or deactivated
+        ebola = self.create_label(self.unicef, "L-003", "Ebola", "Messages about Ebola", ["ebola"])
+        self.assertEqual(get_accessible_ids(self.admin), {self.aids.pk, self.pregnancy.pk, self.tea.pk, ebola.pk})
+
+        self.tea.release()
+        self.assertEqual(get_accessible_ids(self.admin), {self.aids.pk, self.pregnancy.pk, ebola.pk})
+
+        # or a partner becomes unrestricted
+        self.who.is_restricted = False
+        self.who.save(update_fields=("is_restricted",))
+        self.assertEqual(get_accessible_ids(self.user3), {self.aids.pk, self.pregnancy.pk, ebola.pk})
+
+        # or users change partner or role
+        self.user1.update_role(self.unicef, ROLE_ANALYST, self.who)
+        self.assertEqual(get_accessible_ids(self.user1), {self.aids.pk, self.pregnancy.pk, ebola.pk})
+
+        self.assertEqual(get_accessible_ids(self.user2), {self.aids.pk, self.pregnancy.pk})
+
+        self.user2.update_role(self.unicef, ROLE_ADMIN)
+        self.assertEqual(get_accessible_ids(self.user2), {self.aids.pk, self.pregnancy.pk, ebola.pk})
+
+        # including when a user's roles are cleared from the user side
+        r = get_redis_connection()
+        get_accessible_ids(self.user2)
+        self.assertTrue(r.hexists(LABEL_ACCESS_KEY % self.unicef.pk, self.user2.pk))
+
+        self.user2.org_admins.clear()
+        self.assertFalse(r.exists(LABEL_ACCESS_KEY % self.unicef.pk))
+
     def test_release(self):
         self.aids.release()
 
@@ -402,6 +475,72 @@ class FaqTest(BaseCasesTest):
         self.tea_faq1_eng.language = None
         self.assertIsNone(self.tea_faq1_eng.get_language())
 
+    def test_label_ids(self):
+        def assert_label_ids(faq, labels):
+            faq.refresh_from_db()
+            self.assertEqual(faq.label_ids, sorted(l.pk for l in labels))
+
+        assert_label_ids(self.preg_faq1_eng, [self.pregnancy])
+        assert_label_ids(self.preg_faq1_zul, [self.pregnancy])  # translations take labels of their parent
+        assert_label_ids(self.preg_faq2_eng, [self.pregnancy, self.aids])
+
+        self.preg_faq1_eng.labels.add(self.tea)
+
+        assert_label_ids(self.preg_faq1_eng, [self.pregnancy, self.tea])
+        assert_label_ids(self.preg_faq1_lug, [self.pregnancy, self.tea])
+
+        # labels can also be changed from the label side
+        self.tea.faqs.remove(self.preg_faq1_eng)
+
+        assert_label_ids(self.preg_faq1_eng, [self.pregnancy])
+        assert_label_ids(self.preg_faq1_lug, [self.pregnancy])
+        assert_label_ids(self.tea_faq1_eng, [self.tea])
+
+        self.aids.faqs.clear()
+
+        assert_label_ids(self.preg_faq2_eng, [self.pregnancy])
+
+        # a translation which loses its parent has only its own labels
+        self.preg_faq1_zul.parent = None
+        self.preg_faq1_zul.save()
+
+        assert_label_ids(self.preg_faq1_zul, [])
+
+        self.preg_faq1_zul.parent = self.preg_faq2_eng
+        self.preg_faq1_zul.save()
+
+        assert_label_ids(self.preg_faq1_zul, [self.pregnancy])
+
+    def test_search(self):
+        self.create_faq(self.unicef, "What should I eat?", "Eat well when you are pregnant.", "eng", None, [self.aids])
+
+        def search(user, search, limit=None):
+            return [f.question for f in FAQ.search(self.unicef, user, search, limit=limit)]
+
+        # results which match on question are ranked above those which only match on answer
+        self.assertEqual(
+            search(self.admin, {"text": "pregnant"}),
+            [
+                "How do I know I'm pregnant?",
+                "LUG How do I know I'm pregnant?",
+                "ZUL How do I know I'm pregnant?",
+                "What should I eat?",
+            ],
+        )
+        self.assertEqual(
+            search(self.admin, {"text": "pregnant"}, limit=2),
+            ["How do I know I'm pregnant?", "LUG How do I know I'm pregnant?"],
+        )
+        self.assertEqual(search(self.admin, {"text": "pregnant", "label": self.aids.pk}), ["What should I eat?"])
+
+        # user1 can't see FAQs only labelled with tea
+        self.assertEqual(search(self.user1, {"text": "tea"}), [])
+        self.assertEqual(search(self.user1, {"label": self.tea.pk}), [])
+
+        # accessible labels are cached for subsequent searches
+        with self.assertNumQueries(0):
+            self.assertEqual(Label.get_accessible_ids(self.unicef, self.user1), {self.aids.pk, self.pregnancy.pk})
+
 
 class FaqCRUDLTest(BaseCasesTest):
     def test_create(self):
@@ -660,7 +799,7 @@ class FaqCRUDLTest(BaseCasesTest):
         self.login(self.user1)
 
         # check that appropriate number of queries are executed
-        with self.assertNumQueries(28):
+        with self.assertNumQueries(27):
             response = self.url_get("unicef", url, {})
         # should have 4 results as one is label restricted
         self.assertEqual(len(response.json["results"]), 4)
@@ -981,7 +1120,7 @@ class MessageTest(BaseCasesTest):
             message.save()
 
         # check removing a label and adding new ones
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(9):
             setattr(message, "__data__labels", [("L-002", "Feedback"), ("L-003", "Important")])
             message.save()
 
@@ -1016,6 +1155,58 @@ class MessageTest(BaseCasesTest):
         self.assertEqual(msg.is_active, False)
         self.assertEqual(msg.labels.count(), 0)
 
+    def test_changes(self):
+        self.assertEqual(MessageChange.get_last_seq(self.unicef), 0)
+
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Unhandled")
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Handled", is_handled=True)
+        msg3 = self.create_message(self.unicef, 103, self.ann, "Also handled", is_handled=True)
+
+        # unhandled messages aren't visible to clients so changing them isn't recorded
+        msg1.text = "Still unhandled"
+        msg1.modified_on = now()
+        msg1.save(update_fields=("text", "modified_on"))
+
+        seq1 = MessageChange.get_last_seq(self.unicef)
+
+        msg1.is_handled = True
+        msg1.modified_on = now()
+        msg1.save(update_fields=("is_handled", "modified_on"))
+
+        Message.bulk_archive(self.unicef, self.user1, [msg2])
+        msg2.release()
+
+        self.assertEqual(
+            list(MessageChange.objects.order_by("id").values_list("message", "kind")),
+            [
+                (msg2.pk, MessageChange.KIND_HANDLED),
+                (msg3.pk, MessageChange.KIND_HANDLED),
+                (msg1.pk, MessageChange.KIND_HANDLED),
+                (msg2.pk, MessageChange.KIND_UPDATED),
+                (msg2.pk, MessageChange.KIND_DELETED),
+            ],
+        )
+        self.assertEqual(MessageChange.get_last_seq(self.unicef), MessageChange.objects.order_by("id").last().id)
+        self.assertEqual(MessageChange.get_last_seq(self.nyaruka), 0)
+
+        # recent changes before the sequence number are re-read in case they were committed after it was read
+        self.assertEqual(
+            {c["message_id"] for c in MessageChange.get_message_ids(self.unicef, seq1)}, {msg1.pk, msg2.pk, msg3.pk}
+        )
+
+        MessageChange.objects.filter(id__lte=seq1).update(created_on=now() - timedelta(minutes=10))
+
+        self.assertEqual(
+            {c["message_id"] for c in MessageChange.get_message_ids(self.unicef, seq1)}, {msg1.pk, msg2.pk}
+        )
+
+        # only changes older than a day are trimmed
+        MessageChange.objects.filter(message=msg1).update(created_on=now() - timedelta(days=2))
+
+        trim_message_changes()
+
+        self.assertEqual(MessageChange.objects.count(), 4)
+
     def test_search(self):
         bob = self.create_contact(self.nyaruka, "C-002", "Bob", [self.reporters])
         eric = self.create_contact(self.nyaruka, "C-101", "Eric")
@@ -1122,6 +1313,11 @@ class MessageTest(BaseCasesTest):
         # by text (won't include really old message)
         assert_search(self.admin, {"folder": MessageFolder.inbox, "text": "hello"}, [msg8, msg7, msg6, msg5])
         assert_search(self.admin, {"folder": MessageFolder.inbox, "text": "LO 5"}, [msg5])
+        assert_search(self.admin, {"folder": MessageFolder.unlabelled, "text": "hello"}, [msg3, msg2, msg1])
+
+        # unless text search is configured to search all messages
+        with override_settings(SITE_SEARCH_BY_TEXT_DAYS=None):
+            assert_search(self.admin, {"folder": MessageFolder.unlabelled, "text": "hello"}, [msg3, msg2, msg1, msg12])
 
         # check combining text searches with other date based searching
         assert_search(
@@ -1131,6 +1327,40 @@ class MessageTest(BaseCasesTest):
             self.user1, {"folder": MessageFolder.inbox, "after": msg6.created_on, "text": "hello"}, [msg8, msg7]
         )
 
+    def test_search_by_labels_with_limit(self):
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hi 1", [self.aids], is_handled=True)
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Hi 2", [self.pregnancy], is_handled=True)
+        msg3 = self.create_message(self.unicef, 103, self.ann, "Hi 3", [self.aids, self.pregnancy], is_handled=True)
+        self.create_message(self.unicef, 104, self.ann, "Hi 4", [self.tea], is_handled=True)
+        self.create_message(self.unicef, 105, self.ann, "Hi 5", [self.aids], is_archived=True, is_handled=True)
+        msg6 = self.create_message(self.unicef, 106, self.ann, "Hi 6", [self.pregnancy], is_handled=True)
+
+        # user #1 is a restricted partner user who can only see messages with the AIDS and Pregnancy labels
+        search = {"folder": MessageFolder.inbox}
+
+        self.assertEqual(list(Message.search(self.unicef, self.user1, search)), [msg6, msg3, msg2, msg1])
+        self.assertEqual(list(Message.search(self.unicef, self.user1, search, limit=3)), [msg6, msg3, msg2])
+        self.assertEqual(list(Message.search(self.unicef, self.user1, search, limit=1)), [msg6])
+        self.assertEqual(
+            list(Message.search(self.unicef, self.user1, {**search, "label": self.aids.id}, limit=3)), [msg3, msg1]
+        )
+
+        # newer unhandled or deleted messages don't take up any of the limit
+        self.create_message(self.unicef, 107, self.ann, "Hi 7", [self.aids, self.pregnancy], is_handled=False)
+        self.create_message(self.unicef, 108, self.ann, "Hi 8", [self.aids], is_handled=False)
+        self.create_message(self.unicef, 109, self.ann, "Hi 9", [self.pregnancy], is_handled=True, is_active=False)
+
+        self.assertEqual(list(Message.search(self.unicef, self.user1, search, limit=2)), [msg6, msg3])
+        self.assertEqual(
+            list(Message.search(self.unicef, self.user1, {**search, "label": self.aids.id}, limit=1)), [msg3]
+        )
+
+        # searches can seek past the last message of the previous page
+        cursor = encode_cursor(msg3.created_on, msg3.id)
+        self.assertEqual(list(Message.search(self.unicef, self.user1, search, limit=2, cursor=cursor)), [msg2, msg1])
+        cursor = encode_cursor(msg2.created_on, msg2.id)
+        self.assertEqual(list(Message.search(self.unicef, self.user1, search, limit=2, cursor=cursor)), [msg1])
+
     @patch("casepro.test.TestBackend.label_messages")
     @patch("casepro.test.TestBackend.unlabel_messages")
     def test_update_labels(self, mock_unlabel_messages, mock_label_messages):
@@ -1210,6 +1440,85 @@ class MessageTest(BaseCasesTest):
 
         self.assertEqual(self.aids.messages.count(), 2)
 
+    def test_label_messages(self):
+        self.aids.watch(self.admin)
+        self.aids.watch(self.user1)
+        self.tea.watch(self.admin)
+
+        d1 = datetime(2015, 1, 1, 10, 0, tzinfo=timezone.utc)
+        d2 = datetime(2015, 1, 2, 10, 0, tzinfo=timezone.utc)
+
+        msgs = [self.create_message(self.unicef, 100 + m, self.ann, "Hi", created_on=d1) for m in range(10)]
+        msgs += [self.create_message(self.unicef, 200 + m, self.ann, "Hi", created_on=d2) for m in range(5)]
+        msgs[0].label(self.aids)
+
+        # number of queries doesn't depend on the number of messages
+        with self.assertNumQueries(6):
+            Message.label_messages(self.unicef, msgs, [self.aids, self.tea])
+
+        self.assertEqual(set(self.aids.messages.all()), set(msgs))
+        self.assertEqual(set(self.tea.messages.all()), set(msgs))
+
+        # counts are recorded as a single row per day and label
+        self.assertEqual(
+            DailyCount.get_by_label([self.aids], DailyCount.TYPE_INCOMING).day_totals(),
+            [(date(2015, 1, 1), 10), (date(2015, 1, 2), 5)],
+        )
+        self.assertEqual(
+            DailyCount.get_by_label([self.tea], DailyCount.TYPE_INCOMING).day_totals(),
+            [(date(2015, 1, 1), 10), (date(2015, 1, 2), 5)],
+        )
+        self.assertEqual(
+            DailyCount.objects.filter(item_type=DailyCount.TYPE_INCOMING, scope__startswith="label").count(), 5
+        )
+
+        # watchers are notified once per message
+        self.assertEqual(Notification.objects.filter(user=self.admin).count(), 15)
+        self.assertEqual(Notification.objects.filter(user=self.user1).count(), 15)
+
+        # labelling again is a no-op
+        Message.label_messages(self.unicef, msgs, [self.aids, self.tea])
+
+        self.assertEqual(Labelling.objects.count(), 30)
+        self.assertEqual(DailyCount.get_by_label([self.aids], DailyCount.TYPE_INCOMING).total(), 15)
+        self.assertEqual(Notification.objects.count(), 30)
+
+    def test_unlabel_messages(self):
+        d1 = datetime(2015, 1, 1, 10, 0, tzinfo=timezone.utc)
+        d2 = datetime(2015, 1, 2, 10, 0, tzinfo=timezone.utc)
+
+        msgs = [self.create_message(self.unicef, 100 + m, self.ann, "Hi", created_on=d1) for m in range(10)]
+        msgs += [self.create_message(self.unicef, 200 + m, self.ann, "Hi", created_on=d2) for m in range(5)]
+        Message.label_messages(self.unicef, msgs, [self.aids, self.pregnancy, self.tea])
+
+        # number of queries doesn't depend on the number of messages
+        with self.assertNumQueries(2):
+            Message.unlabel_messages(self.unicef, msgs[1:], [self.aids, self.tea])
+
+        self.assertEqual(set(self.aids.messages.all()), {msgs[0]})
+        self.assertEqual(set(self.pregnancy.messages.all()), set(msgs))
+        self.assertEqual(set(self.tea.messages.all()), {msgs[0]})
+
+        # removals are recorded as a single row per day and label
+        self.assertEqual(
+            DailyCount.get_by_label([self.aids], DailyCount.TYPE_INCOMING).day_totals(),
+            [(date(2015, 1, 1), 1), (date(2015, 1, 2), 0)],
+        )
+        self.assertEqual(
+            sorted(DailyCount.objects.filter(count__lt=0).values_list("count", flat=True)), [-9, -9, -5, -5]
+        )
+
+        # clearing all labels
+        with self.assertNumQueries(2):
+            Message.unlabel_messages(self.unicef, msgs)
+
+        self.assertEqual(Labelling.objects.count(), 0)
+        self.assertEqual(DailyCount.get_by_label([self.aids, self.pregnancy, self.tea], "I").total(), 0)
+
+        # nothing to remove means no new counts
+        with self.assertNumQueries(1):
+            Message.unlabel_messages(self.unicef, msgs)
+
     @patch("casepro.test.TestBackend.unlabel_messages")
     def test_bulk_unlabel(self, mock_unlabel_messages):
         self.create_test_messages()
@@ -1357,6 +1666,8 @@ class MessageCRUDLTest(BaseCasesTest):
         )
         self.assertEqual(response.json["results"][1]["id"], 104)
 
+        last_seq = response.json["last_seq"]
+
         t1 = now()
         self.create_message(self.unicef, 210, self.ann, "Is this thing on?", [self.aids], is_handled=True)
         Message.bulk_flag(self.unicef, self.user1, [msg5])
@@ -1382,6 +1693,35 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json["results"][0]["flagged"], True)
         self.assertEqual(response.json["results"][1]["id"], 210)
 
+        # changes within the refresh overlap are always re-read, so pretend these were all made a while ago
+        MessageChange.objects.update(created_on=now() - timedelta(hours=1))
+
+        # test the refresh using the change sequence number from the last request
+        response = self.url_get(
+            "unicef", url, {"folder": "inbox", "text": "", "page": 1, "after": "", "before": "", "last_seq": last_seq}
+        )
+
+        self.assertEqual(len(response.json["results"]), 2)
+        self.assertEqual(response.json["results"][0]["id"], 105)
+        self.assertEqual(response.json["results"][0]["flagged"], True)
+        self.assertEqual(response.json["results"][1]["id"], 210)
+        self.assertGreater(response.json["last_seq"], last_seq)
+
+        # and nothing has changed since that refresh
+        last_seq = response.json["last_seq"]
+        response = self.url_get(
+            "unicef", url, {"folder": "inbox", "text": "", "page": 1, "after": "", "before": "", "last_seq": last_seq}
+        )
+
+        self.assertEqual(response.json["results"], [])
+        self.assertEqual(response.json["last_seq"], last_seq)
+
+        # an invalid change sequence number is a bad request
+        response = self.url_get(
+            "unicef", url, {"folder": "inbox", "text": "", "page": 1, "after": "", "before": "", "last_seq": "x"}
+        )
+        self.assertEqual(response.status_code, 400)
+
         # the message we just flagged is archived but is included if archived is true
         response = self.url_get(
             "unicef",
@@ -1428,6 +1768,32 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json["results"][0]["id"], 101)
         self.assertFalse(response.json["has_more"])
 
+        # request first page using a cursor instead
+        params = {"folder": "inbox", "text": "", "cursor": "", "after": "", "before": format_iso8601(t0)}
+        response = self.url_get("unicef", url, params)
+        self.assertEqual(len(response.json["results"]), 50)
+        self.assertEqual(response.json["results"][0]["id"], 201)
+        self.assertEqual(response.json["results"][49]["id"], 152)
+        self.assertTrue(response.json["has_more"])
+
+        # and second page...
+        response = self.url_get("unicef", url, {**params, "cursor": response.json["next_cursor"]})
+        self.assertEqual(len(response.json["results"]), 50)
+        self.assertEqual(response.json["results"][0]["id"], 151)
+        self.assertEqual(response.json["results"][49]["id"], 102)
+        self.assertTrue(response.json["has_more"])
+
+        # and last page...
+        response = self.url_get("unicef", url, {**params, "cursor": response.json["next_cursor"]})
+        self.assertEqual(len(response.json["results"]), 1)
+        self.assertEqual(response.json["results"][0]["id"], 101)
+        self.assertFalse(response.json["has_more"])
+        self.assertIsNone(response.json["next_cursor"])
+
+        # an invalid cursor is a bad request
+        response = self.url_get("unicef", url, {**params, "cursor": "xyz"})
+        self.assertEqual(response.status_code, 400)
+
     def test_get_lock(self):
         msg = self.create_message(self.unicef, 101, self.ann, "Normal", [self.aids, self.pregnancy])
 
@@ -1636,7 +2002,7 @@ class MessageCRUDLTest(BaseCasesTest):
 
 
 class MessageExportCRUDLTest(BaseCasesTest):
-    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, SITE_EXPORT_FORMAT="xls")
     def test_create_and_read(self):
         ann = self.create_contact(
             self.unicef, "C-001", "Ann", fields={"nickname": "Annie", "age": "28", "state": "WA"}
@@ -1714,6 +2080,40 @@ class MessageExportCRUDLTest(BaseCasesTest):
         self.login(self.norbert)
         self.assertLoginRedirect(self.url_get("unicef", read_url), read_url)
 
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
+    def test_create_and_read_as_csv(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={"nickname": "Annie", "age": "28"})
+
+        d1 = datetime(2015, 12, 25, 13, 0, 0, 0, timezone.utc)
+        d2 = datetime(2015, 12, 25, 14, 0, 0, 0, timezone.utc)
+
+        self.create_message(self.unicef, 101, ann, "What is HIV?", [self.aids], created_on=d1, is_handled=True)
+        self.create_message(
+            self.unicef, 102, ann, "I ♡ RapidPro", [self.pregnancy], created_on=d2, is_flagged=True, is_handled=True
+        )
+
+        self.login(self.user1)
+
+        response = self.url_post(
+            "unicef", "%s?folder=inbox&text=&after=2015-04-01T22:00:00.000Z" % reverse("msgs.messageexport_create")
+        )
+        self.assertEqual(response.status_code, 200)
+
+        export = MessageExport.objects.get()
+        self.assertTrue(export.filename.endswith(".csv"))
+
+        read_url = reverse("msgs.messageexport_read", args=[export.pk])
+        response = self.url_get("unicef", read_url + "?download=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=message_export.csv")
+        self.assertEqual(
+            response.content.decode("utf-8"),
+            "Time,Message ID,Flagged,Labels,Text,Contact,Nickname,Age\r\n"
+            "2015-12-25 14:00:00,102,Yes,Pregnancy,I ♡ RapidPro,C-001,Annie,28\r\n"
+            "2015-12-25 13:00:00,101,No,AIDS,What is HIV?,C-001,Annie,28\r\n",
+        )
+
 
 class OutgoingTest(BaseCasesTest):
     def setUp(self):
@@ -1979,7 +2379,7 @@ class OutgoingCRUDLTest(BaseCasesTest):
 
 
 class ReplyExportCRUDLTest(BaseCasesTest):
-    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, SITE_EXPORT_FORMAT="xls")
     def test_create_and_read(self):
         ann = self.create_contact(
             self.unicef, "C-001", "Ann", fields={"nickname": "Annie", "age": "28", "state": "WA"}
@@ -2123,6 +2523,7 @@ class TasksTest(BaseCasesTest):
             {
                 "labels": {"created": 1, "updated": 2, "deleted": 3},
                 "messages": {"created": 5, "updated": 6, "deleted": 7, "until": t1.isoformat()},
+                "stubs": {"pulled": 0, "released": 0},
             },
             task_state.get_last_results(),
         )
@@ -2148,6 +2549,7 @@ class TasksTest(BaseCasesTest):
                     "deleted": 0,
                     "resume": {"cursor": "cur12345", "since": t1.isoformat(), "until": t2.isoformat()},
                 },
+                "stubs": {"pulled": 0, "released": 0},
             },
             task_state.get_last_results(),
         )
@@ -2209,6 +2611,36 @@ class TasksTest(BaseCasesTest):
             task_state.get_last_results()["messages"],
         )
 
+    @patch("casepro.test.TestBackend.pull_contacts_by_uuid")
+    def test_pull_messages_with_stubs(self, mock_pull_contacts_by_uuid):
+        mock_pull_contacts_by_uuid.return_value = (0, 2, 1, 0)
+
+        ann = self.create_contact(self.unicef, "C-001", "Ann", is_stub=True)
+        bob = self.create_contact(self.unicef, "C-002", "Bob", is_stub=True)
+        cat = self.create_contact(self.unicef, "C-003", "Cat", is_stub=True)
+        dan = self.create_contact(self.unicef, "C-004", "Dan")
+        self.create_message(self.unicef, 101, ann, "Hello")
+        self.create_message(self.unicef, 102, bob, "Hello")
+        self.create_message(self.unicef, 103, cat, "Hello", is_handled=True)
+        self.create_message(self.unicef, 104, dan, "Hello")
+
+        pull_messages(self.unicef.id)
+
+        # only the stub contacts with unhandled messages are pulled
+        mock_pull_contacts_by_uuid.assert_called_once_with(self.unicef, ["C-002", "C-001"])
+
+        task_state = TaskState.objects.get(org=self.unicef, task_key="message-pull")
+        self.assertEqual({"pulled": 2, "released": 1}, task_state.get_last_results()["stubs"])
+
+        # a failure to pull stubs doesn't fail the message pull
+        mock_pull_contacts_by_uuid.side_effect = ValueError("API unavailable")
+
+        pull_messages(self.unicef.id)
+
+        task_state.refresh_from_db()
+        self.assertFalse(task_state.is_failing)
+        self.assertEqual({"pulled": 0, "released": 0}, task_state.get_last_results()["stubs"])
+
     @patch("casepro.test.TestBackend.label_messages")
     @patch("casepro.test.TestBackend.archive_messages")
     def test_handle_messages(self, mock_archive_messages, mock_label_messages):
@@ -2268,7 +2700,13 @@ class TasksTest(BaseCasesTest):
         task_state = self.unicef.get_task_state("message-handle")
         self.assertEqual(
             task_state.get_last_results(),
-            {"handled": 6, "case_replies": 1, "rules_matched": 3, "ignored_with_ticket": 1},
+            {
+                "handled": 6,
+                "case_replies": 1,
+                "rules_matched": 3,
+                "ignored_with_ticket": 1,
+                "timings": {"fetch": ANY, "load": ANY, "match": ANY, "replies": ANY, "actions": ANY, "mark": ANY},
+            },
         )
 
         # check calling again...
@@ -2276,9 +2714,104 @@ class TasksTest(BaseCasesTest):
         task_state = self.unicef.get_task_state("message-handle")
         self.assertEqual(
             task_state.get_last_results(),
-            {"handled": 0, "case_replies": 0, "rules_matched": 0, "ignored_with_ticket": 0},
+            {"handled": 0, "case_replies": 0, "rules_matched": 0, "ignored_with_ticket": 0, "timings": {"fetch": ANY}},
+        )
+
+    @override_settings(HANDLE_MESSAGES_BATCH_SIZE=2)
+    @patch("casepro.msgs.tasks.handle_message_batch", wraps=handle_message_batch)
+    def test_handle_messages_in_batches(self, mock_handle_message_batch):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        cat = self.create_contact(self.unicef, "C-003", "Cat")
+
+        msg1 = self.create_message(self.unicef, 101, ann, "What is aids?")
+        msg2 = self.create_message(self.unicef, 102, bob, "Can I catch Hiv?")
+        msg3 = self.create_message(self.unicef, 103, ann, "I think I'm pregnant")
+        msg4 = self.create_message(self.unicef, 104, ann, "Php is amaze")
+        msg5 = self.create_message(self.unicef, 105, cat, "HIV")
+
+        handle_messages(self.unicef.pk)
+
+        # all of Ann's messages are handled in the same batch
+        mock_handle_message_batch.assert_has_calls(
+            [call(self.unicef, [msg1.id, msg3.id, msg4.id]), call(self.unicef, [msg2.id, msg5.id])]
+        )
+
+        self.assertEqual(set(Message.objects.filter(is_handled=True)), {msg1, msg2, msg3, msg4, msg5})
+        self.assertEqual(set(Message.objects.filter(labels=self.aids)), {msg1, msg2, msg5})
+        self.assertEqual(set(Message.objects.filter(labels=self.pregnancy)), {msg3})
+
+        task_state = self.unicef.get_task_state("message-handle")
+        self.assertEqual(
+            task_state.get_last_results(),
+            {
+                "handled": 5,
+                "case_replies": 0,
+                "rules_matched": 4,
+                "ignored_with_ticket": 0,
+                "timings": {"fetch": ANY, "load": ANY, "match": ANY, "replies": ANY, "actions": ANY, "mark": ANY},
+            },
         )
 
+    @override_settings(HANDLE_MESSAGES_BATCH_SIZE=1, HANDLE_MESSAGES_WORKERS=2)
+    def test_handle_messages_in_threads(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        cat = self.create_contact(self.unicef, "C-003", "Cat")
+
+        msg1 = self.create_message(self.unicef, 101, ann, "What is aids?")
+        msg2 = self.create_message(self.unicef, 102, bob, "Can I catch Hiv?")
+        msg3 = self.create_message(self.unicef, 103, cat, "I think I'm pregnant")
+
+        # worker threads share the test's connection, like in a live server test, so they can see its uncommitted data,
+        # but take turns using it and don't close it
+        test_connection = connections["default"]
+        test_connection.inc_thread_sharing()
+        db_lock = threading.Lock()
+        handled_with = []
+
+        def share_connection():
+            connections["default"] = test_connection
+
+        def handle_batch(org, message_ids, rule_set=None, close_db=False):
+            with db_lock:
+                handled_with.append((org, rule_set, close_db))
+                if message_ids == [msg2.id]:
+                    raise ValueError("boom")
+
+                return handle_message_batch(org, message_ids, rule_set=rule_set)
+
+        try:
+            with patch(
+                "casepro.msgs.tasks.ThreadPoolExecutor", partial(ThreadPoolExecutor, initializer=share_connection)
+            ), patch("casepro.msgs.tasks.handle_message_batch", side_effect=handle_batch):
+                with self.assertRaisesRegex(ValueError, "boom"):
+                    handle_messages(self.unicef.pk)
+        finally:
+            test_connection.dec_thread_sharing()
+
+        self.assertEqual(len(handled_with), 3)
+
+        # each thread handles its batches with its own org and rules, and closes its connection after each batch
+        for org, rule_set, close_db in handled_with:
+            self.assertEqual(org, self.unicef)
+            self.assertIsNot(org, self.unicef)
+            self.assertIsNotNone(rule_set)
+            self.assertTrue(close_db)
+
+        # the other batches are still handled even though one failed
+        self.assertEqual(set(Message.objects.filter(is_handled=True)), {msg1, msg3})
+        self.assertEqual(set(Message.objects.filter(labels=self.aids)), {msg1})
+        self.assertEqual(set(Message.objects.filter(labels=self.pregnancy)), {msg3})
+
+    def test_batch_by_contact(self):
+        rows = [(1, 11), (1, 12), (1, 13), (2, 21), (3, 31), (3, 32), (4, 41)]
+
+        self.assertEqual(batch_by_contact(rows, 2), [[11, 12, 13], [21, 31, 32], [41]])
+        self.assertEqual(batch_by_contact(rows, 1), [[11, 12, 13], [21], [31, 32], [41]])
+        self.assertEqual(batch_by_contact(rows, 100), [[11, 12, 13, 21, 31, 32, 41]])
+        self.assertEqual(batch_by_contact([], 100), [])
+
     def test_trim_old_messages(self):
         ann = self.create_contact(self.unicef, "C-001", "Ann")
         nic = self.create_contact(self.nyaruka, "C-002", "Nic")
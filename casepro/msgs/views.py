@@ -19,6 +19,7 @@ from smartmin.views import (
 from temba_client.utils import parse_iso8601
 
 from django import forms
+from django.core.exceptions import BadRequest
 from django.core.validators import FileExtensionValidator
 from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.urls import reverse
@@ -28,11 +29,21 @@ from django.utils.translation import gettext_lazy as _
 
 from casepro.rules.mixins import RuleFormMixin
 from casepro.statistics.models import DailyCount
-from casepro.utils import JSONEncoder, month_range, str_to_bool
+from casepro.utils import JSONEncoder, month_range, paginate_by_cursor, str_to_bool
 from casepro.utils.export import BaseDownloadView
 
 from .forms import FaqForm, LabelForm
-from .models import FAQ, Label, Message, MessageExport, MessageFolder, Outgoing, OutgoingFolder, ReplyExport
+from .models import (
+    FAQ,
+    Label,
+    Message,
+    MessageChange,
+    MessageExport,
+    MessageFolder,
+    Outgoing,
+    OutgoingFolder,
+    ReplyExport,
+)
 from .tasks import message_export, reply_export
 
 RESPONSE_DELAY_WARN_SECONDS = 24 * 60 * 60  # show response delays > 1 day as warning
@@ -211,29 +222,61 @@ class MessageCRUDL(SmartCRUDL):
 
         page_size = 50
 
-        def get_messages(self, search, last_refresh=None):
+        def get_messages(self, search, last_refresh=None, last_seq=None, limit=None, cursor=None):
             org = self.request.org
             user = self.request.user
-            queryset = Message.search(org, user, search, modified_after=last_refresh, all=False)
+            queryset = Message.search(
+                org,
+                user,
+                search,
+                modified_after=last_refresh,
+                changed_since=last_seq,
+                all=False,
+                limit=limit,
+                cursor=cursor,
+            )
             return queryset.prefetch_related("contact", "labels", "case__assignee", "case__user_assignee")
 
         def get_context_data(self, **kwargs):
             context = super(MessageCRUDL.Search, self).get_context_data(**kwargs)
 
             page = int(self.request.GET.get("page", 1))
+            cursor = self.request.GET.get("cursor")
             last_refresh = self.request.GET.get("last_refresh")
+            last_seq = self.request.GET.get("last_seq")
 
             search = self.derive_search()
 
-            # this is a refresh of new and modified messages
-            if last_refresh:
-                messages = self.get_messages(search, last_refresh)
+            # refreshes and first pages tell the client where to fetch changes from next, and this must be read before
+            # the messages so that no changes are missed
+            if last_seq or last_refresh or (page == 1 and not cursor):
+                context["last_seq"] = MessageChange.get_last_seq(self.request.org)
+
+            # this is a refresh of new and modified messages, since either a change sequence number or a time
+            if last_seq or last_refresh:
+                if last_seq:
+                    try:
+                        last_seq = int(last_seq)
+                    except ValueError:
+                        raise BadRequest("Invalid change sequence number")
+
+                    messages = self.get_messages(search, last_seq=last_seq)
+                else:
+                    messages = self.get_messages(search, last_refresh)
 
                 # don't use paging for these messages
                 context["object_list"] = list(messages)
                 context["has_more"] = False
+            elif cursor is not None:
+                # every page starts from the cursor so we know how many messages we'll need
+                messages = self.get_messages(search, limit=self.page_size + 1, cursor=cursor)
+                context["object_list"], context["next_cursor"] = paginate_by_cursor(
+                    messages, "created_on", cursor, self.page_size
+                )
+                context["has_more"] = bool(context["next_cursor"])
             else:
-                messages = self.get_messages(search)
+                # the paginator needs one more message than the requested page to know if there are more
+                messages = self.get_messages(search, limit=page * self.page_size + 1)
                 paginator = LazyPaginator(messages, per_page=self.page_size)
 
                 context["object_list"] = paginator.page(page)
@@ -250,7 +293,13 @@ class MessageCRUDL(SmartCRUDL):
 
                 results.append(msg)
 
-            return JsonResponse({"results": results, "has_more": context["has_more"]}, encoder=JSONEncoder)
+            response = {"results": results, "has_more": context["has_more"]}
+            if "next_cursor" in context:
+                response["next_cursor"] = context["next_cursor"]
+            if "last_seq" in context:
+                response["last_seq"] = context["last_seq"]
+
+            return JsonResponse(response, encoder=JSONEncoder)
 
     class Lock(OrgPermsMixin, SmartTemplateView):
         """
@@ -289,6 +338,9 @@ class MessageCRUDL(SmartCRUDL):
             else:  # pragma: no cover
                 return HttpResponseBadRequest("Invalid action: %s", action)
 
+            if not lock_messages:
+                Message.publish_changes(org, messages)
+
             return JsonResponse({"messages": lock_messages}, encoder=JSONEncoder)
 
     class Action(OrgPermsMixin, SmartTemplateView):
@@ -469,20 +521,27 @@ class OutgoingCRUDL(SmartCRUDL):
             org = self.request.org
             user = self.request.user
             page = int(self.request.GET.get("page", 1))
+            cursor = self.request.GET.get("cursor")
 
             search = self.derive_search()
             messages = Outgoing.search(org, user, search)
-            paginator = LazyPaginator(messages, per_page=50)
 
-            context["object_list"] = paginator.page(page)
-            context["has_more"] = paginator.num_pages > page
+            if cursor is not None:
+                context["object_list"], context["next_cursor"] = paginate_by_cursor(messages, "created_on", cursor, 50)
+                context["has_more"] = bool(context["next_cursor"])
+            else:
+                paginator = LazyPaginator(messages, per_page=50)
+
+                context["object_list"] = paginator.page(page)
+                context["has_more"] = paginator.num_pages > page
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            return JsonResponse(
-                {"results": [m.as_json() for m in context["object_list"]], "has_more": context["has_more"]},
-                encoder=JSONEncoder,
-            )
+            response = {"results": [m.as_json() for m in context["object_list"]], "has_more": context["has_more"]}
+            if "next_cursor" in context:
+                response["next_cursor"] = context["next_cursor"]
+
+            return JsonResponse(response, encoder=JSONEncoder)
 
     class SearchReplies(OrgPermsMixin, ReplySearchMixin, SmartTemplateView):
         """
@@ -649,7 +708,7 @@ class FaqCRUDL(SmartCRUDL):
             user = self.request.user
 
             search = self.derive_search()
-            faqs = FAQ.search(org, user, search)
+            faqs = FAQ.search(org, user, search, limit=FAQ.SEARCH_LIMIT)
             context["object_list"] = faqs
             return context
 
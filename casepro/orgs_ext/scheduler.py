@@ -0,0 +1,258 @@
+import math
+
+from dash.orgs.models import TaskState
+from django_redis import get_redis_connection
+
+from django.conf import settings
+
+QUEUED_KEY = "org-scheduler:queued:%s"  # sorted set of ids of orgs queued or running a task, scored by slot expiry
+WAITING_KEY = "org-scheduler:waiting:%s"  # sorted set of ids of orgs waiting for a free slot, scored by priority
+METRICS_KEY = "org-scheduler:metrics:%s:%d"  # hash of metrics for a task and org
+METRICS_TTL = 60 * 60 * 24 * 7  # 1 week
+BACKLOG_KEY = "org-scheduler:backlog:%d"  # number of unhandled messages of an org
+BACKLOG_TTL = 60  # backlogs are shared by the schedulings of all tasks for this long
+BACKLOG_MAX = 10000  # backlogs are only counted up to this size, which already gives an org a large weight
+
+HEARTBEAT_INTERVAL = 30  # how often a running task renews its slot
+HEARTBEAT_TIMEOUT = 2 * 60  # how long a running task's slot lasts without being renewed, e.g. if its worker was killed
+
+# atomically frees expired slots and claims as many free slots as possible for the given org ids, in order
+CLAIM_SLOTS_SCRIPT = """
+local queued_key, now, expires_on, max_queued = KEYS[1], ARGV[1], ARGV[2], tonumber(ARGV[3])
+
+redis.call("ZREMRANGEBYSCORE", queued_key, "-inf", now)
+local num_free = max_queued - redis.call("ZCARD", queued_key)
+
+local claimed = {}
+for i = 4, #ARGV do
+    if num_free <= 0 then
+        break
+    end
+    if redis.call("ZADD", queued_key, "NX", expires_on, ARGV[i]) == 1 then
+        table.insert(claimed, ARGV[i])
+        num_free = num_free - 1
+    end
+end
+return claimed
+"""
+
+# atomically frees expired slots and if there is a free slot, claims it for the highest priority waiting org
+POP_WAITING_SCRIPT = """
+local queued_key, waiting_key = KEYS[1], KEYS[2]
+local now, expires_on, max_queued = ARGV[1], ARGV[2], tonumber(ARGV[3])
+
+redis.call("ZREMRANGEBYSCORE", queued_key, "-inf", now)
+if redis.call("ZCARD", queued_key) >= max_queued then
+    return false
+end
+
+local popped = redis.call("ZPOPMAX", waiting_key)
+if #popped == 0 then
+    return false
+end
+
+redis.call("ZADD", queued_key, expires_on, popped[1])
+return popped[1]
+"""
+
+
+def get_backlogs(orgs):
+    """
+    Gets the number of unhandled messages of each of the given orgs, up to BACKLOG_MAX. These are cached briefly so that
+    they're shared by the schedulings of different tasks.
+    """
+    from casepro.msgs.models import Message
+
+    r = get_redis_connection()
+    cached = r.mget([BACKLOG_KEY % o.id for o in orgs]) if orgs else []
+    backlogs = {o.id: int(c) for o, c in zip(orgs, cached) if c is not None}
+
+    missing = [o for o in orgs if o.id not in backlogs]
+    if missing:
+        with r.pipeline() as pipe:
+            for org in missing:
+                backlogs[org.id] = Message.get_unhandled(org)[:BACKLOG_MAX].count()
+                pipe.set(BACKLOG_KEY % org.id, backlogs[org.id], ex=BACKLOG_TTL)
+            pipe.execute()
+
+    return backlogs
+
+
+def get_weights(orgs, task_key):
+    """
+    Gets the weight of each of the given orgs for the given task, which grows with the org's backlog of unhandled
+    messages and the duration of its last run of the task. Weights grow logarithmically so that an org with a huge
+    backlog is scheduled more eagerly than a small org, but can't monopolise the workers.
+    """
+    backlogs = get_backlogs(orgs)
+    states = {s.org_id: s for s in TaskState.objects.filter(org__in=orgs, task_key=task_key)}
+
+    weights = {}
+    for org in orgs:
+        state = states.get(org.id)
+        last_duration = 0
+        if state and state.started_on and state.ended_on:
+            last_duration = max((state.ended_on - state.started_on).total_seconds(), 0)
+
+        weights[org.id] = 1 + math.log10(1 + backlogs[org.id]) + math.log10(1 + last_duration)
+
+    return weights, states
+
+
+def select_orgs(orgs, task_key, now: float):
+    """
+    Selects which of the given orgs to queue the given task for, claiming their slots. Orgs with the task already queued
+    or running aren't queued again, and at most SYNC_SCHEDULER_MAX_QUEUED orgs can have the task queued or running at
+    once. Remaining slots go to the orgs which have waited longest since their last run, with waits scaled by org
+    weights. Orgs which don't get a slot are left waiting for the next one to be freed.
+    """
+    r = get_redis_connection()
+    queued_key = QUEUED_KEY % task_key
+
+    # forget about orgs whose slots have expired because their tasks were lost before starting or stopped heartbeating
+    r.zremrangebyscore(queued_key, "-inf", now)
+    queued_ids = {int(i) for i in r.zrange(queued_key, 0, -1)}
+
+    candidates = [o for o in orgs if o.id not in queued_ids]
+    if not candidates:
+        record_waiting(task_key, {})
+        return []
+
+    priorities = get_priorities(candidates, task_key, now)
+    candidates = sorted(candidates, key=lambda o: priorities[o.id], reverse=True)
+
+    # claiming is atomic as slots may have been claimed since we checked, e.g. by a finishing task for a waiting org
+    claimed = claim_slots(task_key, [o.id for o in candidates], now, now + settings.SYNC_SCHEDULER_QUEUED_TIMEOUT)
+    selected = [o for o in candidates if o.id in claimed]
+    skipped = [o for o in candidates if o.id not in claimed]
+
+    record_skipped(task_key, skipped)
+    record_waiting(task_key, {o.id: priorities[o.id] for o in skipped})
+    return selected
+
+
+def get_priorities(orgs, task_key, now: float):
+    """
+    Gets the priority of each of the given orgs for the given task, i.e. how long they've waited since their last run
+    scaled by their weights
+    """
+    weights, states = get_weights(orgs, task_key)
+
+    def priority(org):
+        state = states.get(org.id)
+        if not state or not state.ended_on:
+            return math.inf  # never run so should run as soon as possible
+
+        waited = max(now - state.ended_on.timestamp(), 0)
+        return waited * weights[org.id]
+
+    return {o.id: priority(o) for o in orgs}
+
+
+def claim_slots(task_key, org_ids, now: float, expires_on: float):
+    """
+    Claims as many free slots for the given task as possible for the given org ids, in order
+    """
+    claimed = get_redis_connection().eval(
+        CLAIM_SLOTS_SCRIPT,
+        1,
+        QUEUED_KEY % task_key,
+        now,
+        expires_on,
+        settings.SYNC_SCHEDULER_MAX_QUEUED,
+        *[str(i) for i in org_ids],
+    )
+    return {int(i) for i in claimed}
+
+
+def record_waiting(task_key, priorities):
+    """
+    Replaces the orgs waiting for a free slot for the given task with the given org ids and priorities
+    """
+    pipe = get_redis_connection().pipeline()
+    pipe.delete(WAITING_KEY % task_key)
+    if priorities:
+        pipe.zadd(WAITING_KEY % task_key, {str(org_id): p for org_id, p in priorities.items()})
+    pipe.execute()
+
+
+def pop_waiting(task_key, now: float):
+    """
+    Pops the id of the highest priority org waiting for a free slot for the given task and claims the slot for it, if
+    there is a free slot
+    """
+    popped = get_redis_connection().eval(
+        POP_WAITING_SCRIPT,
+        2,
+        QUEUED_KEY % task_key,
+        WAITING_KEY % task_key,
+        now,
+        now + settings.SYNC_SCHEDULER_QUEUED_TIMEOUT,
+        settings.SYNC_SCHEDULER_MAX_QUEUED,
+    )
+    return int(popped) if popped else None
+
+
+def record_running(task_key, org_id: int, now: float):
+    """
+    Records that the given org's task is still running, renewing its slot. Slots which have already been freed aren't
+    claimed again.
+    """
+    get_redis_connection().zadd(QUEUED_KEY % task_key, {str(org_id): now + HEARTBEAT_TIMEOUT}, xx=True)
+
+
+def free_slot(task_key, org_id: int):
+    """
+    Frees the given org's slot for the given task without recording a run, e.g. if the org is no longer active
+    """
+    get_redis_connection().zrem(QUEUED_KEY % task_key, str(org_id))
+
+
+def record_skipped(task_key, orgs):
+    """
+    Records that the given orgs weren't queued due to backpressure
+    """
+    if not orgs:
+        return
+
+    pipe = get_redis_connection().pipeline()
+    for org in orgs:
+        pipe.hincrby(METRICS_KEY % (task_key, org.id), "skipped", 1)
+        pipe.expire(METRICS_KEY % (task_key, org.id), METRICS_TTL)
+    pipe.execute()
+
+
+def record_finished(task_key, org_id: int, queued_on: float, started_on: float, ended_on: float, failed: bool):
+    """
+    Records that the given org's task has finished, freeing its slot and updating its metrics
+    """
+    metrics_key = METRICS_KEY % (task_key, org_id)
+    duration = ended_on - started_on
+
+    pipe = get_redis_connection().pipeline()
+    pipe.zrem(QUEUED_KEY % task_key, str(org_id))
+    pipe.hincrby(metrics_key, "runs", 1)
+    pipe.hincrby(metrics_key, "failures", 1 if failed else 0)
+    pipe.hset(metrics_key, "last_wait", round(started_on - queued_on, 3))
+    pipe.hset(metrics_key, "last_duration", round(duration, 3))
+    pipe.hincrbyfloat(metrics_key, "total_duration", round(duration, 3))
+    pipe.expire(metrics_key, METRICS_TTL)
+    pipe.execute()
+
+
+def get_metrics(task_key, org):
+    """
+    Gets the metrics for the given task and org, i.e. the number of runs, failures and skips due to backpressure, how
+    long the last run waited to start and took, and the total time spent running
+    """
+    metrics = get_redis_connection().hgetall(METRICS_KEY % (task_key, org.id))
+    metrics = {k.decode(): v.decode() for k, v in metrics.items()}
+
+    return {
+        "runs": int(metrics.get("runs", 0)),
+        "failures": int(metrics.get("failures", 0)),
+        "skipped": int(metrics.get("skipped", 0)),
+        "last_wait": float(metrics["last_wait"]) if "last_wait" in metrics else None,
+        "last_duration": float(metrics["last_duration"]) if "last_duration" in metrics else None,
+        "total_duration": float(metrics.get("total_duration", 0)),
+    }
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from celery import current_app, shared_task
+from celery.utils.log import get_task_logger
+from dash.orgs.models import Org
+
+from django.conf import settings
+
+from . import scheduler
+
+logger = get_task_logger(__name__)
+
+
+@shared_task
+def schedule_org_task(task_name, task_key, queue="celery"):
+    """
+    Alternative to dash's trigger_org_task which only queues the given org task for as many orgs as the scheduler
+    allows, prioritising orgs by how long they've waited and their backlogs
+    """
+    now = time.time()
+    active_orgs = list(Org.objects.filter(is_active=True))
+    selected = scheduler.select_orgs(active_orgs, task_key, now)
+
+    for org in selected:
+        queue_org_task(task_name, task_key, org.id, queue, now)
+
+    logger.info(f"Scheduled task '{task_name}' for {len(selected)} of {len(active_orgs)} active orgs")
+
+
+@shared_task
+def run_org_task(task_name, task_key, org_id, queued_on, queue="celery"):
+    """
+    Runs the given org task for an org queued by the scheduler, and records its metrics. The org's slot is renewed by a
+    heartbeat while the task runs, so that it's freed soon after if the worker is killed. Once the task ends, the slot
+    is given straight to the next org waiting for one rather than waiting for the next scheduling.
+    """
+    started_on = time.time()
+    scheduler.record_running(task_key, org_id, started_on)
+
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(
+        target=send_heartbeats, args=(task_key, org_id, started_on, stop_heartbeat), daemon=True
+    )
+    heartbeat.start()
+
+    failed = True
+    try:
+        current_app.tasks[task_name](org_id)
+        failed = False
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+
+        scheduler.record_finished(task_key, org_id, queued_on, started_on, time.time(), failed)
+
+        now = time.time()
+        next_org_id = scheduler.pop_waiting(task_key, now)
+        if next_org_id:
+            if Org.objects.filter(id=next_org_id, is_active=True).exists():
+                queue_org_task(task_name, task_key, next_org_id, queue, now)
+            else:
+                scheduler.free_slot(task_key, next_org_id)
+
+
+def send_heartbeats(task_key, org_id, started_on: float, stop):
+    """
+    Renews the slot of a running org task until stopped, or until the task's lock timeout after which it's no longer
+    considered running anyway
+    """
+    ends_on = started_on + settings.ORG_TASK_LOCK_TIMEOUTS[task_key]
+
+    while not stop.wait(scheduler.HEARTBEAT_INTERVAL) and time.time() < ends_on:
+        scheduler.record_running(task_key, org_id, time.time())
+
+
+def queue_org_task(task_name, task_key, org_id, queue, now: float):
+    """
+    Queues the given org task for an org which has been given a slot
+    """
+    run_org_task.apply_async(args=[task_name, task_key, org_id, now], kwargs={"queue": queue}, queue=queue)
@@ -1,15 +1,23 @@
+import threading
+import time
 import zoneinfo
+from datetime import timedelta
 from unittest.mock import patch
 
 import pytz
 from dash.orgs.models import Org, TaskState
+from django_redis import get_redis_connection
 
+from django.test.utils import override_settings
 from django.urls import reverse
+from django.utils import timezone
 
 from casepro.contacts.models import Field, Group
 from casepro.test import BaseCasesTest, TestBackend
 
+from . import scheduler
 from .models import Flow
+from .tasks import run_org_task, schedule_org_task, send_heartbeats
 
 
 class OrgExtTest(BaseCasesTest):
@@ -197,3 +205,222 @@ class TaskExtCRUDLTest(BaseCasesTest):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(list(response.context["object_list"]), [state2, state1])
+
+
+class SchedulerTest(BaseCasesTest):
+    def set_last_run(self, org, task_key, ago, duration):
+        ended_on = timezone.now() - ago
+        state = TaskState.get_or_create(org, task_key)
+        state.started_on = ended_on - duration
+        state.ended_on = ended_on
+        state.save()
+
+    def test_get_weights(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        for m in range(99):
+            self.create_message(self.unicef, 100 + m, ann, "Hello")
+
+        self.set_last_run(self.unicef, "message-handle", timedelta(minutes=1), timedelta(seconds=9))
+
+        weights, states = scheduler.get_weights([self.unicef, self.nyaruka], "message-handle")
+
+        self.assertAlmostEqual(weights[self.unicef.id], 4.0)  # 1 + log10(1 + 99) + log10(1 + 9)
+        self.assertEqual(weights[self.nyaruka.id], 1.0)
+        self.assertEqual(set(states.keys()), {self.unicef.id})
+
+        # backlogs are only counted up to a maximum
+        get_redis_connection().delete(scheduler.BACKLOG_KEY % self.unicef.id)
+
+        with patch("casepro.orgs_ext.scheduler.BACKLOG_MAX", 9):
+            self.assertEqual(
+                scheduler.get_backlogs([self.unicef, self.nyaruka]), {self.unicef.id: 9, self.nyaruka.id: 0}
+            )
+
+    @override_settings(SYNC_SCHEDULER_MAX_QUEUED=1)
+    def test_select_orgs(self):
+        def select_orgs(task_key, now):
+            return scheduler.select_orgs([self.unicef, self.nyaruka], task_key, now)
+
+        now = time.time()
+
+        # orgs which have never run the task come first
+        self.set_last_run(self.unicef, "message-pull", timedelta(minutes=10), timedelta(seconds=1))
+
+        self.assertEqual(select_orgs("message-pull", now), [self.nyaruka])
+
+        # and are given the slot, so no other org can be selected until it's freed
+        self.assertEqual(select_orgs("message-pull", now), [])
+
+        scheduler.free_slot("message-pull", self.nyaruka.id)
+
+        # then orgs which have waited longest, weighted by their backlogs
+        self.set_last_run(self.nyaruka, "message-pull", timedelta(minutes=15), timedelta(seconds=1))
+
+        self.assertEqual(select_orgs("message-pull", now), [self.nyaruka])
+
+        scheduler.free_slot("message-pull", self.nyaruka.id)
+
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        for m in range(10):
+            self.create_message(self.unicef, 100 + m, ann, "Hello")
+
+        # backlogs are cached briefly
+        self.assertEqual(select_orgs("message-pull", now), [self.nyaruka])
+
+        scheduler.free_slot("message-pull", self.nyaruka.id)
+        get_redis_connection().delete(scheduler.BACKLOG_KEY % self.unicef.id)
+
+        self.assertEqual(select_orgs("message-pull", now), [self.unicef])
+
+        # other tasks have their own slots
+        self.assertEqual(select_orgs("contact-pull", now), [self.unicef])
+
+        # a slot is freed if its task doesn't start within the queued timeout, as it must have been lost
+        self.assertEqual(select_orgs("message-pull", now + 14 * 60), [])
+        self.assertEqual(select_orgs("message-pull", now + 16 * 60), [self.unicef])
+
+        # a running task keeps its slot while it's heartbeating
+        scheduler.record_running("message-pull", self.unicef.id, now + 20 * 60)
+
+        self.assertEqual(select_orgs("message-pull", now + 21 * 60), [])
+
+        # but loses it soon after it stops, e.g. because its worker was killed
+        self.assertEqual(select_orgs("message-pull", now + 23 * 60), [self.unicef])
+
+        # or when it finishes
+        scheduler.record_finished("message-pull", self.unicef.id, now, now + 1, now + 3, failed=False)
+
+        self.assertEqual(select_orgs("message-pull", now + 23 * 60), [self.unicef])
+
+        self.assertEqual(
+            scheduler.get_metrics("message-pull", self.nyaruka),
+            {
+                "runs": 0,
+                "failures": 0,
+                "skipped": 6,
+                "last_wait": None,
+                "last_duration": None,
+                "total_duration": 0.0,
+            },
+        )
+        self.assertEqual(
+            scheduler.get_metrics("message-pull", self.unicef),
+            {
+                "runs": 1,
+                "failures": 0,
+                "skipped": 4,
+                "last_wait": 1.0,
+                "last_duration": 2.0,
+                "total_duration": 2.0,
+            },
+        )
+
+    @override_settings(SYNC_SCHEDULER_MAX_QUEUED=2)
+    def test_claim_slots(self):
+        now = time.time()
+
+        self.assertEqual(scheduler.claim_slots("message-pull", [self.unicef.id], now, now + 60), {self.unicef.id})
+
+        # orgs which already have a slot aren't given another, and only as many orgs as there are free slots get one
+        org3 = self.create_org("Org 3", timezone="Africa/Kigali", subdomain="org3")
+        self.assertEqual(
+            scheduler.claim_slots("message-pull", [self.unicef.id, self.nyaruka.id, org3.id], now, now + 60),
+            {self.nyaruka.id},
+        )
+
+        # a waiting org can only be given a slot when one is free
+        scheduler.record_waiting("message-pull", {org3.id: 10.0})
+
+        self.assertIsNone(scheduler.pop_waiting("message-pull", now))
+
+        scheduler.free_slot("message-pull", self.unicef.id)
+
+        self.assertEqual(scheduler.pop_waiting("message-pull", now), org3.id)
+        self.assertEqual(scheduler.claim_slots("message-pull", [self.unicef.id], now, now + 60), set())
+        self.assertIsNone(scheduler.pop_waiting("message-pull", now + 61))  # slots expired but no orgs waiting
+
+    @override_settings(SYNC_SCHEDULER_MAX_QUEUED=1)
+    @patch("casepro.orgs_ext.tasks.run_org_task.apply_async")
+    def test_schedule_org_task(self, mock_apply_async):
+        schedule_org_task("casepro.msgs.tasks.handle_messages", "message-handle", "sync")
+
+        self.assertEqual(len(mock_apply_async.call_args_list), 1)
+
+        task_name, task_key, org_id, queued_on = mock_apply_async.call_args.kwargs["args"]
+        self.assertEqual((task_name, task_key), ("casepro.msgs.tasks.handle_messages", "message-handle"))
+        self.assertEqual(mock_apply_async.call_args.kwargs["queue"], "sync")
+
+        # the other org won't be queued until the first one's task has finished
+        schedule_org_task("casepro.msgs.tasks.handle_messages", "message-handle", "sync")
+
+        self.assertEqual(len(mock_apply_async.call_args_list), 1)
+
+        # at which point it's queued straight away rather than waiting to be scheduled again
+        run_org_task("casepro.msgs.tasks.handle_messages", "message-handle", org_id, queued_on, queue="sync")
+
+        self.assertEqual(len(mock_apply_async.call_args_list), 2)
+        self.assertNotEqual(mock_apply_async.call_args.kwargs["args"][2], org_id)
+        self.assertEqual(mock_apply_async.call_args.kwargs["queue"], "sync")
+
+        next_org_id = mock_apply_async.call_args.kwargs["args"][2]
+
+        # and there are no more orgs waiting so finishing that doesn't queue anything
+        run_org_task("casepro.msgs.tasks.handle_messages", "message-handle", next_org_id, queued_on, queue="sync")
+
+        self.assertEqual(len(mock_apply_async.call_args_list), 2)
+
+        # until the next scheduling
+        schedule_org_task("casepro.msgs.tasks.handle_messages", "message-handle", "sync")
+
+        self.assertEqual(len(mock_apply_async.call_args_list), 3)
+
+    @patch("casepro.orgs_ext.scheduler.HEARTBEAT_INTERVAL", 0.01)
+    def test_send_heartbeats(self):
+        r = get_redis_connection()
+        queued_key = scheduler.QUEUED_KEY % "message-handle"
+        now = time.time()
+
+        scheduler.claim_slots("message-handle", [self.unicef.id], now, now + 60)
+
+        # a running task renews its slot until it's stopped
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=send_heartbeats, args=("message-handle", self.unicef.id, now, stop))
+        heartbeat.start()
+
+        for i in range(500):
+            if r.zscore(queued_key, str(self.unicef.id)) > now + 60:
+                break
+            time.sleep(0.01)
+
+        stop.set()
+        heartbeat.join()
+
+        self.assertGreater(r.zscore(queued_key, str(self.unicef.id)), now + 60)
+
+        # heartbeats don't claim slots which have been freed
+        scheduler.free_slot("message-handle", self.unicef.id)
+        scheduler.record_running("message-handle", self.unicef.id, time.time())
+
+        self.assertIsNone(r.zscore(queued_key, str(self.unicef.id)))
+
+        # and stop once the task's lock timeout has passed
+        scheduler.claim_slots("message-handle", [self.unicef.id], now, now + 60)
+        send_heartbeats("message-handle", self.unicef.id, now - 13 * 60 * 60, threading.Event())
+
+        self.assertEqual(r.zscore(queued_key, str(self.unicef.id)), now + 60)
+
+    def test_run_org_task(self):
+        run_org_task("casepro.msgs.tasks.handle_messages", "message-handle", self.unicef.id, time.time())
+
+        self.assertIsNotNone(self.unicef.get_task_state("message-handle").ended_on)
+
+        metrics = scheduler.get_metrics("message-handle", self.unicef)
+        self.assertEqual((metrics["runs"], metrics["failures"]), (1, 0))
+
+        # failures are recorded and re-raised
+        with patch("casepro.msgs.models.Message.get_unhandled", side_effect=ValueError("boom")):
+            with self.assertRaises(ValueError):
+                run_org_task("casepro.msgs.tasks.handle_messages", "message-handle", self.unicef.id, time.time())
+
+        metrics = scheduler.get_metrics("message-handle", self.unicef)
+        self.assertEqual((metrics["runs"], metrics["failures"]), (2, 1))
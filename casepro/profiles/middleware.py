@@ -1,10 +1,16 @@
+import logging
+
 from django.contrib import messages
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 
+from .models import UserOrgCache
+
 ALLOW_NO_CHANGE = {"profiles.user_self", "users.user_logout"}
 
+logger = logging.getLogger(__name__)
+
 
 class ForcePasswordChangeMiddleware:
     """
@@ -27,3 +33,25 @@ class ForcePasswordChangeMiddleware:
             if url_name not in ALLOW_NO_CHANGE:
                 messages.info(request, _("You are required to change your password"))
                 return HttpResponseRedirect(reverse("profiles.user_self"))
+
+
+class UserOrgCacheMiddleware:
+    """
+    Middleware to give the logged in user a request-scoped cache of their partner and role in each org, so these are
+    only fetched from the database once per request
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        cache = UserOrgCache.attach(request.user) if request.user.is_authenticated else None
+
+        response = self.get_response(request)
+
+        if cache and cache.hits:
+            logger.debug(
+                "%s used cached partner and role %d times, saving at least as many queries", request.path, cache.hits
+            )
+
+        return response
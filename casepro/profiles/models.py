@@ -122,6 +122,26 @@ class Notification(models.Model):
     def new_message_labelling(cls, org, user, message):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_MESSAGE_LABELLING, message=message)
 
+    @classmethod
+    def bulk_new_message_labelling(cls, org, users, messages):
+        """
+        Creates message labelling notifications for all the given users and messages, skipping any that exist
+        """
+        existing = set(
+            cls.objects.filter(
+                org=org, user__in=users, type=cls.TYPE_MESSAGE_LABELLING, message__in=messages
+            ).values_list("user_id", "message_id")
+        )
+
+        cls.objects.bulk_create(
+            [
+                cls(org=org, user=user, type=cls.TYPE_MESSAGE_LABELLING, message=message)
+                for user in users
+                for message in messages
+                if (user.id, message.id) not in existing
+            ]
+        )
+
     @classmethod
     def new_case_assignment(cls, org, user, case_action):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_CASE_ASSIGNMENT, case_action=case_action)
@@ -134,6 +154,30 @@ class Notification(models.Model):
     def new_case_reply(cls, org, user, message):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_CASE_REPLY, message=message)
 
+    @classmethod
+    def bulk_new_case_reply(cls, org, user_ids_by_message):
+        """
+        Creates case reply notifications for the given messages and the ids of the users to notify, skipping any that
+        exist
+        """
+        if not user_ids_by_message:
+            return
+
+        existing = set(
+            cls.objects.filter(org=org, type=cls.TYPE_CASE_REPLY, message__in=user_ids_by_message.keys()).values_list(
+                "user_id", "message_id"
+            )
+        )
+
+        cls.objects.bulk_create(
+            [
+                cls(org=org, user_id=user_id, type=cls.TYPE_CASE_REPLY, message=message)
+                for message, user_ids in user_ids_by_message.items()
+                for user_id in user_ids
+                if (user_id, message.id) not in existing
+            ]
+        )
+
     @classmethod
     def send_all(cls):
         unsent = cls.objects.filter(is_sent=False)
@@ -220,25 +264,73 @@ def _user_get_full_name(user):
     return user.profile.full_name if user.has_profile() else " ".join([user.first_name, user.last_name]).strip()
 
 
+class UserOrgCache:
+    """
+    Request-scoped cache of a user's partner and role in each org, attached to the user by UserOrgCacheMiddleware
+    """
+
+    ATTR = "_org_cache"
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+
+    def get(self, name, org, calculate):
+        key = (name, org.pk)
+        if key in self.values:
+            self.hits += 1
+            return self.values[key]
+
+        self.values[key] = calculate()
+        return self.values[key]
+
+    def clear(self):
+        self.values.clear()
+
+    @classmethod
+    def attach(cls, user):
+        cache = cls()
+        setattr(user, cls.ATTR, cache)
+        return cache
+
+    @classmethod
+    def lookup(cls, user, name, org, calculate):
+        """
+        Looks up a value using the user's cache if it has one, or just calculates it if not
+        """
+        cache = getattr(user, cls.ATTR, None)
+        return cache.get(name, org, calculate) if cache is not None else calculate()
+
+    @classmethod
+    def clear_for(cls, user):
+        cache = getattr(user, cls.ATTR, None)
+        if cache is not None:
+            cache.clear()
+
+
 def _user_get_partner(user, org):
     """
     Gets the partner org for this user in the given org
     """
-    return user.partners.filter(org=org, is_active=True).first()
+    return UserOrgCache.lookup(user, "partner", org, lambda: user.partners.filter(org=org, is_active=True).first())
 
 
 def _user_get_role(user, org):
     """
     Gets the role as a character code for this user in the given org
     """
-    if user in org.administrators.all():
-        return ROLE_ADMIN
-    elif user in org.editors.all():
-        return ROLE_MANAGER
-    elif user in org.viewers.all():
-        return ROLE_ANALYST
-    else:
-        return None
+
+    def calculate():
+        if user in org.administrators.all():
+            return ROLE_ADMIN
+        elif user in org.editors.all():
+            return ROLE_MANAGER
+        elif user in org.viewers.all():
+            return ROLE_ANALYST
+        else:
+            return None
+
+    return UserOrgCache.lookup(user, "role", org, calculate)
 
 
 def _user_update_role(user, org, role, partner=None):
@@ -253,6 +345,8 @@ def _user_update_role(user, org, role, partner=None):
     elif role not in PARTNER_ROLES and partner:
         raise ValueError("Cannot specify a partner for role %s" % role)
 
+    UserOrgCache.clear_for(user)
+
     remove_from = [p for p in user.partners_primary.filter(org=org) if p != partner]
     user.partners_primary.remove(*remove_from)
 
@@ -278,6 +372,8 @@ def _user_update_role(user, org, role, partner=None):
 
 
 def _user_remove_from_org(user, org):
+    UserOrgCache.clear_for(user)
+
     # remove user from all org groups
     org.administrators.remove(user)
     org.editors.remove(user)
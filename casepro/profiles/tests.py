@@ -2,13 +2,16 @@ from datetime import datetime
 from unittest.mock import call, patch
 
 from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import RequestFactory
 from django.test.utils import override_settings
 from django.urls import reverse
 from django.utils import timezone
 
 from casepro.test import BaseCasesTest
 
-from .models import ROLE_ADMIN, ROLE_ANALYST, ROLE_MANAGER, Notification, Profile
+from .middleware import UserOrgCacheMiddleware
+from .models import ROLE_ADMIN, ROLE_ANALYST, ROLE_MANAGER, Notification, Profile, UserOrgCache
 from .tasks import send_notifications
 
 
@@ -222,6 +225,32 @@ class UserTest(BaseCasesTest):
         self.assertEqual(self.user4.get_role(self.unicef), None)
         self.assertEqual(self.admin.get_role(self.nyaruka), None)
 
+    def test_org_cache(self):
+        user = User.objects.get(pk=self.user1.pk)
+        cache = UserOrgCache.attach(user)
+
+        with self.assertNumQueries(3):
+            self.assertEqual(user.get_partner(self.unicef), self.moh)
+            self.assertEqual(user.get_role(self.unicef), ROLE_MANAGER)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(user.get_partner(self.unicef), self.moh)
+            self.assertEqual(user.get_role(self.unicef), ROLE_MANAGER)
+
+        self.assertEqual(cache.hits, 2)
+
+        # changing the user's role clears their cache
+        user.update_role(self.unicef, ROLE_ANALYST, self.who)
+
+        self.assertEqual(user.get_partner(self.unicef), self.who)
+        self.assertEqual(user.get_role(self.unicef), ROLE_ANALYST)
+
+        # as does removing them from the org
+        user.remove_from_org(self.unicef)
+
+        self.assertIsNone(user.get_partner(self.unicef))
+        self.assertIsNone(user.get_role(self.unicef))
+
     def test_update_role(self):
         # change role from manager to analyst, partner from moh to who
         self.user1.update_role(self.unicef, ROLE_ANALYST, self.who)
@@ -1286,3 +1315,28 @@ class ForcePasswordChangeMiddlewareTest(BaseCasesTest):
 
         response = self.url_get("unicef", reverse("cases.inbox"))
         self.assertEqual(response.status_code, 200)
+
+
+class UserOrgCacheMiddlewareTest(BaseCasesTest):
+    def test_call(self):
+        def get_response(request):
+            request.user.get_role(self.unicef)
+            request.user.get_role(self.unicef)
+            request.user.get_partner(self.unicef)
+            return HttpResponse()
+
+        middleware = UserOrgCacheMiddleware(get_response)
+
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(pk=self.user1.pk)
+
+        with self.assertLogs("casepro.profiles.middleware", level="DEBUG") as logs:
+            middleware(request)
+
+        self.assertEqual(
+            logs.output,
+            [
+                "DEBUG:casepro.profiles.middleware:/ used cached partner and role 1 times, saving at least as many queries"
+            ],
+        )
+        self.assertEqual(request.user._org_cache.hits, 1)
@@ -0,0 +1,101 @@
+import random
+import string
+import time
+
+import regex
+from dash.orgs.models import Org
+
+from django.core.management.base import BaseCommand
+
+from casepro.msgs.models import Message
+from casepro.rules.models import ContainsTest, Quantifier, Rule
+from casepro.utils import json_encode, normalize
+
+ORG_SIZES = (10, 100, 1000)  # number of labels (i.e. keyword rules) in each simulated org
+KEYWORDS_PER_RULE = 3
+WORDS_PER_MESSAGE = 20
+
+
+def regex_matches(rule, message):
+    """
+    Matches a message against a rule using the per-keyword regex search that ContainsTest used before keywords were
+    indexed, so that the index can be checked against it
+    """
+    text = normalize(message.text)
+
+    def keyword_check(w):
+        return lambda: bool(regex.search(r"\b" + w + r"\b", text, flags=regex.UNICODE | regex.V0))
+
+    for test in rule.get_tests():
+        if not test.quantifier.evaluate([keyword_check(keyword) for keyword in test.keywords]):
+            return False
+    return True
+
+
+class Command(BaseCommand):
+    help = "Benchmarks matching of messages against keyword rules as the number of rules grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000, help="The number of messages to match")
+        parser.add_argument("--seed", type=int, default=1, help="The seed for generating random keywords and text")
+
+    def handle(self, *args, **options):
+        rand = random.Random(options["seed"])
+        org = Org(name="Benchmark")
+
+        vocabulary = ["".join(rand.choices(string.ascii_lowercase, k=rand.randint(3, 8))) for w in range(5000)]
+        messages = [
+            Message(org=org, text=" ".join(rand.choices(vocabulary, k=WORDS_PER_MESSAGE)))
+            for m in range(options["messages"])
+        ]
+
+        self.stdout.write("Matching %d messages against rules...\n\n" % len(messages))
+        self.stdout.write("  labels | regex (us/msg) | indexed (us/msg) | matches")
+        self.stdout.write("---------|----------------|------------------|--------")
+
+        for num_rules in ORG_SIZES:
+            rules = [self.create_rule(org, rand.sample(vocabulary, KEYWORDS_PER_RULE)) for r in range(num_rules)]
+
+            # deserialize tests up front so that neither path includes that cost
+            for rule in rules:
+                rule.get_tests()
+
+            start = time.perf_counter()
+            regex_matches_by_msg = [{r for r, rule in enumerate(rules) if regex_matches(rule, m)} for m in messages]
+            regex_time = time.perf_counter() - start
+
+            processor = Rule.BatchProcessor(org, rules)
+
+            start = time.perf_counter()
+            num_indexed_matches, _ = processor.include_messages(*messages)
+            indexed_time = time.perf_counter() - start
+
+            # check that the index matched exactly the same rules for each message as the regex search
+            rule_set = processor.rule_set
+            rule_nums = {id(rule): r for r, rule in enumerate(rules)}
+            for message, expected in zip(messages, regex_matches_by_msg):
+                found_keywords = rule_set.keyword_index.search(normalize(message.text))
+                candidates = rule_set.get_candidate_rules(found_keywords)
+                indexed = {rule_nums[id(rule)] for rule in candidates if rule.matches(message, found_keywords)}
+
+                assert indexed == expected, "indexed matching gave different results for %r" % message.text
+
+            assert num_indexed_matches == sum(len(m) for m in regex_matches_by_msg)
+
+            self.stdout.write(
+                " %7d | %14.1f | %16.1f | %7d"
+                % (
+                    num_rules,
+                    regex_time * 1000000 / len(messages),
+                    indexed_time * 1000000 / len(messages),
+                    num_indexed_matches,
+                )
+            )
+
+    @staticmethod
+    def create_rule(org, keywords):
+        """
+        Creates an unsaved rule with no actions, so that it can be evaluated without touching the database
+        """
+        tests = [ContainsTest(keywords, Quantifier.ANY)]
+        return Rule(org=org, tests=json_encode(tests), actions=json_encode([]))
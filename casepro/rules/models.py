@@ -2,13 +2,15 @@ import json
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 from enum import Enum
+from uuid import uuid4
 
 import regex
 from celery.utils.log import get_task_logger
 from dash.orgs.models import Org
 from dash.utils import get_obj_cacheable
+from django_redis import get_redis_connection
 
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 
 from casepro.contacts.models import Group
@@ -16,6 +18,10 @@ from casepro.msgs.models import Label, Message
 from casepro.utils import json_encode, normalize
 
 KEYWORD_REGEX = regex.compile(r"^\w[\w\- ]*\w$", flags=regex.UNICODE | regex.V0)
+INDEXABLE_KEYWORD_REGEX = regex.compile(r"^\w(?:[\w\- ]*\w)?$", flags=regex.UNICODE | regex.V0)
+WORD_REGEX = regex.compile(r"\w+", flags=regex.UNICODE | regex.V0)
+
+RULE_SET_VERSION_KEY = "rule-set:%d:version"
 
 logger = get_task_logger(__name__)
 
@@ -61,6 +67,52 @@ class Quantifier(Enum):
         return str(self.text)
 
 
+class KeywordIndex(object):
+    """
+    An index of keywords which allows normalized text to be scanned once for all keywords, rather than once per keyword.
+    A keyword matches if it occurs in the text with word boundaries on either side.
+    """
+
+    def __init__(self, keywords):
+        self.by_first_word = defaultdict(set)
+        self.patterns = {}
+
+        for keyword in set(keywords):
+            if INDEXABLE_KEYWORD_REGEX.match(keyword):
+                # a keyword which starts and ends with word characters can only match at the start of a word, so we
+                # index it by its first word
+                self.by_first_word[WORD_REGEX.match(keyword).group(0)].add(keyword)
+            else:
+                # anything else (e.g. from a rule created before keywords were validated) falls back to a regex
+                self.patterns[keyword] = regex.compile(r"\b" + keyword + r"\b", flags=regex.UNICODE | regex.V0)
+
+    def search(self, text):
+        """
+        Searches the given normalized text for keywords
+        :param text: the normalized text
+        :return: the set of keywords found
+        """
+        found = set()
+        words = list(WORD_REGEX.finditer(text))
+        word_ends = {w.end() for w in words}
+
+        for word in words:
+            candidates = self.by_first_word.get(word.group(0))
+            if not candidates:
+                continue
+
+            start = word.start()
+            for keyword in candidates:
+                if keyword not in found and text.startswith(keyword, start) and (start + len(keyword)) in word_ends:
+                    found.add(keyword)
+
+        for keyword, pattern in self.patterns.items():
+            if pattern.search(text):
+                found.add(keyword)
+
+        return found
+
+
 class DeserializationContext(object):
     """
     Context object passed to all test or action from_json methods
@@ -111,6 +163,13 @@ class Test(object):
         Subclasses must implement this to return a boolean.
         """
 
+    def matches_indexed(self, message, found_keywords):
+        """
+        Returns whether this test matches the given message, given the keywords already found in its text by a
+        KeywordIndex. Only tests which depend on keywords need to override this.
+        """
+        return self.matches(message)
+
     def __eq__(self, other):  # pragma: no cover
         return other and self.TYPE == other.TYPE
 
@@ -141,15 +200,27 @@ class ContainsTest(Test):
         return "message contains %s %s" % (str(self.quantifier), ", ".join(quoted_keywords))
 
     def matches(self, message):
-        text = normalize(message.text)
+        found_keywords = KeywordIndex(self.keywords).search(normalize(message.text))
 
+        return self.matches_indexed(message, found_keywords)
+
+    def matches_indexed(self, message, found_keywords):
         def keyword_check(w):
-            return lambda: bool(regex.search(r"\b" + w + r"\b", text, flags=regex.UNICODE | regex.V0))
+            return lambda: w in found_keywords
 
         checks = [keyword_check(keyword) for keyword in self.keywords]
 
         return self.quantifier.evaluate(checks)
 
+    def get_required_keywords(self):
+        """
+        Gets the keywords of which at least one must be found for this test to match, or None if it can match without
+        any of them
+        """
+        if self.keywords and self.quantifier in (Quantifier.ANY, Quantifier.ALL):
+            return self.keywords
+        return None
+
     @classmethod
     def is_valid_keyword(cls, keyword):
         return KEYWORD_REGEX.match(keyword)
@@ -330,8 +401,7 @@ class LabelAction(Action):
         return "apply label '%s'" % self.label.name
 
     def apply_to(self, org, messages):
-        for msg in messages:
-            msg.label(self.label)
+        Message.label_messages(org, messages, [self.label])
 
         if self.label.is_synced:
             try:
@@ -435,15 +505,40 @@ class Rule(models.Model):
     def get_actions_description(self):
         return _(" and ").join([a.get_description() for a in self.get_actions()])
 
-    def matches(self, message):
+    def matches(self, message, found_keywords=None):
         """
         Returns whether this rule matches the given message, i.e. all of its tests match the message
+        :param message: the message
+        :param found_keywords: the keywords found in the message text by a KeywordIndex if already searched
         """
         for test in self.get_tests():
-            if not test.matches(message):
+            if found_keywords is not None:
+                matched = test.matches_indexed(message, found_keywords)
+            else:
+                matched = test.matches(message)
+
+            if not matched:
                 return False
         return True
 
+    def get_keywords(self):
+        """
+        Gets all keywords used by the tests of this rule
+        """
+        return [k for t in self.get_tests() if t.TYPE == ContainsTest.TYPE for k in t.keywords]
+
+    def get_required_keywords(self):
+        """
+        Gets keywords of which at least one must be found in a message for this rule to match, or None if this rule
+        can match messages without any keywords
+        """
+        for test in self.get_tests():
+            if test.TYPE == ContainsTest.TYPE:
+                required = test.get_required_keywords()
+                if required:
+                    return required
+        return None
+
     class BatchProcessor(object):
         """
         Applies a set of rules to a batch of messages in a way that allows same actions to be merged and reduces needed
@@ -452,7 +547,7 @@ class Rule(models.Model):
 
         def __init__(self, org, rules):
             self.org = org
-            self.rules = rules
+            self.rule_set = rules if isinstance(rules, RuleSet) else RuleSet(rules)
             self.messages_by_action = defaultdict(set)
 
         def include_messages(self, *messages):
@@ -465,8 +560,10 @@ class Rule(models.Model):
             num_actions_deferred = 0
 
             for message in messages:
-                for rule in self.rules:
-                    if rule.matches(message):
+                found_keywords = self.rule_set.keyword_index.search(normalize(message.text))
+
+                for rule in self.rule_set.get_candidate_rules(found_keywords):
+                    if rule.matches(message, found_keywords):
                         num_rules_matched += 1
                         for action in rule.get_actions():
                             self.messages_by_action[action].add(message)
@@ -480,3 +577,78 @@ class Rule(models.Model):
             """
             for action, messages in self.messages_by_action.items():
                 action.apply_to(self.org, messages)
+
+
+class RuleSet(object):
+    """
+    A set of rules with their tests and actions deserialized, and their keywords indexed. The rule set for each org is
+    cached in each process, and reloaded when the version for that org in Redis changes.
+    """
+
+    CACHE = {}  # org id -> (version, rule set)
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        # build a single index of the keywords of all rules, and a lookup of which rules could match when a given
+        # keyword is found, so that each message only needs to be scanned once and only candidate rules checked
+        self.keyword_index = KeywordIndex([k for r in self.rules for k in r.get_keywords()])
+        self.rules_by_keyword = defaultdict(set)
+        self.unindexed_rules = set()
+
+        for r, rule in enumerate(self.rules):
+            required = rule.get_required_keywords()
+            if required:
+                for keyword in required:
+                    self.rules_by_keyword[keyword].add(r)
+            else:
+                self.unindexed_rules.add(r)
+
+            rule.get_actions()  # so that actions are also deserialized once for the lifetime of this set
+
+    @classmethod
+    def get_for_org(cls, org):
+        """
+        Gets the rule set for the given org, from the cache if it's still current
+        """
+        version = cls.get_version(org.id)
+        cached = cls.CACHE.get(org.id)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        rule_set = cls(Rule.get_all(org))
+        cls.CACHE[org.id] = (version, rule_set)
+        return rule_set
+
+    @classmethod
+    def get_version(cls, org_id):
+        r = get_redis_connection()
+        key = RULE_SET_VERSION_KEY % org_id
+
+        version = r.get(key)
+        if version is None:
+            r.set(key, uuid4().hex, nx=True)
+            version = r.get(key)
+
+        return version
+
+    @classmethod
+    def invalidate(cls, org_id):
+        """
+        Invalidates the cached rule set for the given org in all processes. Takes an id rather than an org so that
+        callers like signal handlers don't need to load the org. The version is only changed once the current
+        transaction commits, as otherwise another process could cache the old rules under the new version.
+        """
+        transaction.on_commit(lambda: get_redis_connection().set(RULE_SET_VERSION_KEY % org_id, uuid4().hex))
+
+        cls.CACHE.pop(org_id, None)
+
+    def get_candidate_rules(self, found_keywords):
+        """
+        Gets the rules which could match a message in which the given keywords were found, in their original order
+        """
+        candidates = set(self.unindexed_rules)
+        for keyword in found_keywords:
+            candidates.update(self.rules_by_keyword.get(keyword, ()))
+
+        return [self.rules[r] for r in sorted(candidates)]
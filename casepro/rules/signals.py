@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from casepro.contacts.models import Group
+from casepro.msgs.models import Label
+
+from .models import Rule, RuleSet
+
+
+@receiver(post_save, sender=Rule)
+@receiver(post_delete, sender=Rule)
+@receiver(post_save, sender=Label)
+@receiver(post_save, sender=Group)
+def invalidate_rule_set(sender, instance, **kwargs):
+    """
+    Invalidates the cached rule set of the org when a rule, or a label or group which rules may reference, changes
+    """
+    RuleSet.invalidate(instance.org_id)
@@ -1,9 +1,12 @@
 from unittest.mock import call, patch
 
+import regex
+
 from django.urls import reverse
 
 from casepro.msgs.models import Message
 from casepro.test import BaseCasesTest
+from casepro.utils import normalize
 
 from .models import (
     Action,
@@ -13,9 +16,11 @@ from .models import (
     FieldTest,
     FlagAction,
     GroupsTest,
+    KeywordIndex,
     LabelAction,
     Quantifier,
     Rule,
+    RuleSet,
     Test,
     WordCountTest,
 )
@@ -134,6 +139,64 @@ class TestsTest(BaseCasesTest):
         self.assertFalse(ContainsTest.is_valid_keyword("kat-"))  # can't end with a dash
 
 
+class KeywordIndexTest(BaseCasesTest):
+    def test_search(self):
+        index = KeywordIndex(["red", "kit", "kit kat", "kit-kat", "tu\u0301", "a.c"])
+
+        self.assertEqual(index.search(""), set())
+        self.assertEqual(index.search("fred blueth"), set())
+        self.assertEqual(index.search("red kit"), {"red", "kit"})
+        self.assertEqual(index.search("a kit kat bar"), {"kit", "kit kat"})
+        self.assertEqual(index.search("kit-kat"), {"kit", "kit-kat"})
+        self.assertEqual(index.search("kit katy"), {"kit"})
+        self.assertEqual(index.search("kitkat"), set())
+        self.assertEqual(index.search("tu\u0301 eres"), {"tu\u0301"})
+        self.assertEqual(index.search("tu eres"), set())
+
+        # keywords which aren't valid are still matched as regexes
+        self.assertEqual(index.search("abc"), {"a.c"})
+
+    def test_same_as_regex_search(self):
+        def regex_search(keywords, text):
+            """
+            The per-keyword regex search which ContainsTest used before keywords were indexed
+            """
+            text = normalize(text)
+            return {w for w in keywords if regex.search(r"\b" + w + r"\b", text, flags=regex.UNICODE | regex.V0)}
+
+        keywords = [
+            normalize(k)
+            for k in ("red", "kit", "kit kat", "kit-kat", "Tú", "a.c", "hiv", "hiv-aids", "aids", "co2", "x", "kit ")
+        ]
+        texts = [
+            "",
+            "Fred Blueth",
+            "RED kit",
+            "a kit  kat bar",
+            "kit-kat kit_kat kitkat",
+            "¿Tú? tu, TÚ!",
+            "abc a-c a.c",
+            "HIV/AIDS hiv-aids hiv--aids",
+            "CO2 co2x x-ray x",
+            "kit kit",
+            "red\nkit\tkat",
+        ]
+
+        index = KeywordIndex(keywords)
+
+        for text in texts:
+            self.assertEqual(index.search(normalize(text)), regex_search(keywords, text), text)
+
+            for keyword in keywords:
+                for quantifier in (Quantifier.ANY, Quantifier.ALL, Quantifier.NONE):
+                    test = ContainsTest([keyword, "red"], quantifier)
+                    expected = quantifier.evaluate(
+                        [lambda w=w: w in regex_search(test.keywords, text) for w in test.keywords]
+                    )
+
+                    self.assertEqual(test.matches(Message(text=text)), expected, (text, keyword, quantifier))
+
+
 class RulesTemplateTagsTest(BaseCasesTest):
     def setUp(self):
         super(RulesTemplateTagsTest, self).setUp()
@@ -391,6 +454,70 @@ class RuleTest(BaseCasesTest):
 
         self.assertEqual(set(Message.objects.filter(is_archived=True)), {msg3, msg4})
 
+    def test_batch_processor_unindexed_rules(self):
+        msg1 = self.create_message(self.unicef, 101, self.ann, "What is AIDS?")
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Hello")
+
+        # a rule which matches without any keywords present, and one which needs all of its keywords
+        rule1 = self.create_rule(self.unicef, [ContainsTest(["aids", "hiv"], Quantifier.NONE)], [FlagAction()])
+        rule2 = self.create_rule(self.unicef, [ContainsTest(["what", "aids"], Quantifier.ALL)], [ArchiveAction()])
+
+        processor = Rule.BatchProcessor(self.unicef, [rule1, rule2])
+
+        self.assertEqual(processor.include_messages(msg1, msg2), (2, 2))
+        self.assertEqual(dict(processor.messages_by_action), {FlagAction(): {msg2}, ArchiveAction(): {msg1}})
+
+
+class RuleSetTest(BaseCasesTest):
+    def test_get_for_org(self):
+        rule_set = RuleSet.get_for_org(self.unicef)
+        self.assertEqual(len(rule_set.rules), 3)
+        self.assertEqual(
+            set(rule_set.rules_by_keyword.keys()), {"aids", "hiv", "pregnant", "pregnancy", "tea", "chai"}
+        )
+
+        # fetching again uses the cached rule set without any database queries
+        with self.assertNumQueries(0):
+            self.assertIs(RuleSet.get_for_org(self.unicef), rule_set)
+
+        # changing the tests of a label invalidates the cached set
+        self.tea.update_tests([ContainsTest(["coffee"], Quantifier.ANY)])
+
+        rule_set = RuleSet.get_for_org(self.unicef)
+        self.assertEqual(len(rule_set.rules), 3)
+        self.assertIn("coffee", rule_set.rules_by_keyword)
+        self.assertNotIn("tea", rule_set.rules_by_keyword)
+
+        # as does releasing a label
+        self.tea.release()
+
+        rule_set = RuleSet.get_for_org(self.unicef)
+        self.assertEqual(len(rule_set.rules), 2)
+        self.assertNotIn("coffee", rule_set.rules_by_keyword)
+
+        # as does a group being changed, e.g. by a sync
+        self.females.name = "Women"
+        self.females.save(update_fields=("name",))
+
+        self.assertIsNot(RuleSet.get_for_org(self.unicef), rule_set)
+
+        # as does a change in the version by another process
+        rule_set = RuleSet.get_for_org(self.unicef)
+        RuleSet.CACHE[self.unicef.id] = (b"stale", rule_set)
+
+        self.assertIsNot(RuleSet.get_for_org(self.unicef), rule_set)
+
+        # other processes only see a new version once the change is committed
+        version = RuleSet.get_version(self.unicef.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            RuleSet.invalidate(self.unicef.id)
+            self.assertEqual(RuleSet.get_version(self.unicef.id), version)
+
+        self.assertNotEqual(RuleSet.get_version(self.unicef.id), version)
+
+        # other orgs have their own rule sets
+        self.assertEqual(len(RuleSet.get_for_org(self.nyaruka).rules), 1)
+
 
 class RuleCRUDLTest(BaseCasesTest):
     def test_list(self):
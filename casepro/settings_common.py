@@ -66,6 +66,8 @@ SITE_CONTACT_DISPLAY = "name"  # Overrules SITE_HIDE_CONTACT_FIELDS Options: 'na
 SITE_REDACT_URNS = True
 SITE_ALLOW_CASE_WITHOUT_MESSAGE = True
 SITE_MAX_MESSAGE_CHARS = 160  # the max value for this is 800
+SITE_SEARCH_BY_TEXT_DAYS = 90  # text searches only include this many days of messages, None for all messages
+SITE_EXPORT_FORMAT = "csv"  # Options: 'csv' or 'xls' (held in memory so only suitable for small exports)
 
 # junebug configuration
 JUNEBUG_API_ROOT = "http://localhost:8080/"
@@ -145,6 +147,7 @@ MIDDLEWARE = (
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "dash.orgs.middleware.SetOrgMiddleware",
+    "casepro.profiles.middleware.UserOrgCacheMiddleware",
     "casepro.utils.middleware.JSONMiddleware",
     "casepro.profiles.middleware.ForcePasswordChangeMiddleware",
 )
@@ -170,6 +173,28 @@ ORG_CONFIG_FIELDS = [
 # number of days after which incoming messages which don't belong to a case and haven't been labelled, can be deleted
 TRIM_OLD_MESSAGES_DAYS = None
 
+# unhandled messages are handled in batches of about this size (a contact's messages are never split across batches),
+# and batches can be handled in parallel by more than one worker thread
+HANDLE_MESSAGES_BATCH_SIZE = 1000
+HANDLE_MESSAGES_WORKERS = 1
+
+# org sync tasks are queued by a scheduler which allows at most this many orgs to have each task queued or running at
+# once, giving free slots to the orgs which have waited longest, weighted by their backlogs. Tasks which haven't started
+# this many seconds after being queued are assumed to have been lost, and running tasks keep their slots by heartbeat.
+SYNC_SCHEDULER_MAX_QUEUED = 10
+SYNC_SCHEDULER_QUEUED_TIMEOUT = 15 * 60
+
+# how many seconds a client's push stream (/push/) stays open before it reconnects. Streams should be served by an ASGI
+# worker (casepro.asgi) so that open streams don't each hold a thread.
+PUSH_STREAM_SECONDS = 5 * 60
+
+# how long each org task can run before its lock expires and it's no longer considered running
+ORG_TASK_LOCK_TIMEOUTS = {
+    "message-pull": 2 * 60 * 60,
+    "contact-pull": 2 * 60 * 60,
+    "message-handle": 12 * 60 * 60,
+}
+
 INSTALLED_APPS = (
     "django.contrib.auth",
     "django.contrib.contenttypes",
@@ -431,23 +456,24 @@ CELERY_RESULT_BACKEND = None  # task results are stored internally
 CELERY_TIMEZONE = "UTC"
 CELERY_BEAT_SCHEDULE = {
     "message-pull": {
-        "task": "dash.orgs.tasks.trigger_org_task",
+        "task": "casepro.orgs_ext.tasks.schedule_org_task",
         "schedule": timedelta(minutes=1),
-        "args": ("casepro.msgs.tasks.pull_messages", "sync"),
+        "args": ("casepro.msgs.tasks.pull_messages", "message-pull", "sync"),
     },
     "contact-pull": {
-        "task": "dash.orgs.tasks.trigger_org_task",
+        "task": "casepro.orgs_ext.tasks.schedule_org_task",
         "schedule": timedelta(minutes=3),
-        "args": ("casepro.contacts.tasks.pull_contacts", "sync"),
+        "args": ("casepro.contacts.tasks.pull_contacts", "contact-pull", "sync"),
     },
     "message-handle": {
-        "task": "dash.orgs.tasks.trigger_org_task",
+        "task": "casepro.orgs_ext.tasks.schedule_org_task",
         "schedule": timedelta(minutes=1),
-        "args": ("casepro.msgs.tasks.handle_messages", "sync"),
+        "args": ("casepro.msgs.tasks.handle_messages", "message-handle", "sync"),
     },
     "squash-counts": {"task": "casepro.statistics.tasks.squash_counts", "schedule": timedelta(minutes=5)},
     "send-notifications": {"task": "casepro.profiles.tasks.send_notifications", "schedule": timedelta(minutes=1)},
     "trim-old-messages": {"task": "casepro.msgs.tasks.trim_old_messages", "schedule": crontab(hour=22, minute=0)},
+    "trim-message-changes": {"task": "casepro.msgs.tasks.trim_message_changes", "schedule": timedelta(hours=1)},
 }
 
 # -----------------------------------------------------------------------------------
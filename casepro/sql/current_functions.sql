@@ -1,5 +1,91 @@
 -- Generated by collect_sql on 2021-07-12 22:09 UTC
 
+----------------------------------------------------------------------
+-- Trigger function to maintain open/closed case counts when cases are labelled or unlabelled
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_labels_on_change() RETURNS TRIGGER AS $$
+DECLARE
+  _row cases_case_labels;
+  _case cases_case;
+  _delta INT;
+  _item_type CHAR(1);
+BEGIN
+  IF TG_OP = 'INSERT' THEN _row := NEW; _delta := 1; ELSE _row := OLD; _delta := -1; END IF;
+
+  SELECT * INTO _case FROM cases_case WHERE id = _row.case_id;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  _item_type := CASE WHEN _case.closed_on IS NULL THEN 'O' ELSE 'X' END;
+
+  INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+  VALUES(_item_type, 'label:' || _row.label_id, _delta, FALSE);
+
+  -- partners with access to this label gain or lose the case, unless they can see it anyway
+  INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+  SELECT _item_type, 'partner:' || pl.partner_id, _delta, FALSE FROM cases_partner_labels pl
+  INNER JOIN msgs_label l ON l.id = pl.label_id AND l.is_active = TRUE
+  WHERE pl.label_id = _row.label_id
+  AND pl.partner_id NOT IN (SELECT cases_case_partner_ids(_case.id, _case.assignee_id, _row.label_id));
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain open/closed case counts when cases are opened, closed, reopened or reassigned
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_on_change() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' AND (OLD.closed_on IS NULL) = (NEW.closed_on IS NULL) AND OLD.assignee_id = NEW.assignee_id THEN
+    RETURN NULL;
+  END IF;
+
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM cases_record_case_counts(OLD, -1);
+  END IF;
+
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM cases_record_case_counts(NEW, 1);
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Utility function to get the partners which can see a case, i.e. its assignee and partners with any of its labels
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_partner_ids(_case_id INT, _assignee_id INT, _exclude_label_id INT) RETURNS SETOF INT AS $$
+BEGIN
+  RETURN QUERY
+    SELECT _assignee_id
+    UNION
+    SELECT pl.partner_id FROM cases_case_labels cl
+    INNER JOIN msgs_label l ON l.id = cl.label_id AND l.is_active = TRUE
+    INNER JOIN cases_partner_labels pl ON pl.label_id = cl.label_id
+    WHERE cl.case_id = _case_id AND cl.label_id IS DISTINCT FROM _exclude_label_id;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Utility function to add or remove a case from the open/closed case counts of its org, labels and partners
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_record_case_counts(_case cases_case, _delta INT) RETURNS VOID AS $$
+DECLARE
+  _item_type CHAR(1) := CASE WHEN _case.closed_on IS NULL THEN 'O' ELSE 'X' END;
+BEGIN
+  INSERT INTO statistics_totalcount("item_type", "scope", "count", "is_squashed")
+  SELECT _item_type, 'org:' || _case.org_id, _delta, FALSE
+  UNION ALL
+  SELECT _item_type, 'label:' || label_id, _delta, FALSE FROM cases_case_labels WHERE case_id = _case.id
+  UNION ALL
+  SELECT _item_type, 'partner:' || partner_id, _delta, FALSE
+  FROM cases_case_partner_ids(_case.id, _case.assignee_id, NULL) AS partner_id;
+END;
+$$ LANGUAGE plpgsql;
+
 ----------------------------------------------------------------------
 -- Utility function to check whether message belongs in archived folder
 ----------------------------------------------------------------------
@@ -65,7 +151,7 @@ END;
 $$ LANGUAGE plpgsql;
 
 ----------------------------------------------------------------------
--- Trigger function to maintain label counts
+-- Trigger function to maintain label counts and record changes for inbox refreshes
 ----------------------------------------------------------------------
 CREATE OR REPLACE FUNCTION msgs_message_on_change() RETURNS TRIGGER AS $$
 DECLARE
@@ -103,6 +189,17 @@ BEGIN
     -- ensure message fields on label m2m are in sync
     UPDATE msgs_message_labels SET message_is_archived = NEW.is_archived, message_is_flagged = NEW.is_flagged WHERE message_id = NEW.id;
 
+    -- record changes to handled messages so that clients can refresh without scanning by modified_on
+    IF NEW.is_handled AND NEW.modified_on IS DISTINCT FROM OLD.modified_on THEN
+      INSERT INTO msgs_messagechange("org_id", "message_id", "kind", "created_on")
+      VALUES(NEW.org_id, NEW.id, CASE WHEN NOT OLD.is_handled THEN 'H' WHEN NOT NEW.is_active THEN 'D' ELSE 'U' END, NOW());
+    END IF;
+
+  ELSIF TG_OP = 'INSERT' AND NEW.is_handled THEN
+
+    -- messages can also be created as already handled
+    INSERT INTO msgs_messagechange("org_id", "message_id", "kind", "created_on") VALUES(NEW.org_id, NEW.id, 'H', NOW());
+
   END IF;
 
   RETURN NULL;
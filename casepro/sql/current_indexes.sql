@@ -16,6 +16,15 @@ CREATE INDEX msgs_archived
 ON msgs_message(org_id, created_on DESC)
 WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = TRUE;
 
+-- for searching FAQ answers with ILIKE (requires pg_trgm)
+CREATE INDEX msgs_faq_answer_trgm ON msgs_faq USING GIN (answer gin_trgm_ops);
+
+-- for filtering FAQs by their own or their parent's labels
+CREATE INDEX msgs_faq_label_ids ON msgs_faq USING GIN (label_ids);
+
+-- for searching FAQ questions with ILIKE (requires pg_trgm)
+CREATE INDEX msgs_faq_question_trgm ON msgs_faq USING GIN (question gin_trgm_ops);
+
 CREATE INDEX msgs_flagged
 ON msgs_message(org_id, created_on DESC)
 WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = FALSE AND is_flagged = TRUE;
@@ -38,11 +47,20 @@ WHERE is_active = TRUE AND is_handled = TRUE;
 
 CREATE INDEX msgs_message_org_unhandled ON msgs_message(org_id) WHERE is_handled = FALSE;
 
+-- for searching message text with ILIKE (requires pg_trgm)
+CREATE INDEX msgs_message_text_trgm
+ON msgs_message USING GIN (text gin_trgm_ops)
+WHERE is_active = TRUE AND is_handled = TRUE;
+
 CREATE INDEX msgs_messageaction_messages_idx ON msgs_messageaction USING GIN ("messages");
 
 CREATE INDEX msgs_outgoing_org_partner_created
 ON msgs_outgoing(org_id, partner_id, created_on DESC);
 
+-- for searching outgoing text with ILIKE (requires pg_trgm)
+CREATE INDEX msgs_outgoing_text_trgm
+ON msgs_outgoing USING GIN (text gin_trgm_ops);
+
 CREATE INDEX msgs_unlabelled_inbox
 ON msgs_message(org_id, created_on DESC)
 WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = FALSE AND "type" = 'I' AND has_labels = FALSE;
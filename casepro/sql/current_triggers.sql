@@ -1,5 +1,13 @@
 -- Generated by collect_sql on 2021-07-12 22:09 UTC
 
+CREATE TRIGGER cases_case_labels_on_change_trg
+   AFTER INSERT OR DELETE ON cases_case_labels
+   FOR EACH ROW EXECUTE PROCEDURE cases_case_labels_on_change();
+
+CREATE TRIGGER cases_case_on_change_trg
+   AFTER INSERT OR UPDATE OR DELETE ON cases_case
+   FOR EACH ROW EXECUTE PROCEDURE cases_case_on_change();
+
 CREATE TRIGGER msgs_message_labels_on_change_trg
    AFTER INSERT OR DELETE ON msgs_message_labels
    FOR EACH ROW EXECUTE PROCEDURE msgs_message_labels_on_change();
@@ -9,6 +17,6 @@ CREATE TRIGGER msgs_message_labels_on_truncate_trg
   EXECUTE PROCEDURE msgs_message_labels_on_change();
 
 CREATE TRIGGER msgs_message_on_change_trg
-   AFTER UPDATE ON msgs_message
+   AFTER INSERT OR UPDATE ON msgs_message
    FOR EACH ROW EXECUTE PROCEDURE msgs_message_on_change();
 
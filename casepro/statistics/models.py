@@ -4,11 +4,12 @@ from dash.orgs.models import Org
 
 from django.contrib.auth.models import User
 from django.db import connection, models
-from django.db.models import Index, Q, Sum
+from django.db.models import Count, Index, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext_lazy as _
 
-from casepro.cases.models import CaseAction, Partner
+from casepro.cases.models import Case, CaseAction, Partner
 from casepro.msgs.models import Label
 from casepro.utils import date_range
 from casepro.utils.export import BaseExport
@@ -32,6 +33,8 @@ class BaseCount(models.Model):
     TYPE_REPLIES = "R"
     TYPE_CASE_OPENED = "C"
     TYPE_CASE_CLOSED = "D"
+    TYPE_OPEN_CASES = "O"  # current number of open cases, maintained by triggers
+    TYPE_CLOSED_CASES = "X"  # current number of closed cases, maintained by triggers
 
     id = models.BigAutoField(auto_created=True, primary_key=True)
 
@@ -262,6 +265,21 @@ class DailyCount(BaseCount):
     def record_removal(cls, day, item_type, *scope_args):
         cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=-1)
 
+    @classmethod
+    def record_counts(cls, item_type, counts):
+        """
+        Records many items or removals at once, as a single count per day and scope
+        :param item_type: the item type
+        :param counts: dict of (day, scope args) tuples to counts, where negative counts are removals
+        """
+        cls.objects.bulk_create(
+            [
+                cls(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=count)
+                for (day, scope_args), count in counts.items()
+                if count
+            ]
+        )
+
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
         return cls._get_count_set(item_type, {cls.encode_scope(o): o for o in orgs}, since, until)
@@ -519,3 +537,42 @@ def record_case_closed_time(close_action):
         td = close_action.created_on - start_date
         seconds_since_open = ceil(td.total_seconds())
         DailySecondTotalCount.record_item(day, seconds_since_open, DailySecondTotalCount.TYPE_TILL_CLOSED, partner)
+
+
+def update_partner_case_counts(partners):
+    """
+    Recalculates the open and closed case counts of the given partners, which the case triggers can't maintain when a
+    change to the labels a partner can access changes which cases it can see. Rather than replacing the existing counts,
+    which would lose any written by the triggers in the meantime, this adds a correcting count calculated from the
+    cases and the existing counts as read by a single query, i.e. from the same snapshot.
+    """
+    for partner in partners:
+        cases = Case.objects.filter(org_id=partner.org_id).filter(Case.partner_filter(partner)).order_by()
+        scope = TotalCount.encode_scope(partner)
+
+        def case_count(qs):
+            return Coalesce(Subquery(qs.values("org_id").annotate(count=Count("*")).values("count")), 0)
+
+        def total_count(item_type):
+            totals = TotalCount.objects.filter(item_type=item_type, scope=scope).order_by()
+            return Coalesce(Subquery(totals.values("scope").annotate(total=Sum("count")).values("total")), 0)
+
+        actual = (
+            Partner.objects.filter(pk=partner.pk)
+            .annotate(
+                open_cases=case_count(cases.filter(closed_on=None)),
+                closed_cases=case_count(cases.exclude(closed_on=None)),
+                open_total=total_count(TotalCount.TYPE_OPEN_CASES),
+                closed_total=total_count(TotalCount.TYPE_CLOSED_CASES),
+            )
+            .values("open_cases", "closed_cases", "open_total", "closed_total")
+            .get()
+        )
+        deltas = {
+            TotalCount.TYPE_OPEN_CASES: actual["open_cases"] - actual["open_total"],
+            TotalCount.TYPE_CLOSED_CASES: actual["closed_cases"] - actual["closed_total"],
+        }
+
+        TotalCount.objects.bulk_create(
+            [TotalCount(item_type=t, scope=scope, count=d) for t, d in deltas.items() if d != 0]
+        )
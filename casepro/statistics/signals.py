@@ -1,12 +1,19 @@
 from math import ceil
 
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_init, post_save
 from django.dispatch import receiver
 
-from casepro.cases.models import CaseAction
-from casepro.msgs.models import Message, Outgoing
+from casepro.cases.models import CaseAction, Partner
+from casepro.msgs.models import Label, Message, Outgoing
 
-from .models import DailyCount, DailySecondTotalCount, TotalCount, datetime_to_date, record_case_closed_time
+from .models import (
+    DailyCount,
+    DailySecondTotalCount,
+    TotalCount,
+    datetime_to_date,
+    record_case_closed_time,
+    update_partner_case_counts,
+)
 
 
 def record_daily_and_total(day, item_type: str, *scope_args):
@@ -104,3 +111,39 @@ def record_new_case_action(sender, instance, created, **kwargs):
         record_daily_and_total(day, DailyCount.TYPE_CASE_CLOSED, org, user)
         record_daily_and_total(day, DailyCount.TYPE_CASE_CLOSED, partner)
         record_case_closed_time(instance)
+
+
+@receiver(m2m_changed, sender=Partner.labels.through)
+def update_case_counts_on_partner_labels(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal handler to recalculate partner case counts when the labels of a partner change (instance is a partner or a
+    label)
+    """
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            update_partner_case_counts([instance])
+    elif action in ("post_add", "post_remove"):
+        update_partner_case_counts(Partner.objects.filter(pk__in=pk_set))
+    elif action == "pre_clear":
+        instance._cleared_partners = list(instance.partners.all())
+    elif action == "post_clear":
+        update_partner_case_counts(instance.__dict__.pop("_cleared_partners", []))
+
+
+@receiver(post_init, sender=Label)
+def track_label_activation(sender, instance, **kwargs):
+    """
+    Init signal handler to remember whether a label was active so that saving it can tell if that has changed
+    """
+    instance._was_active = instance.__dict__.get("is_active")
+
+
+@receiver(post_save, sender=Label)
+def update_case_counts_on_label_save(sender, instance, created, **kwargs):
+    """
+    Save signal handler to recalculate partner case counts when a label is activated or deactivated
+    """
+    was_active, instance._was_active = instance._was_active, instance.is_active
+
+    if not created and was_active != instance.is_active:
+        update_partner_case_counts(instance.partners.all())
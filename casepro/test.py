@@ -9,6 +9,7 @@ from xlrd.sheet import XL_CELL_DATE
 
 from django.conf import settings
 from django.core import mail
+from django.core.cache import cache
 from django.utils.timezone import now
 
 from casepro import backend
@@ -35,6 +36,8 @@ class BaseCasesTest(DashTest):
     def setUp(self):
         super(BaseCasesTest, self).setUp()
 
+        cache.clear()
+
         settings.SITE_BACKEND = "casepro.test.TestBackend"
         settings.SITE_ORGS_STORAGE_ROOT = "test_orgs"
 
@@ -1,3 +1,4 @@
+import base64
 import calendar
 import json
 import re
@@ -11,6 +12,7 @@ import pytz
 from dateutil.relativedelta import relativedelta
 from temba_client.utils import format_iso8601
 
+from django.core.exceptions import BadRequest
 from django.utils import timezone
 from django.utils.timesince import timeuntil
 
@@ -170,6 +172,53 @@ class TimelineItem(object):
         return {"time": self.get_time(), "type": self.item.TIMELINE_TYPE, "item": self.item.as_json()}
 
 
+def encode_cursor(dt, pk):
+    """
+    Encodes the time and id of the last item on a page as an opaque cursor for fetching the next page
+    """
+    return base64.urlsafe_b64encode(f"{dt.isoformat()}|{pk}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor into the time and id of the last item on the previous page, raising a bad request error if the
+    cursor wasn't one of ours
+    """
+    try:
+        dt, pk = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(dt), int(pk)
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+
+def paginate_by_cursor(queryset, time_field, cursor, page_size):
+    """
+    Gets a page of items ordered newest first by the given time field and id. Rather than counting through all the
+    previous pages, this seeks directly to the items after the given cursor so deep pages cost the same as the first.
+
+    :param queryset: the items to paginate
+    :param time_field: the name of the time field to order by, e.g. created_on
+    :param cursor: the cursor returned with the previous page, or None for the first page
+    :param page_size: the maximum number of items on a page
+    :return: tuple of the page items and the cursor for the next page or None if there are no more
+    """
+    queryset = queryset.order_by(f"-{time_field}", "-id")
+
+    if cursor:
+        last_time, last_id = decode_cursor(cursor)
+
+        # the non-strict inequality on the time field alone lets this use our (org, time DESC) indexes
+        queryset = queryset.filter(**{f"{time_field}__lte": last_time})
+        queryset = queryset.exclude(**{time_field: last_time, "id__gte": last_id})
+
+    items = list(queryset[: page_size + 1])
+    if len(items) <= page_size:
+        return items, None
+
+    items = items[:page_size]
+    return items, encode_cursor(getattr(items[-1], time_field), items[-1].id)
+
+
 def uuid_to_int(uuid):
     """
     Converts a UUID hex string to an int within the range of a Django IntegerField, and also >=0, as the URL regexes
@@ -1,4 +1,8 @@
+import csv
+import io
 import json
+import os
+import time
 from datetime import date, datetime
 
 import pytz
@@ -11,6 +15,7 @@ from xlwt import Workbook, XFStyle
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields.hstore import KeyTransform
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.core.files.temp import NamedTemporaryFile
@@ -21,6 +26,110 @@ from django.urls import reverse
 from . import json_encode
 from .email import send_email
 
+DATE_STYLE = XFStyle()
+DATE_STYLE.num_format_str = "DD-MM-YYYY"
+
+DATETIME_STYLE = XFStyle()
+DATETIME_STYLE.num_format_str = "DD-MM-YYYY HH:MM:SS"
+
+MAX_SHEET_ROWS = 65535
+
+
+def write_excel_value(sheet, row, col, value):
+    if isinstance(value, bool):
+        sheet.write(row, col, "Yes" if value else "No")
+    elif isinstance(value, datetime):
+        value = value.astimezone(pytz.UTC).replace(tzinfo=None) if value else None
+        sheet.write(row, col, value, DATETIME_STYLE)
+    elif isinstance(value, date):
+        sheet.write(row, col, value, DATE_STYLE)
+    else:
+        sheet.write(row, col, value)
+
+
+class ExcelWriter(object):
+    """
+    Writes rows to an Excel workbook, starting new sheets as needed. Note that xlwt holds the shared string table in
+    memory and reads all flushed row data back into memory to save the workbook, so memory use still grows with the
+    size of the export.
+    """
+
+    extension = "xls"
+    content_type = "application/vnd.ms-excel"
+
+    FLUSH_ROWS = 1000
+
+    def __init__(self, file, headers, sheet_name):
+        self.file = file
+        self.headers = headers
+        self.sheet_name = sheet_name
+        self.book = Workbook()
+        self.sheet = None
+        self.num_sheets = 0
+        self.row = 0
+
+    def write_row(self, values):
+        if not self.sheet or self.row > MAX_SHEET_ROWS:
+            if self.sheet:
+                self.sheet.flush_row_data()
+
+            self.num_sheets += 1
+            self.sheet = self.book.add_sheet(self.sheet_name(self.num_sheets))
+            self.row = 0
+            self._write_row(self.headers)
+
+        self._write_row(values)
+
+        if self.row % self.FLUSH_ROWS == 0:
+            self.sheet.flush_row_data()
+
+    def _write_row(self, values):
+        for col, value in enumerate(values):
+            write_excel_value(self.sheet, self.row, col, value)
+        self.row += 1
+
+    def close(self):
+        if not self.sheet:
+            self.sheet = self.book.add_sheet(self.sheet_name(1))
+            self._write_row(self.headers)
+
+        self.book.save(self.file)
+
+
+class CSVWriter(object):
+    """
+    Writes rows to a CSV file as we go, so that memory use doesn't grow with the size of the export
+    """
+
+    extension = "csv"
+    content_type = "text/csv"
+
+    def __init__(self, file, headers, sheet_name):
+        self.stream = io.TextIOWrapper(file, encoding="utf-8", newline="", write_through=True)
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(headers)
+
+    def write_row(self, values):
+        self.writer.writerow([self.format_value(v) for v in values])
+
+    @staticmethod
+    def format_value(value):
+        if isinstance(value, bool):
+            return "Yes" if value else "No"
+        elif isinstance(value, datetime):
+            return value.astimezone(pytz.UTC).strftime("%Y-%m-%d %H:%M:%S")
+        elif isinstance(value, date):
+            return value.strftime("%Y-%m-%d")
+        return value
+
+    def close(self):
+        self.stream.flush()
+        self.stream.detach()  # so that closing the wrapper doesn't close the underlying file
+
+
+EXPORT_WRITERS = {w.extension: w for w in (ExcelWriter, CSVWriter)}
+EXPORT_CONTENT_TYPES = {w.extension: w.content_type for w in (ExcelWriter, CSVWriter)}
+
 
 class BaseExport(models.Model):
     """
@@ -39,28 +148,19 @@ class BaseExport(models.Model):
     directory = None
     download_view = None
 
-    DATE_STYLE = XFStyle()
-    DATE_STYLE.num_format_str = "DD-MM-YYYY"
-
-    DATETIME_STYLE = XFStyle()
-    DATETIME_STYLE.num_format_str = "DD-MM-YYYY HH:MM:SS"
-
-    MAX_SHEET_ROWS = 65535
-
-    def do_export(self):
+    def do_export(self, progress_callback=None):
         """
         Does actual export. Called from a celery task.
         """
-        book = Workbook()
-        self.render_book(book)
-
         temp = NamedTemporaryFile(delete=True)
-        book.save(temp)
+        extension = self.write_file(temp, progress_callback)
         temp.flush()
+        temp.seek(0)
 
         org_root = getattr(settings, "SITE_ORGS_STORAGE_ROOT", "orgs")
-        filename = "%s/%d/%s/%s.xls" % (org_root, self.org_id, self.directory, random_string(20))
+        filename = "%s/%d/%s/%s.%s" % (org_root, self.org_id, self.directory, random_string(20), extension)
         default_storage.save(filename, File(temp))
+        temp.close()
 
         self.filename = filename
         self.save(update_fields=("filename",))
@@ -75,6 +175,15 @@ class BaseExport(models.Model):
 
         gc.collect()
 
+    def write_file(self, file, progress_callback=None):
+        """
+        Writes the export to the given file, returning the file extension
+        """
+        book = Workbook()
+        self.render_book(book)
+        book.save(file)
+        return ExcelWriter.extension
+
     def render_book(self, book):  # pragma: no cover
         """
         Child classes implement this to populate the Excel book
@@ -86,15 +195,7 @@ class BaseExport(models.Model):
             self.write_value(sheet, row, col, value)
 
     def write_value(self, sheet, row, col, value):
-        if isinstance(value, bool):
-            sheet.write(row, col, "Yes" if value else "No")
-        elif isinstance(value, datetime):
-            value = value.astimezone(pytz.UTC).replace(tzinfo=None) if value else None
-            sheet.write(row, col, value, self.DATETIME_STYLE)
-        elif isinstance(value, date):
-            sheet.write(row, col, value, self.DATE_STYLE)
-        else:
-            sheet.write(row, col, value)
+        write_excel_value(sheet, row, col, value)
 
     class Meta:
         abstract = True
@@ -102,24 +203,67 @@ class BaseExport(models.Model):
 
 class BaseSearchExport(BaseExport):
     """
-    Base class for exports based on item searches which may be initiated by partner users
+    Base class for exports based on item searches which may be initiated by partner users. These are written a row at
+    a time, with items fetched from the database in chunks, so that memory use doesn't grow with the size of the export.
     """
 
     partner = models.ForeignKey("cases.Partner", related_name="%(class)ss", null=True, on_delete=models.PROTECT)
 
     search = models.TextField()
 
+    CHUNK_SIZE = 2000
+
     @classmethod
     def create(cls, org, user, search):
         return cls.objects.create(org=org, partner=user.get_partner(org), created_by=user, search=json_encode(search))
 
-    def render_book(self, book):
-        search = self.get_search()
+    def write_file(self, file, progress_callback=None):
+        writer = EXPORT_WRITERS[settings.SITE_EXPORT_FORMAT](file, self.get_headers(), self.get_sheet_name)
 
-        self.render_search(book, search)
+        start = time.perf_counter()
+        num_rows = 0
 
-    def render_search(self, book, search):  # pragma: no cover
-        pass
+        for values in self.get_rows(self.get_search()):
+            writer.write_row(values)
+            num_rows += 1
+
+            if progress_callback and num_rows % self.CHUNK_SIZE == 0:
+                progress_callback(num_rows, num_rows / (time.perf_counter() - start))
+
+        writer.close()
+
+        if progress_callback:
+            progress_callback(num_rows, num_rows / max(time.perf_counter() - start, 0.001))
+
+        return writer.extension
+
+    @staticmethod
+    def get_contact_field_columns(contact_fields, contact_path="contact"):
+        """
+        Gets annotations which select the values of the given contact fields directly from the contacts' hstore column
+        """
+        return {
+            "contact_field_%d" % f: KeyTransform(field.key, "%s__fields" % contact_path)
+            for f, field in enumerate(contact_fields)
+        }
+
+    def get_headers(self):  # pragma: no cover
+        """
+        Child classes implement this to provide the column headers
+        """
+        return []
+
+    def get_sheet_name(self, num):  # pragma: no cover
+        """
+        Child classes implement this to provide the name of each Excel sheet
+        """
+        return str(num)
+
+    def get_rows(self, search):  # pragma: no cover
+        """
+        Child classes implement this to generate the row values for the given search
+        """
+        return []
 
     def get_search(self):
         search = json.loads(self.search)
@@ -164,8 +308,12 @@ class BaseDownloadView(OrgObjPermsMixin, SmartReadView):
 
             export_file = default_storage.open(export.filename, "rb")
 
-            response = HttpResponse(export_file, content_type="application/vnd.ms-excel")
-            response["Content-Disposition"] = "attachment; filename=%s" % self.filename
+            # use the extension of the actual export file, as it might be a CSV file rather than an Excel one
+            extension = os.path.splitext(export.filename)[1][1:]
+            filename = "%s.%s" % (os.path.splitext(self.filename)[0], extension)
+
+            response = HttpResponse(export_file, content_type=EXPORT_CONTENT_TYPES[extension])
+            response["Content-Disposition"] = "attachment; filename=%s" % filename
 
             return response
         else:
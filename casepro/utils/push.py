@@ -0,0 +1,126 @@
+import asyncio
+import json
+from urllib.parse import urlencode
+
+import redis.asyncio as aioredis
+from django_redis import get_redis_connection
+
+from django.conf import settings
+from django.db import transaction
+
+SCOPE_VERSION_KEY = "push:version:%s"
+SCOPE_CHANNEL = "push:channel:%s"
+SCOPE_VERSION_TTL = 60 * 60 * 24 * 7  # 1 week
+
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_RETRY_MILLIS = 2000
+
+
+def inbox_scope(org):
+    """
+    Scope for changes to any of the incoming messages of an org, watched by users who can see all labels
+    """
+    return "inbox:%d" % org.pk
+
+
+def label_scope(label_id):
+    """
+    Scope for changes to the incoming messages with a label, watched by users who can only see some labels
+    """
+    return "label:%d" % label_id
+
+
+def case_scope(case):
+    """
+    Scope for changes to the timeline of a case
+    """
+    return "case:%d" % case.pk
+
+
+def publish(*scopes):
+    """
+    Publishes a change to the given scopes, waking any clients streaming them. This happens once the current
+    transaction commits so that clients don't refresh before they can see the change.
+    """
+    transaction.on_commit(lambda: publish_now(scopes))
+
+
+def publish_now(scopes, r=None):
+    """
+    Publishes a change to the given scopes by incrementing their versions and notifying their channels
+    """
+    r = r or get_redis_connection()
+
+    pipe = r.pipeline()
+    for scope in scopes:
+        pipe.incr(SCOPE_VERSION_KEY % scope)
+        pipe.expire(SCOPE_VERSION_KEY % scope, SCOPE_VERSION_TTL)
+        pipe.publish(SCOPE_CHANNEL % scope, 1)
+    pipe.execute()
+
+
+def get_versions(scopes, r=None):
+    """
+    Gets the current versions of the given scopes
+    """
+    r = r or get_redis_connection()
+    scopes = list(scopes)
+
+    versions = r.mget([SCOPE_VERSION_KEY % s for s in scopes]) if scopes else []
+    return {s: int(v or 0) for s, v in zip(scopes, versions)}
+
+
+async def stream_changes(scopes_by_param, known, seconds):
+    """
+    Async generator of server-sent events for the given params, each of which watches one or more scopes. An event is
+    sent with the current versions whenever they differ from the known ones, which is woken by the scope channels so
+    no worker is held while waiting. The stream ends after the given number of seconds and the client reconnects,
+    passing back the last versions it saw as the event id.
+
+    :param scopes_by_param: dict of params to the scopes they watch, where a param's version is the sum of its scopes'
+    :param known: dict of params to the versions the client has seen, which may be empty
+    :param seconds: the number of seconds to keep the stream open for
+    """
+    scopes = list({s for param_scopes in scopes_by_param.values() for s in param_scopes})
+    keys = [SCOPE_VERSION_KEY % s for s in scopes]
+
+    r = aioredis.from_url(settings.CACHES["default"]["LOCATION"])
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds
+    try:
+        # subscribe before reading versions so that a change published in between isn't missed
+        if scopes:
+            await pubsub.subscribe(*[SCOPE_CHANNEL % s for s in scopes])
+
+        yield "retry: %d\n\n" % STREAM_RETRY_MILLIS
+        last_sent = loop.time()
+
+        while True:
+            scope_versions = {s: int(v or 0) for s, v in zip(scopes, await r.mget(keys))} if scopes else {}
+            versions = {param: sum(scope_versions[s] for s in ss) for param, ss in scopes_by_param.items()}
+
+            if versions != known:
+                changed = any(versions[p] != v for p, v in known.items())
+                data = json.dumps({"versions": versions, "changed": changed})
+                yield "id: %s\ndata: %s\n\n" % (urlencode(versions), data)
+                known, last_sent = versions, loop.time()
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+
+            # a comment line keeps proxies from closing a quiet stream
+            if loop.time() - last_sent >= STREAM_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = loop.time()
+
+            wait = min(remaining, STREAM_KEEPALIVE_SECONDS - (loop.time() - last_sent))
+            if scopes:
+                await pubsub.get_message(timeout=wait)
+            else:
+                await asyncio.sleep(wait)
+    finally:
+        await pubsub.aclose()
+        await r.aclose()
@@ -1,13 +1,17 @@
+import time
 from datetime import date, datetime
 from enum import Enum
 from uuid import UUID
 
 import pytz
+from asgiref.sync import async_to_sync, sync_to_async
 
 from django.core import mail
+from django.core.exceptions import BadRequest
 from django.http import HttpRequest
 from django.test import override_settings
 
+from casepro.msgs.models import Message
 from casepro.test import BaseCasesTest
 
 from . import (
@@ -15,6 +19,8 @@ from . import (
     date_range,
     date_to_milliseconds,
     datetime_to_microseconds,
+    decode_cursor,
+    encode_cursor,
     get_language_name,
     humanize_seconds,
     is_valid_language_code,
@@ -24,6 +30,7 @@ from . import (
     microseconds_to_datetime,
     month_range,
     normalize,
+    paginate_by_cursor,
     safe_max,
     str_to_bool,
     truncate,
@@ -31,6 +38,7 @@ from . import (
 )
 from .email import send_email
 from .middleware import JSONMiddleware
+from .push import get_versions, inbox_scope, label_scope, publish, publish_now, stream_changes
 
 
 class UtilsTest(BaseCasesTest):
@@ -128,6 +136,30 @@ class UtilsTest(BaseCasesTest):
         )
         self.assertEqual(list(date_range(date(2015, 1, 29), date(2015, 1, 29))), [])
 
+    def test_cursors(self):
+        dt = datetime(2015, 12, 25, 13, 30, 15, 123456, pytz.UTC)
+
+        cursor = encode_cursor(dt, 123)
+        self.assertEqual(decode_cursor(cursor), (dt, 123))
+
+        for invalid in ("xyz", "x" * 5, encode_cursor(dt, 123)[:-4], "¿?"):
+            self.assertRaises(BadRequest, decode_cursor, invalid)
+
+    def test_paginate_by_cursor(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        msgs = [self.create_message(self.unicef, 101 + m, ann, f"Msg #{m}") for m in range(5)]
+
+        # give two messages the same time so that paging has to use ids to break ties
+        Message.objects.filter(id__in=[msgs[2].id, msgs[3].id]).update(created_on=msgs[2].created_on)
+
+        items, cursor = paginate_by_cursor(Message.objects.all(), "created_on", None, 3)
+        self.assertEqual(items, [msgs[4], msgs[3], msgs[2]])
+        self.assertIsNotNone(cursor)
+
+        items, cursor = paginate_by_cursor(Message.objects.all(), "created_on", cursor, 3)
+        self.assertEqual(items, [msgs[1], msgs[0]])
+        self.assertIsNone(cursor)
+
     def test_timeline_item(self):
         d1 = datetime(2015, 10, 1, 9, 0, 0, 0, pytz.UTC)
         ann = self.create_contact(self.unicef, "C-101", "Ann")
@@ -175,6 +207,58 @@ class UtilsTest(BaseCasesTest):
         self.assertEqual(humanize_seconds(180000), "2\xa0days, 2\xa0hours")
 
 
+class PushTest(BaseCasesTest):
+    def test_publish(self):
+        scope1, scope2, scope3 = inbox_scope(self.unicef), inbox_scope(self.nyaruka), label_scope(self.aids.id)
+        self.assertEqual(get_versions([scope1, scope2, scope3]), {scope1: 0, scope2: 0, scope3: 0})
+
+        # changes are only published once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            publish(scope1, scope3)
+
+            self.assertEqual(get_versions([scope1, scope3]), {scope1: 0, scope3: 0})
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(get_versions([scope1, scope2, scope3]), {scope1: 1, scope2: 0, scope3: 1})
+
+        publish_now([scope2])
+
+        self.assertEqual(get_versions([scope1, scope2, scope3]), {scope1: 1, scope2: 1, scope3: 1})
+        self.assertEqual(get_versions([]), {})
+
+    def test_stream_changes(self):
+        scope1, scope2 = inbox_scope(self.unicef), label_scope(self.aids.id)
+        publish_now([scope1])
+
+        async def read_stream(known):
+            stream = stream_changes({"inbox": [scope1], "labels": [scope2]}, known, 10)
+            events = [await anext(stream), await anext(stream)]
+
+            # a change published to an open stream wakes it straight away
+            started = time.monotonic()
+            await sync_to_async(publish_now)([scope2])
+            events.append(await anext(stream))
+            await stream.aclose()
+
+            return events, time.monotonic() - started
+
+        events, waited = async_to_sync(read_stream)({})
+        self.assertEqual(events[0], "retry: 2000\n\n")
+        self.assertEqual(
+            events[1], 'id: inbox=1&labels=0\ndata: {"versions": {"inbox": 1, "labels": 0}, "changed": false}\n\n'
+        )
+        self.assertEqual(
+            events[2], 'id: inbox=1&labels=1\ndata: {"versions": {"inbox": 1, "labels": 1}, "changed": true}\n\n'
+        )
+        self.assertLess(waited, 5)
+
+        # a client which passes back versions which are out of date is told about the change straight away
+        events, waited = async_to_sync(read_stream)({"inbox": 0, "labels": 1})
+        self.assertEqual(
+            events[1], 'id: inbox=1&labels=1\ndata: {"versions": {"inbox": 1, "labels": 1}, "changed": true}\n\n'
+        )
+
+
 class EmailTest(BaseCasesTest):
     @override_settings(SEND_EMAILS=True)
     def test_send_email(self):